@@ -1,5 +1,6 @@
 import requests
 import json
+import sys
 
 host = "http://localhost:5001"
 
@@ -27,12 +28,26 @@ body = {
     "typical": 1
 }
 
-r = requests.post(host + "/api/v1/model", data = json.dumps(body)).json()
+stream = "--stream" in sys.argv # Print tokens as they are generated instead of waiting for the full completion
 
-print(r)
+if stream:
+    text = ""
+    with requests.post(host + "/api/extra/generate/stream", data = json.dumps(body), stream = True) as r:
+        for line in r.iter_lines(decode_unicode = True):
+            if line and line.startswith("data:"):
+                token = json.loads(line[5:])['token']
+                print(token, end = "", flush = True)
+                text += token
+    print()
+else:
+    r = requests.post(host + "/api/v1/model", data = json.dumps(body)).json()
+
+    print(r)
+
+    text = r['results'][0]['text']
 
 with open("output.py", "w") as f:
-    lines = r['results'][0]['text'].splitlines()
+    lines = text.splitlines()
 
     for line in lines:
         f.write(f"{line}\n")
\ No newline at end of file
@@ -1,25 +1,34 @@
-import requests
+import sys
 import json
+import queue
+import signal
 import asyncio
 import uuid
-import websockets
-import jsonpickle
 import threading
 import time
 
-from urllib import parse
-
 from multiprocessing import Queue
+from collections import OrderedDict
 # from queue import Queue
 
-from utils.helpers.agent_helpers import get_inference_config, validate_endpoint
-from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
-from utils.helpers.all_helpers import create_ws_message
-from utils.helpers.constants import HTTPMethod, WorkerState, WorkerTask
+from utils.helpers.agent_helpers import completion_text, get_inference_config, validate_endpoint
+from utils.helpers.backend_pool import BackendPool
+from utils.helpers.inference_cache import InferenceCache
+from utils.helpers.inference_client import InferenceError
+from utils.helpers.liveness import LivenessTracker
+from utils.helpers.plan_cache import PlanCache, task_template
+from utils.helpers.prompts import PromptBuilder, Tokenizer
+from utils.helpers.screenshot_pipeline import DEFAULT_PRESET, ScreenshotPipeline
+from utils.helpers.tracing import AGENT_QUEUE_WAIT, INFERENCE, Trace, span
+from utils.helpers.worker_pool import WorkerPool
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction, InstructionStreamParser
+from utils.helpers.wire_protocol import PROTOCOL_JSON, decode_message, encode_message, negotiate, unpack_object
+from utils.helpers.constants import HTTPMethod, WorkerState, WorkerTask, InferencePriority, node_url as default_node_url
 
 from utils.console import *
 
 from worker import Worker
+from engines import DEFAULT_ENGINE, prepare_engine
 
 class Agent():
     '''An :class:`Agent` employs :class:`Worker`'s that carry out their given task.
@@ -28,34 +37,67 @@ class Agent():
     An :class:`Agent` must be attached to a Node in order to receive instruction, this can be done
     by calling `.attach_agent()` on the parent :class:`Node`.'''
 
-    workers = []
-
-    def __init__(self, uses_inference_endpoint = True, inference_endpoint = "http://localhost:5001", uid = "", agent_task_queue: Queue = None) -> None:
+    def __init__(self, uses_inference_endpoint = True, inference_endpoint = "http://localhost:5001", uid = "", agent_task_queue: Queue = None, stream_inference = False, inference_cache: InferenceCache = None, use_node_scheduler = False, browser_pool_size = 2, max_leases_per_browser = 50, worker_engine = DEFAULT_ENGINE, max_pages_per_worker = 4, vision_preset = DEFAULT_PRESET, min_workers = 1, max_workers = 4, worker_idle_timeout = 60, worker_mode = "thread", max_concurrent_tasks = None, prefetch = 2, node_url: str = None, heartbeat_interval = 5, worker_deadline = 30, task_deadline = 300, max_branches_per_task: int = None, plan_cache: PlanCache = None, task_queue_size: int = None, prompt_history_turns = 0, tokenizer_path: str = None) -> None:
         self._uses_inference_endpoint = uses_inference_endpoint
+        self._stream_inference = stream_inference # Dispatch instructions to a Worker as they are generated instead of after the full response
         self._inference_endpoint = inference_endpoint
         self._inference_config = get_inference_config()
         self.agent_id = uid.hex if uid != "" else uuid.uuid4().hex
-        self.is_valid = validate_endpoint(inference_endpoint) # Is the endpoint a valid and reachable endpoint. If false, the endpoint may be incorrectly written or not open
         self.agent_name = f"Agent-{self.agent_id}"
         self.agent_task_queue = agent_task_queue
+        self.node_url = node_url or default_node_url() # WebSocket of the Node this agent and its Workers talk through
         self.task_queue = Queue()
+        self.protocol = PROTOCOL_JSON # Wire protocol negotiated with the Node on connect
+        self._backends = BackendPool(inference_endpoint) # One or more inference endpoints, load balanced and health probed. Its HTTP session is opened on first use inside the agent process
+        self._inference_cache = inference_cache if inference_cache is not None else InferenceCache() # Skips the generate call for prompts already answered with the same sampling config
+        self._plans = plan_cache if plan_cache is not None else PlanCache() # Plans made for earlier tasks of the same shape, reused without inference
+        self._plan_prompts = {} # task_id -> (prompt, generation prompt or None) of a planned task in flight, so its plan is dropped from the caches if it fails
+        self._replan = OrderedDict() # Templates whose plan failed after coming from the PlanCache. Their next generation skips the InferenceCache
+        self._prompts = PromptBuilder.from_config(self._inference_config, tokenizer = Tokenizer(tokenizer_path), history_turns = prompt_history_turns) # Fixed preamble, history and task, within the context size
+        self._use_node_scheduler = use_node_scheduler # Submit generations to the Node's InferenceScheduler instead of calling the endpoint directly
+        self._pending_inference = {} # request_id -> future waiting on an inference_result from the Node
+        self._browser_pool_size = browser_pool_size # Warm browsers kept for this agent's Workers
+        self._max_leases_per_browser = max_leases_per_browser
+        self._worker_engine = worker_engine # Browser engine the Workers drive, "playwright" or "selenium"
+        self._max_pages_per_worker = max_pages_per_worker # Tasks a single Worker runs concurrently, one page each
+        self._vision_preset = vision_preset # Resolution and format screenshots are prepared in, see VISION_PRESETS
+        self._screenshots = None # ScreenshotPipeline shared by this agent's Workers. Created inside the agent process
+        self._worker_pool_config = {"min_workers": min_workers, "max_workers": max_workers, "idle_timeout": worker_idle_timeout, "mode": worker_mode, "max_branches": max_branches_per_task} # Pages a MultiInstruction's independent branches may use at once, the Worker's max_pages by default
+        self.workers: WorkerPool = None # Elastic pool of Workers pulling from the Task Queue. Created inside the agent process by `.start()`
+        self._max_concurrent_tasks = max_concurrent_tasks or max_workers * max_pages_per_worker # Dispatched tasks run at once. Advertised to the Node as this agent's slots
+        self._worker_pool_config['max_outstanding'] = task_queue_size or 2 * self._max_concurrent_tasks # Tasks waiting on or run by the Workers before new ones are turned away
+        self._prefetch = prefetch # Dispatched tasks held back on top of those, so the next one is at hand when a slot frees up
+        self._prefetched = OrderedDict() # task_id -> task dispatched by the Node and not started yet. The Node may steal these back
+        self._running_tasks = 0
+        self._task_futures = {} # task_id -> future waiting on the Worker's worker_complete
+        self._traces = {} # task_id -> Trace of a dispatched task the Node is tracing
+        self._background_tasks = set() # Strong references to tasks spawned from the message loop so they aren't garbage collected
+        self.heartbeat_interval = heartbeat_interval # Seconds between heartbeats to the Node, and from this agent's Workers
+        self._worker_liveness = LivenessTracker(deadline = worker_deadline) # Workers silent for longer have their tasks requeued
+        self._task_deadline = task_deadline # Seconds a dispatched task may run before it is given back to the Node, `None` for no limit
 
     async def start(self):
         '''Starts the :class:`Agent` and beings listening for instruction on the localhost server.
         Wont be able to send messages to the websocket server without having received a message first that prompts a sent message.
         Must be ran in order to give tasks to :class:`Worker`'s'''
-        async for ws in websockets.connect("ws://localhost:5002", ping_interval = None):
+        import websockets # Imported in the agent process once it runs, so building an Agent stays cheap
+        from utils.helpers.local_transport import connect # The Node's local socket when it runs on this machine, its WebSocket otherwise
+
+        self._backends.start() # Checks the endpoints right away without blocking, then keeps their health fresh for as long as the agent runs
+        self._get_worker_pool().start() # Warm up to min_workers, then grow and shrink with the Task Queue
+        self._spawn(self._watch_workers())
+        async for ws in connect(self.node_url, ping_interval = None):
+            _heartbeat = None
             try:
                 self.ws = ws
-                #hb = threading.Thread(target = self.sync_heartbeat, args = (ws, 2)) # Start the heartbeating thread to keep this connection alive
-                #hb.start()
-
-                await ws.send(create_ws_message(type = "agent_ready", origin = self.agent_name, target = "node")) # Let the node know that this agent is ready to begin tasking
+                self.protocol = await negotiate(ws, self.agent_name, role = "agent") # Register with the Node so messages can be routed to this agent
+                _heartbeat = self._spawn(self.heartbeat(ws, self.heartbeat_interval)) # Keeps the Node from taking this agent's tasks away while it is quiet
+                await self._send(type = "agent_ready", target = "node", data = {"slots": self._max_concurrent_tasks, "prefetch": self._prefetch}) # Let the node know that this agent is ready to begin tasking, and how much it can take
                 print_substep(f"{self.agent_name}: Ready to receive instruction from Node!", style = "green1")
                 async for message in ws:
                     try:
-                        print("Listening...")
-                        res = json.loads(message)
+                        log_debug("%s: Listening...", self.agent_name, category = "agent")
+                        res = decode_message(message)
 
                         # Maybe create a new thread to parse and run workers if the websocket keeps cutting out during task awaiting
                         await self._parse(res)
@@ -65,15 +107,24 @@ class Agent():
                         #self.start # Try to notify Node somehow for a more graceful shutdown
             except websockets.ConnectionClosed as e: # Handle spontaneous disconnects and reconnect when occurred
                 continue
+            finally:
+                if _heartbeat is not None:
+                    _heartbeat.cancel()
 
     def sync_start(self):
         '''Starts the :class:`Agent` and beings listening for instruction on the localhost server.
         Wont be able to send messages to the websocket server without having received a message first that prompts a sent message.
         Must be ran in order to give tasks to :class:`Worker`'s'''
+        prepare_engine(self._worker_engine, browser_pool_size = self._browser_pool_size, max_leases_per_browser = self._max_leases_per_browser) # Launch browsers before the first task needs one
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.start())
-        loop.close()
+        try:
+            loop.run_until_complete(self.start())
+        finally:
+            if self.workers is not None:
+                self.workers.stop()
+            loop.run_until_complete(self._backends.close())
+            loop.close()
 
     def sync_heartbeat(self, ws, interval):
         '''Run a heartbeat to keep the WebSocket client alive while working on a task or parsing a new message.
@@ -87,26 +138,30 @@ class Agent():
         '''Run a heartbeat to keep the WebSocket client alive while working on a task or parsing a new message.
         The heartbeat will run on :class:`Agent` creation, and ends when the :class:`Agent` is destroyed.'''
         while True:
-            print_substep(f"{self.agent_name}: Sending heartbeat.", style = "bright_blue")
+            log_debug("%s: Sending heartbeat.", self.agent_name, category = "agent")
             try:
-                await ws.send(create_ws_message(type = "heartbeat", origin = self.agent_name, target = "node", data = {}))
-            except:
-                print_error("Couldnt send heartbeat. Trying again.")
-            time.sleep(interval)
-
-    async def run_dequeue(self):
-        '''Grabs the first task from the Agent Task Queue and inferences to split it up into smaller tasks for the :class:`Worker`'s.
-        NOTE: :class:`Agent` will NOT receive messages from the localhost during this time. Only when the task has been inferenced and put into
-        the Task Queue will it listen again.'''
-        print_substep(f"{self.agent_name}: Beginning scanning for tasks in Agent Task Queue...", style = "bright_blue")
-        # Wait to get a task from Node
-        try:
-            task = self.agent_task_queue.get(block = True, timeout = None)
+                await self._send(type = "heartbeat", target = "node", ws = ws)
+            except Exception as e:
+                print_error(f"{self.agent_name}: Couldnt send heartbeat: {type(e).__name__}: {e}. Trying again.")
+            await asyncio.sleep(interval)
 
-            # NOTE: In production, task would inference on Agent further, then be sent to Workers
-            await self.instruct("null", task)
-        except Exception as e:
-            print_error("Agent Task Queue empty. Didnt retrieve any data.")
+    async def _watch_workers(self):
+        '''Gives the tasks of Workers that stopped sending heartbeats back to the Node, and replaces those Workers'''
+        while True:
+            await asyncio.sleep(self._worker_liveness.deadline / 4)
+            for name, reported in self._worker_liveness.expired().items():
+                _tasks = [task_id for task_id in reported or [] if task_id in self._task_futures]
+                if self.workers is not None:
+                    self.workers.evict(name, tasks = len(_tasks))
+                print_warning(f"{self.agent_name}: {name} missed its heartbeat deadline, {len(_tasks)} tasks requeued", category = "agent")
+                for task_id in _tasks:
+                    self._give_up(task_id)
+
+    def _give_up(self, task_id: str):
+        '''Ends the wait on a dispatched task with "requeue", which hands it back to the Node for any agent to run again'''
+        _future = self._task_futures.pop(task_id, None)
+        if _future is not None and not _future.done():
+            _future.set_result({"task_id": task_id, "result": "requeue"})
 
     async def flush_agent(self):
         '''Essentially reset the :class:`Agent` after all tasks given are completed. This usually includes after the Agent Task Queue is empty as well.
@@ -117,40 +172,292 @@ class Agent():
         if msg['target'] == self.agent_name or msg['target'] == "any_agent":
             if msg['type'] == "function_invoke":
                 if msg['data']['function_to_invoke'] == "instruct":
-                    self.instruct(prompt = msg['data']['params']['prompt'])
+                    self._spawn(self.instruct(prompt = msg['data']['params']['prompt']))
                 elif msg['data']['function_to_invoke'] == "_put_queue":
-                    _deserialized_item = jsonpickle.decode(msg['data']['params']['item'])
-                    self._put_queue(item = _deserialized_item)
+                    _deserialized_item = unpack_object(msg['data']['params']['item'])
+                    if not self._put_queue(item = _deserialized_item): # Tell the sender to hold on to it and try again later
+                        _admission = self._get_worker_pool().admission
+                        await self._send(type = "queue_full", target = msg['origin'], data = {"ref": msg['data']['params'].get('ref'), "retry_after": _admission.retry_after(), "depth": _admission.depth, "capacity": _admission.capacity})
+            elif msg['type'] == "heartbeat": # From one of this agent's Workers, with the tasks it runs
+                if self.workers is not None and msg['origin'] in self.workers:
+                    self._worker_liveness.beat(msg['origin'], msg['data'].get('tasks', []))
             elif msg['type'] == "worker_complete":
-                print(f"{msg['origin']} completed their task: {msg['data']['result']}")
-            elif msg['type'] == "agent_dequeue":
-                await self.run_dequeue()
+                if self.workers is not None and msg['origin'] in self.workers:
+                    self.workers.task_done()
+                    self._worker_liveness.beat(msg['origin'])
+                _planned = self._plan_prompts.pop(msg['data'].get('task_id'), None)
+                if _planned is not None and msg['data']['result'] == "failed":
+                    self._spawn(self._forget_plan(*_planned))
+                _future = self._task_futures.pop(msg['data'].get('task_id'), None)
+                if _future is not None and not _future.done():
+                    _future.set_result(msg['data'])
+                log("%s completed their task: %s", msg['origin'], msg['data']['result'], category = "agent")
+            elif msg['type'] == "inference_result":
+                _future = self._pending_inference.get(msg['data']['request_id'])
+                if _future is not None and not _future.done():
+                    _future.set_result(msg['data'])
+            elif msg['type'] == "dispatch_task":
+                _trace = Trace.receive(msg['data'].get('trace'))
+                if _trace is not None:
+                    _trace.mark("received")
+                    self._traces[msg['data']['task_id']] = _trace
+                self._prefetched[msg['data']['task_id']] = unpack_object(msg['data']['item'])
+                self._drain_dispatched()
+            elif msg['type'] == "steal_task": # Give a task back to the Node if it hasn't been started yet
+                _returned = self._prefetched.pop(msg['data']['task_id'], None) is not None
+                if _returned:
+                    self._traces.pop(msg['data']['task_id'], None)
+                await self._send(type = "task_returned", target = "node", data = {"task_id": msg['data']['task_id'], "returned": _returned})
+            elif msg['type'] == "get_prompt_stats":
+                await self._send(type = "prompt_stats", target = msg['origin'], data = self._prompts.stats())
+            elif msg['type'] == "get_plan_stats":
+                await self._send(type = "plan_stats", target = msg['origin'], data = self._plans.stats())
+            elif msg['type'] == "get_worker_stats":
+                await self._send(type = "worker_stats", target = msg['origin'], data = self._get_worker_pool().stats())
             elif msg['type'] == "ping":
                 print_substep(f"{self.agent_name}: Received ping from {msg['origin']}", style = "bright_blue")
                 return True # Maybe send a pong back to the Node. If need be
 
+    def _drain_dispatched(self):
+        '''Starts prefetched tasks while there are free slots'''
+        while self._prefetched and self._running_tasks < self._max_concurrent_tasks:
+            _task_id, _task = self._prefetched.popitem(last = False)
+            self._running_tasks += 1
+            self._spawn(self._run_dispatched(_task_id, _task))
+
+    async def _run_dispatched(self, task_id: str, task):
+        '''Runs one task dispatched by the Node and reports back when it is done, which frees its credit on the Node'''
+        _result = "success"
+        _completion = None # The Worker's worker_complete data for instructions
+        _trace = self._traces.pop(task_id, None)
+        if _trace is not None:
+            _trace.since("received", AGENT_QUEUE_WAIT)
+        try:
+            await self._send(type = "task_started", target = "node", data = {"task_id": task_id})
+            if not isinstance(task, (SingleInstruction, MultiInstruction)): # A prompt, planned into instructions first
+                _prompt = task
+                with span(_trace, INFERENCE): # Next to nothing when the plan cache has a plan for it
+                    task, _generated = await self._plan(_prompt)
+                if task is None:
+                    raise RuntimeError("The model's answer held no instructions")
+                self._plan_prompts[task_id] = (_prompt, _generated)
+            _done = asyncio.get_running_loop().create_future()
+            self._task_futures[task_id] = _done
+            await self.instruct("null", task, task_id = task_id, trace = _trace)
+            try:
+                _completion = await asyncio.wait_for(_done, self._task_deadline)
+            except asyncio.TimeoutError: # Likely a hung browser. Free its page and let another agent try
+                _worker = self._worker_liveness.reported_by(task_id)
+                if _worker is not None:
+                    await self._send(type = "worker_cancel", target = _worker, data = {"task_id": task_id})
+                print_warning(f"{self.agent_name}: Task {task_id} ran past its {self._task_deadline} s deadline, requeued", category = "agent")
+                _completion = {"task_id": task_id, "result": "requeue"}
+            _result = _completion['result']
+            _trace = Trace.receive(_completion.get('trace')) or _trace # Now with the Worker's stages
+        except queue.Full: # The Workers are backed up. Give it back so the Node can send it elsewhere
+            print_warning(f"{self.agent_name}: Task queue full, task {task_id} requeued", category = "agent")
+            _result = "requeue"
+        except Exception as e:
+            print_error(f"{self.agent_name}: Dispatched task failed: {type(e).__name__}: {e}")
+            _result = "failed"
+        finally:
+            self._task_futures.pop(task_id, None)
+            self._plan_prompts.pop(task_id, None) # Already handled on worker_complete, unless the task never got that far
+            self._running_tasks -= 1
+        _data = {"task_id": task_id, "result": _result}
+        if _completion is not None and _completion.get('branches'):
+            _data['branches'] = _completion['branches'] # Per-branch results of a MultiInstruction that ran as several
+        if _trace is not None:
+            _data['trace'] = _trace.to_dict()
+        await self._send(type = "task_done", target = "node", data = _data)
+        self._drain_dispatched()
+
+    def _spawn(self, coro):
+        '''Runs `coro` in the background of the agent's event loop'''
+        _task = asyncio.get_running_loop().create_task(coro)
+        self._background_tasks.add(_task)
+        _task.add_done_callback(self._background_tasks.discard)
+        return _task
+
+    async def _send(self, type: str, target: str, data: dict = {}, ws = None):
+        '''Sends a message to the :class:`Node` using the negotiated wire protocol'''
+        await (ws or self.ws).send(encode_message(type = type, origin = self.agent_name, target = target, data = data, protocol = self.protocol))
+
     def _put_queue(self, item):
         '''Put an item into the Task Queue. Active :class:`Worker`'s will automatically get items out of the Task Queue and run them as they're available.
+        Returns `False` when the Task Queue is full, in which case the item was not queued and the caller still owns it.
         Example item: `MultiInstruction([SingleInstruction(WorkerTask.GOTO, "https://google.com"), SingleInstruction(WorkerTask.SCREENSHOT, None)])`'''
         try:
-            self.task_queue.put(item, block = False)
-        except:
-            print_error(text = f"Insertting {item} into Task Queue, failed. It is possible the queue was full, or something else happened. Task aborted.")
-
-    async def instruct(self, prompt: str, task):
-        '''Passes on the prompt to the model associated with this :class:`Agent` and waits for a response.
+            self._get_worker_pool().submit(item, block = False)
+        except queue.Full:
+            print_warning(f"{self.agent_name}: Task Queue full, turned away {item}", category = "agent")
+            return False
+        return True
+
+    async def instruct(self, prompt: str, task = None, bypass_cache = False, priority: InferencePriority = None, task_id: str = None, trace: Trace = None):
+        '''Passes on the prompt to the model associated with this :class:`Agent`, hands the instructions it answers with to a :class:`Worker`
+        and returns them as a :class:`MultiInstruction` (see :meth:`plan`). If `task` is already a set of instructions, it is handed straight to a :class:`Worker` instead.
+        Set `bypass_cache` when a fresh sample is wanted even though an identical prompt was answered before.
+        `priority` is the scheduling class used by the :class:`Node`'s scheduler. When omitted the scheduler picks one from the prompt length.
+        `task_id` is echoed back in the Worker's `worker_complete` for tasks dispatched by the :class:`Node`, and so is `trace` with the Worker's stages added.
         Don't run this outside of a :class:`Node` just to ensure that no arbitrary inferences get prompted causing potential confusion in the LLM.'''
 
         #assert self.is_valid, "No valid endpoint provided, please update the endpoint using .update_endpoint() and then .reload_agent()"
 
-        _prompt = "\n### Instruct: \n".join([prompt])
-        await self._employ_worker(self, self.task_queue, uuid.uuid4())
-        self.task_queue.put(task)
-        # TODO
-        # if self._uses_inference_endpoint:
-        #     _r = self._post(path = "api/v1/generate", body = self._gen_body(_prompt))
+        if task is not None:
+            self._get_worker_pool().submit(task, block = False, task_id = task_id, trace = trace) # A pooled Worker picks it up, and the pool grows if they are all busy. Raises queue.Full when they are backed up
+        elif self._uses_inference_endpoint:
+            _plan = None
+            _generated = None # Prompt the plan was generated from, to drop it from the InferenceCache should the plan fail
+            if self._stream_inference:
+                _plan = None if bypass_cache else self._plans.get(prompt)
+                if _plan is None:
+                    _plan = await self.instruct_streaming(self._build_prompt(prompt).text, priority = priority) # Instructions run as they are generated, so the plan isn't cached
+                    self._prompts.record(prompt, self._plan_text(_plan))
+                    return _plan
+                self._prompts.record(prompt, self._plan_text(_plan)) # The history grows as if it had been generated
+            else:
+                _plan, _generated = await self._plan(prompt, bypass_cache = bypass_cache, priority = priority)
+            if _plan is not None:
+                _task_id = task_id or uuid.uuid4().hex
+                self._get_worker_pool().submit(_plan, block = False, task_id = _task_id, trace = trace)
+                self._plan_prompts[_task_id] = (prompt, _generated)
+            return _plan
+
+    async def plan(self, prompt: str, bypass_cache = False, priority: InferencePriority = None):
+        '''Turns a task prompt into the :class:`MultiInstruction` the Workers run. A task shaped like one planned before gets that plan
+        from the :class:`PlanCache` with its own URLs and quoted text filled in, and skips inference entirely.
+        Returns `None` when the model's answer holds no instructions.'''
+        _plan, _ = await self._plan(prompt, bypass_cache = bypass_cache, priority = priority)
+        return _plan
+
+    async def _plan(self, prompt: str, bypass_cache = False, priority: InferencePriority = None):
+        ''':meth:`plan`, also returning the prompt the plan was generated from, or `None` when it came from the :class:`PlanCache`'''
+        _replan = self._replan.pop(task_template(prompt)[0], False)
+        if not bypass_cache and not _replan:
+            _plan = self._plans.get(prompt)
+            if _plan is not None:
+                self._prompts.record(prompt, self._plan_text(_plan)) # The history grows as if it had been generated
+                return _plan, None
+        _start = time.perf_counter()
+        _text = self._build_prompt(prompt).text
+        _ok, _r = await self._generate(_text, bypass_cache = bypass_cache, priority = priority, refresh = _replan)
+        if not _ok:
+            return None, None
+        _instructions = InstructionStreamParser.parse(completion_text(_r))
+        if not _instructions:
+            return None, None
+        _plan = MultiInstruction(_instructions)
+        self._plans.put(prompt, _plan, inference_seconds = time.perf_counter() - _start)
+        self._prompts.record(prompt, self._plan_text(_plan))
+        return _plan, _text
+
+    async def _forget_plan(self, prompt: str, generated: str = None):
+        '''Drops a plan that failed from the :class:`PlanCache`, and the generation it came from from the :class:`InferenceCache`, so
+        the next task of its shape is planned afresh instead of getting the same plan back. When the plan itself came from the
+        PlanCache its generation isn't known, and the next one for the shape skips the InferenceCache instead'''
+        if self._plans.invalidate(prompt):
+            print_warning(f"{self.agent_name}: Plan failed, dropped it from the plan cache", category = "agent")
+        if generated is not None:
+            await self._inference_cache.adiscard(generated, self._gen_body(generated))
+        else:
+            self._replan[task_template(prompt)[0]] = True
+            while len(self._replan) > 1024:
+                self._replan.popitem(last = False)
+
+    def _build_prompt(self, prompt: str):
+        '''The full prompt for a task, see :class:`PromptBuilder`'''
+        _built = self._prompts.build(prompt)
+        log_debug("%s: Prompt of %d tokens, %d of them reused from the last one, %d to process%s", self.agent_name, _built.tokens, _built.reused_tokens, _built.processed_tokens, " (truncated to fit)" if _built.truncated else "", category = "agent")
+        return _built
+
+    @staticmethod
+    def _plan_text(plan: MultiInstruction):
+        '''A plan the way the model writes one, one action per line, for the prompt history'''
+        return "\n".join(instruction.task.name if instruction.action is None else f"{instruction.task.name} {instruction.action}" for instruction in plan.get_action_list())
+
+    async def _generate(self, prompt: str, bypass_cache = False, priority: InferencePriority = None, refresh = False):
+        '''Runs a full generate call, answering from the :class:`InferenceCache` when the same prompt and sampling config were seen before.
+        With `refresh` the cached answer is skipped but the new one replaces it'''
+        _body = self._gen_body(prompt)
+        _cached = None if refresh else await self._inference_cache.aget(prompt, _body, bypass = bypass_cache)
+        if _cached is not None:
+            return True, _cached
+
+        if self._use_node_scheduler:
+            _ok, _r = await self._scheduled_generate(prompt, _body, priority)
+        else:
+            _ok, _r = await self._request(HTTPMethod.POST, path = "api/v1/generate", body = _body)
+        if _ok:
+            await self._inference_cache.aput(prompt, _body, _r, bypass = bypass_cache)
+
+        return _ok, _r
+
+    async def _ask_node(self, type: str, data: dict):
+        '''Sends a request to the :class:`Node`'s :class:`InferenceScheduler` and waits for the `inference_result` answering it.
+        Returns the request_id it was sent with and the reply'''
+        _request_id = uuid.uuid4().hex
+        _future = asyncio.get_running_loop().create_future()
+        self._pending_inference[_request_id] = _future
+        try:
+            await self._send(type = type, target = "node", data = dict(data, request_id = _request_id))
+            return _request_id, await _future
+        finally:
+            self._pending_inference.pop(_request_id, None)
 
-        #     return _r
+    async def _scheduled_generate(self, prompt: str, body: dict, priority: InferencePriority = None):
+        '''Submits a generation to the :class:`Node`'s :class:`InferenceScheduler` and waits for the `inference_result`'''
+        _, _reply = await self._ask_node("inference_request", {"prompt": prompt, "body": body, "priority": None if priority is None else priority.value})
+
+        if not _reply['ok']:
+            print_warning(f"{self.agent_name}: Scheduled inference failed: {_reply['error']}")
+            return False, None
+        return True, _reply['result']
+
+    async def stream_tokens(self, prompt: str, priority: InferencePriority = None):
+        '''Async iterator over the tokens of a generation, yielded as the backend produces them.
+        With the :class:`Node`'s scheduler the stream waits for a slot like any other generation, and streams from the backend it was given'''
+        _path, _body = "api/extra/generate/stream", self._gen_body(prompt)
+        if not self._use_node_scheduler:
+            async for token in self._backends.stream(_path, _body):
+                yield token
+            return
+
+        _request_id, _reply = await self._ask_node("inference_reserve", {"prompt": prompt, "priority": None if priority is None else priority.value})
+        if not _reply['ok']:
+            raise InferenceError(f"No inference slot from the Node: {_reply['error']}")
+        _ok = False
+        try:
+            async for token in self._backends.stream(_path, _body, backend = self._backends.backend_for(_reply['result']['endpoint']), failover = False): # Failing over would take a slot the scheduler didn't give out
+                yield token
+            _ok = True
+        finally:
+            await self._send(type = "inference_release", target = "node", data = {"request_id": _request_id, "ok": _ok})
+
+    async def stream_instructions(self, prompt: str, priority: InferencePriority = None):
+        '''Async iterator over the :class:`SingleInstruction`'s of a generation, each yielded as soon as the model finishes writing it'''
+        _parser = InstructionStreamParser()
+        async for token in self.stream_tokens(prompt, priority = priority):
+            for instruction in _parser.feed(token):
+                yield instruction
+        for instruction in _parser.close():
+            yield instruction
+
+    async def instruct_streaming(self, prompt: str, priority: InferencePriority = None):
+        '''Streams a generation and hands each instruction to a :class:`Worker` the moment it is parsed, so the first action
+        starts while the model is still writing the rest. The instructions go through a queue of their own so a single
+        :class:`Worker` runs them in order on the same page. Returns the full list of instructions dispatched.'''
+        _queue = Queue()
+        _instructions = []
+        async for instruction in self.stream_instructions(prompt, priority = priority):
+            if not _instructions:
+                await self._employ_worker(self, _queue, uuid.uuid4(), max_pages = 1) # Only employ once there is something to do. One page keeps the instructions in order
+            _queue.put(instruction)
+            _instructions.append(instruction)
+        if _instructions:
+            _queue.put(Worker.STOP) # The stream's Worker exits once it has run everything
+
+        return MultiInstruction(_instructions)
 
     def update_endpoint(self, new_endpoint: str):
         '''Updates the :class:`Agent`'s endpoint with a new one
@@ -162,21 +469,42 @@ class Agent():
         '''Runs validity checks and updates configurations again to ensure the :class:`Agent` is up to date
         Typically only ran after updating something like the endpoint after :class:`Agent` initialization'''
 
-        self.is_valid = validate_endpoint(self._inference_endpoint)
+        self._backends.set_endpoints(self._inference_endpoint)
+        self._validate_backends()
+
+    @property
+    def is_valid(self):
+        '''Is at least one endpoint valid and reachable. If false, the endpoints may be incorrectly written or not open.
+        Kept up to date by the background health probes while the :class:`Agent` runs.'''
+        return self._backends.is_valid
+
+    def _validate_backends(self):
+        for backend in self._backends.backends:
+            backend.healthy = validate_endpoint(backend.endpoint)
 
     def on_worker_complete(self, worker: Worker):
         '''Should only be called as a callback function when a :class:`Worker` is complete with their given task'''
-        if worker not in self.workers: # If the worker the call was from is not an attached worker
+        if self.workers is None or worker not in self.workers: # If the worker the call was from is not an attached worker
             print("Task completion callback received from unknown Worker. Ignoring completion call.")
         else:
             print(f"Worker: {worker.worker_uuid} completed their task.")
 
-    async def _employ_worker(self, parent_agent, task_queue, uuid):
-        '''Initializes a new :class:`Worker` and attaches them to this object'''
+    def _get_screenshot_pipeline(self):
+        if self._screenshots is None:
+            self._screenshots = ScreenshotPipeline(preset = self._vision_preset)
+        return self._screenshots
+
+    def _get_worker_pool(self):
+        '''The :class:`WorkerPool` serving the Task Queue, created on first use inside the agent process'''
+        if self.workers is None:
+            self.workers = WorkerPool(self, self.task_queue, max_pages = self._max_pages_per_worker, engine = self._worker_engine, vision_preset = self._vision_preset, screenshots = self._get_screenshot_pipeline(), node_url = self.node_url, heartbeat_interval = self.heartbeat_interval, **self._worker_pool_config)
+        return self.workers
+
+    async def _employ_worker(self, parent_agent, task_queue, uuid, max_pages = None):
+        '''Initializes a dedicated :class:`Worker` on its own `task_queue`, outside of the pool. Put `Worker.STOP` on the queue to let it go'''
         print_substep(f"{self.agent_name}: Employing new Worker with UUID: {uuid}", style = "bright_blue")
 
-        worker = Worker(parent_agent = parent_agent, task_queue = task_queue, uid = uuid)
-        self.workers.append(worker)
+        worker = Worker(parent_agent = parent_agent, task_queue = task_queue, uid = uuid, engine = self._worker_engine, max_pages = max_pages or self._max_pages_per_worker, screenshots = self._get_screenshot_pipeline(), node_url = self.node_url)
 
         _p = threading.Thread(target = worker.sync_start, name = f"Thread-{worker.worker_name}")
         _p.start() # Start the new worker process
@@ -185,44 +513,46 @@ class Agent():
         print("Test process")
 
     def _gen_body(self, prompt: str):
-        if self._inference_config != None:
-            _new_config = self._inference_config
-            _new_config.update({"prompt:": prompt})
-
-            return _new_config
-        else:
-            return {"prompt": prompt}
+        '''The generate request for `prompt`: a copy of the inference config with the prompt set, the config itself stays as is'''
+        return dict(self._inference_config or {}, prompt = prompt)
 
-    def _request(self, method: HTTPMethod, path: str, body = None):
+    async def _request(self, method: HTTPMethod, path: str, body = None):
         try:
             if type(body) == dict:
                 if body != None:
                     _body = json.dumps(body)
                 else:
                     _body = None
-            elif type(body) == str:
+            elif type(body) == str or body == None:
                 _body = body
             else:
                 raise RuntimeError("(_post) body was not given a valid json string or dict or None")
 
             if method == HTTPMethod.POST:
-                self._post(path, body)
+                return await self._post(path, _body)
             elif method == HTTPMethod.GET:
-                self._get(path, body)
+                return await self._get(path, _body)
         except Exception as e:
             print_warning(e)
 
             return False, None
 
-    def _post(self, path: str, body = None):
-        _r = True, requests.post(parse.urljoin(self._inference_endpoint, path), data = body)
+    async def _post(self, path: str, body = None):
+        _r = True, await self._backends.post(path, body)
 
         return _r
 
-    def _get(self, path: str, body = None):
-        _r = True, requests.get(parse.urljoin(self._inference_endpoint, path), data = body)
+    async def _get(self, path: str, body = None):
+        _r = True, await self._backends.get(path, body)
 
         return _r
 
     def __str__(self):
-        return self.agent_name
\ No newline at end of file
+        return self.agent_name
+
+def run_agent(agent_task_queue: Queue = None, **kwargs):
+    '''Entry point of an agent process started by a :class:`Node`. The :class:`Agent` is built in its own process, so the Node
+    never waits on it and nothing but these arguments has to be pickled. Terminating the process unwinds it like an exit, so its
+    pools and sessions are closed and its queues give their semaphores back'''
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    Agent(agent_task_queue = agent_task_queue, **kwargs).sync_start()
\ No newline at end of file
@@ -0,0 +1,58 @@
+'''Pages per second each browser engine sustains on a local static site, with up to `max_pages` pages in flight.
+Each task is the GOTO + SCREENSHOT pair a :class:`Worker` runs for a typical instruction.
+Run from `src/`: `python -m benchmarks.engine_bench [tasks] [max_pages] [engine ...]`'''
+
+import sys
+import json
+import time
+import asyncio
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction
+
+from engines import get_engine
+from benchmarks.stubs import StaticSite
+
+async def _task(engine, url):
+    async with engine.page() as page:
+        await engine.run(page, SingleInstruction(WorkerTask.GOTO, url))
+        return await engine.run(page, SingleInstruction(WorkerTask.SCREENSHOT, None))
+
+async def bench_engine(name: str, site: StaticSite, tasks: int = 50, max_pages: int = 4):
+    _engine = get_engine(name, max_pages = max_pages)
+    _start = time.perf_counter()
+    await _engine.start()
+    _startup = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    try:
+        _shots = await asyncio.gather(*[_task(_engine, site.page_url(n)) for n in range(tasks)])
+    finally:
+        await _engine.stop()
+    _elapsed = time.perf_counter() - _start
+
+    return {
+        "engine": _engine.name, # May differ from `name` when Playwright fell back to Selenium
+        "tasks": tasks,
+        "max_pages": max_pages,
+        "startup_seconds": round(_startup, 3),
+        "seconds": round(_elapsed, 3),
+        "pages_per_second": round(tasks / _elapsed, 2),
+        "avg_screenshot_bytes": round(sum(len(s) for s in _shots) / len(_shots)) if _shots else 0
+    }
+
+async def run(tasks: int = 50, max_pages: int = 4, engines = ("playwright", "selenium")):
+    _results = {}
+    with StaticSite() as site:
+        for name in engines:
+            try:
+                _results[name] = await bench_engine(name, site, tasks, max_pages)
+            except Exception as e:
+                _results[name] = {"error": f"{type(e).__name__}: {e}"}
+    return _results
+
+if __name__ == "__main__":
+    _tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    _max_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    _engines = sys.argv[3:] or ("playwright", "selenium")
+    print(json.dumps(asyncio.run(run(_tasks, _max_pages, _engines)), indent = 4))
@@ -0,0 +1,66 @@
+'''Tasks per second through the durable SQLite queue against the in-memory `multiprocessing.Queue` it can replace.
+Each task is enqueued, dequeued and (for the durable queue) acked, in batches of `batch` tasks.
+Run from `src/`: `python -m benchmarks.queue_bench [tasks] [batch ...]`'''
+
+import os
+import sys
+import json
+import time
+import tempfile
+
+from multiprocessing import Queue
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+from utils.helpers.durable_queue import DurableQueue
+
+def sample_task(n: int):
+    return MultiInstruction([SingleInstruction(WorkerTask.GOTO, f"https://example.com/{n}"), SingleInstruction(WorkerTask.SCREENSHOT, None)])
+
+def bench_memory(tasks: int):
+    _queue = Queue()
+    _items = [sample_task(n) for n in range(tasks)]
+    _start = time.perf_counter()
+    for item in _items:
+        _queue.put(item)
+    _enqueued = time.perf_counter()
+    for _ in range(tasks):
+        _queue.get()
+    _done = time.perf_counter()
+    return {"enqueue_per_second": round(tasks / (_enqueued - _start)), "dequeue_per_second": round(tasks / (_done - _enqueued)), "round_trip_per_second": round(tasks / (_done - _start))}
+
+def bench_durable(tasks: int, batch: int, path: str):
+    _queue = DurableQueue(path, compact_every = 0)
+    _items = [sample_task(n) for n in range(tasks)]
+    _start = time.perf_counter()
+    for i in range(0, tasks, batch):
+        _queue.put_many(_items[i:i + batch])
+    _enqueued = time.perf_counter()
+    _taken = 0
+    while _taken < tasks:
+        _leases = _queue.lease(batch)
+        _queue.ack([lease.id for lease in _leases])
+        _taken += len(_leases)
+    _done = time.perf_counter()
+    _queue.compact()
+    _compacted = time.perf_counter()
+    _queue.close()
+    return {
+        "batch": batch,
+        "enqueue_per_second": round(tasks / (_enqueued - _start)),
+        "dequeue_ack_per_second": round(tasks / (_done - _enqueued)),
+        "round_trip_per_second": round(tasks / (_done - _start)),
+        "compaction_seconds": round(_compacted - _done, 4)
+    }
+
+def run(tasks: int = 5000, batches = (1, 10, 100)):
+    _results = {"tasks": tasks, "multiprocessing.Queue": bench_memory(tasks)}
+    with tempfile.TemporaryDirectory() as directory:
+        for batch in batches:
+            _results[f"durable batch={batch}"] = bench_durable(tasks, batch, os.path.join(directory, f"queue_{batch}.db"))
+    return _results
+
+if __name__ == "__main__":
+    _tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    _batches = [int(b) for b in sys.argv[2:]] or (1, 10, 100)
+    print(json.dumps(run(_tasks, _batches), indent = 4))
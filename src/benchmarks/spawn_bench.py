@@ -0,0 +1,79 @@
+'''Import time of the main modules in a fresh interpreter, and how long a new process takes until it runs with the agent's
+modules loaded: started cold with `fork` or `spawn`, or handed to a template of the :class:`WarmSpawner`.
+Run from `src/`: `python -m benchmarks.spawn_bench [rounds] [module ...]`'''
+
+import sys
+import json
+import time
+import statistics
+import subprocess
+import multiprocessing
+
+from utils.helpers.spawner import WarmSpawner
+
+AGENT_MODULES = ["agent", "engines.fake_engine"]
+
+def import_seconds(module: str, rounds = 3):
+    '''Best of `rounds` fresh interpreters importing `module`'''
+    _code = f"import time; _t = time.perf_counter(); import {module}; print(time.perf_counter() - _t)"
+    _times = []
+    for _ in range(rounds):
+        _r = subprocess.run([sys.executable, "-c", _code], capture_output = True, text = True)
+        if _r.returncode != 0:
+            return {"error": _r.stderr.strip().splitlines()[-1] if _r.stderr.strip() else f"exit code {_r.returncode}"}
+        _times.append(float(_r.stdout.strip().splitlines()[-1]))
+    return {"seconds": round(min(_times), 4)}
+
+def _import_and_report(queue, modules):
+    for module in modules:
+        __import__(module)
+    queue.put(True)
+
+def _summary(samples: list):
+    return {"median_ms": round(statistics.median(samples) * 1000, 2), "min_ms": round(min(samples) * 1000, 2), "max_ms": round(max(samples) * 1000, 2)}
+
+def bench_cold(method: str, rounds: int, modules: list):
+    _context = multiprocessing.get_context(method)
+    _queue = _context.Queue()
+    _samples = []
+    for _ in range(rounds):
+        _start = time.perf_counter()
+        _process = _context.Process(target = _import_and_report, args = (_queue, modules))
+        _process.start()
+        _queue.get(timeout = 60)
+        _samples.append(time.perf_counter() - _start)
+        _process.join()
+    return _summary(_samples)
+
+def bench_warm(rounds: int, modules: list):
+    _queue = multiprocessing.get_context("spawn").Queue()
+    _spawner = WarmSpawner(modules, warm = 1, inherited = (_queue,), name = "BenchTemplate").start()
+    _samples = []
+    try:
+        for _ in range(rounds):
+            while not _spawner.stats()['ready']: # Measure the hand over, not the template warming up
+                time.sleep(0.01)
+            _start = time.perf_counter()
+            _spawned = _spawner.spawn(_import_and_report, modules)
+            _queue.get(timeout = 60)
+            _samples.append(time.perf_counter() - _start)
+            _spawned.join()
+    finally:
+        _spawner.stop()
+    return dict(_summary(_samples), start_method = _spawner.stats()['start_method'])
+
+def run(rounds = 5, modules = AGENT_MODULES):
+    _results = {"imports": {module: import_seconds(module) for module in ["agent", "worker", "node", "utils.helpers.wire_protocol", *modules[1:]]}}
+    _spawn = {}
+    for method in multiprocessing.get_all_start_methods():
+        if method == "forkserver":
+            continue # Used by the warm spawner below
+        _spawn[f"cold_{method}"] = bench_cold(method, rounds, modules)
+    _spawn['warm'] = bench_warm(rounds, modules)
+    _results['time_to_running'] = _spawn
+    return _results
+
+if __name__ == "__main__":
+    _rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    _modules = sys.argv[2:] or AGENT_MODULES
+    print(json.dumps(run(_rounds, _modules), indent = 4))
@@ -0,0 +1,182 @@
+'''Local stand-ins for the services the pipeline talks to, so it can be exercised without a model or the internet.
+Run from `src/`: `python -m benchmarks.stubs [port ...]` serves a stub KoboldCpp on each `port` (default 5001),
+which is enough to exercise a :class:`BackendPool` with several backends.'''
+
+import sys
+import json
+import asyncio
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def plan_completion(url: str):
+    '''A completion planning a visit to `url` and a screenshot of it. Point it at a :class:`StaticSite` page to stay offline'''
+    return f"1. GOTO {url}\n2. SCREENSHOT\n"
+
+DEFAULT_COMPLETION = plan_completion("http://localhost/")
+
+class StubKoboldServer():
+    '''A minimal KoboldCpp stand-in speaking just enough HTTP/1.1 (with keep-alive) for the inference clients.
+    Serves `GET api/v1/model`, `POST api/v1/generate` and the Server-Sent Events endpoint `POST api/extra/generate/stream`.
+    `latency` is the delay before the first token and `token_rate` the tokens generated per second after that.'''
+
+    def __init__(self, host = "localhost", port = 5001, completion = DEFAULT_COMPLETION, latency = 0.0, token_rate = 0.0):
+        self.host = host
+        self.port = port
+        self.completion = completion
+        self.latency = latency
+        self.token_rate = token_rate # 0 means every token is available immediately
+        self.requests_served = 0
+        self._server = None
+
+    @property
+    def endpoint(self):
+        return f"http://{self.host}:{self.port}"
+
+    def tokens(self):
+        '''Splits the completion into word-sized tokens, keeping whitespace attached like a real tokenizer would'''
+        _tokens = []
+        _current = ""
+        for ch in self.completion:
+            if ch.isspace() and _current and not _current[-1].isspace():
+                _tokens.append(_current)
+                _current = ""
+            _current += ch
+        if _current:
+            _tokens.append(_current)
+        return _tokens
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                _request_line = await reader.readline()
+                if not _request_line:
+                    break
+                _method, _path, _ = _request_line.decode("latin-1").split(" ", 2)
+                _headers = {}
+                while True:
+                    _line = (await reader.readline()).decode("latin-1").strip()
+                    if not _line:
+                        break
+                    _key, _, _value = _line.partition(":")
+                    _headers[_key.strip().lower()] = _value.strip()
+                _body = await reader.readexactly(int(_headers.get("content-length", 0)))
+                self.requests_served += 1
+
+                _path = _path.lstrip("/")
+                if _method == "POST" and _path == "api/extra/generate/stream":
+                    await self._stream(writer)
+                    break # The SSE response is delimited by closing the connection
+                elif _method == "POST" and _path == "api/v1/generate":
+                    await self._delay_all()
+                    self._respond(writer, 200, {"results": [{"text": self.completion}]})
+                elif _method == "GET" and _path == "api/v1/model":
+                    self._respond(writer, 200, {"result": "stub/phi-2"})
+                else:
+                    self._respond(writer, 404, {"detail": f"{_method} /{_path} not found"})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _delay_all(self):
+        _delay = self.latency
+        if self.token_rate:
+            _delay += len(self.tokens()) / self.token_rate
+        if _delay:
+            await asyncio.sleep(_delay)
+
+    def _respond(self, writer, status, payload):
+        _body = json.dumps(payload).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\nContent-Type: application/json\r\nContent-Length: {len(_body)}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1") + _body)
+
+    async def _stream(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for token in self.tokens():
+            if self.token_rate:
+                await asyncio.sleep(1 / self.token_rate)
+            writer.write(f"event: message\ndata: {json.dumps({'token': token})}\n\n".encode("utf-8"))
+            await writer.drain()
+
+class StaticSite():
+    '''Serves `pages` generated HTML pages (`/page/<n>`, with a text input and a button on each) from a background thread,
+    so browser engines can be benchmarked without the internet.'''
+
+    def __init__(self, host = "localhost", port = 0, pages = 20, paragraphs = 30):
+        self.host = host
+        self.pages = pages
+        self.paragraphs = paragraphs
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1] # Port 0 picks a free one
+        self._thread = None
+
+    def page_url(self, n: int):
+        return f"http://{self.host}:{self.port}/page/{n % self.pages}"
+
+    def render(self, n: int):
+        _paragraphs = "".join(f"<p>Page {n}, paragraph {i}. The quick brown fox jumps over the lazy dog.</p>" for i in range(self.paragraphs))
+        return (f"<!DOCTYPE html><html><head><title>Page {n}</title></head><body><h1>Page {n}</h1>"
+                f"<input id=\"q\" type=\"text\"><button id=\"go\">Go</button>{_paragraphs}</body></html>").encode("utf-8")
+
+    def _handler(self):
+        _site = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                _, _, _n = self.path.rpartition("/")
+                _body = _site.render(int(_n) if _n.isdigit() else 0)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(_body)))
+                self.end_headers()
+                self.wfile.write(_body)
+
+            def log_message(self, *args):
+                pass
+
+        return _Handler
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, name = "Thread-StaticSite", daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+async def serve_forever(ports: list):
+    _servers = [await StubKoboldServer(port = port).start() for port in ports]
+    for server in _servers:
+        print(f"Stub KoboldCpp serving on {server.endpoint}")
+    await asyncio.Future()
+
+if __name__ == "__main__":
+    asyncio.run(serve_forever([int(port) for port in sys.argv[1:]] or [5001]))
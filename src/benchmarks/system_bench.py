@@ -0,0 +1,186 @@
+'''End to end throughput of a :class:`Node` with its :class:`Agent`'s and :class:`Worker`'s, without a model, a browser or the internet.
+The Node runs in this process with tracing on. Its agents inference against a stub KoboldCpp (configurable latency and token rate)
+and their Workers drive the fake browser engine against a local static site.
+Reports tasks/sec, per-stage latency percentiles, messages/sec through `Node.ws_main` and the RSS of every process as JSON,
+so runs can be compared between commits. Tasks the Node turns away with `queue_full` are sent again after its `retry_after`.
+Run from `src/`: `python -m benchmarks.system_bench --tasks 200 --agents 2 --workers 2 [--output run.json]`'''
+
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import threading
+import subprocess
+import multiprocessing
+
+import jsonpickle
+import psutil
+import websockets
+
+from node import Node
+
+from utils.helpers.constants import NodeType, WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+from utils.helpers.wire_protocol import decode_message, encode_message, negotiate
+
+from benchmarks.stubs import StaticSite, StubKoboldServer, plan_completion
+
+CLIENT_NAME = "system_bench"
+
+def parse_args(argv = None):
+    _parser = argparse.ArgumentParser(description = "Benchmarks a Node with its Agents and Workers against local stubs")
+    _parser.add_argument("--tasks", type = int, default = 200)
+    _parser.add_argument("--agents", type = int, default = 2)
+    _parser.add_argument("--workers", type = int, default = 2, help = "Max Workers per Agent")
+    _parser.add_argument("--pages", type = int, default = 4, help = "Pages per Worker")
+    _parser.add_argument("--prompt-ratio", type = float, default = 0.25, help = "Share of tasks sent as prompts, which go through inference instead of straight to a Worker")
+    _parser.add_argument("--latency", type = float, default = 0.2, help = "Stub KoboldCpp seconds before the first token")
+    _parser.add_argument("--token-rate", type = float, default = 200.0, help = "Stub KoboldCpp tokens per second")
+    _parser.add_argument("--goto-delay", type = float, default = 0.05)
+    _parser.add_argument("--screenshot-delay", type = float, default = 0.02)
+    _parser.add_argument("--max-queued-tasks", type = int, default = 10000, help = "Tasks the Node holds before it answers with queue_full")
+    _parser.add_argument("--timeout", type = float, default = 300, help = "Seconds to wait for every task to finish")
+    _parser.add_argument("--output", default = None, help = "Also write the JSON report to this file")
+    return _parser.parse_args(argv)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def serve_in_thread(stub: StubKoboldServer):
+    '''Runs the stub on an event loop of its own, so blocking endpoint checks in this process can't stall it'''
+    _ready = threading.Event()
+
+    def _run():
+        _loop = asyncio.new_event_loop()
+        _loop.run_until_complete(stub.start())
+        _ready.set()
+        _loop.run_forever()
+
+    threading.Thread(target = _run, name = "Thread-StubKobold", daemon = True).start()
+    _ready.wait()
+    return stub
+
+def commit_hash():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, timeout = 5).stdout.strip() or None
+    except Exception:
+        return None
+
+def process_rss():
+    '''Resident memory in MB of this process (the Node) and every agent process it started'''
+    _rss = {"node": round(psutil.Process().memory_info().rss / (1024.0 ** 2), 1)}
+    for child in multiprocessing.active_children():
+        try:
+            _rss[child.name] = round(psutil.Process(child.pid).memory_info().rss / (1024.0 ** 2), 1)
+        except psutil.Error:
+            pass
+    return _rss
+
+def make_tasks(site: StaticSite, count: int, prompt_ratio: float):
+    _prompts = int(count * prompt_ratio)
+    _tasks = [f"Take a screenshot of {site.page_url(n)}" for n in range(_prompts)]
+    _tasks += [MultiInstruction([SingleInstruction(WorkerTask.GOTO, site.page_url(n)), SingleInstruction(WorkerTask.SCREENSHOT, None)]) for n in range(_prompts, count)]
+    return _tasks
+
+async def wait_for(condition, timeout: float, interval = 0.1):
+    _deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > _deadline:
+            raise TimeoutError("Timed out waiting on the benchmark")
+        await asyncio.sleep(interval)
+
+async def resend_rejected(ws, protocol, tasks: list, resent: list):
+    '''Sends the tasks the Node turned away again once their `retry_after` passed, like a well behaved producer'''
+    async for raw in ws:
+        msg = decode_message(raw)
+        if msg['type'] == "queue_full" and msg['data'].get('ref') is not None:
+            await asyncio.sleep(msg['data']['retry_after'])
+            resent.append(msg['data']['ref'])
+            await send_task(ws, protocol, tasks, msg['data']['ref'])
+
+async def send_task(ws, protocol, tasks: list, ref: int):
+    await ws.send(encode_message(type = "node_add_queue_item", origin = CLIENT_NAME, target = "node", data = {"item": jsonpickle.encode(tasks[ref]), "ref": ref}, protocol = protocol))
+
+async def run(args):
+    os.environ.update({"SOAP_FAKE_GOTO_DELAY": str(args.goto_delay), "SOAP_FAKE_SCREENSHOT_DELAY": str(args.screenshot_delay), "SOAP_FAKE_FETCH": "1"})
+    _site = StaticSite().start()
+    _stub = serve_in_thread(StubKoboldServer(port = free_port(), completion = plan_completion(_site.page_url(0)), latency = args.latency, token_rate = args.token_rate)) # Plans visit the local site
+    _node = Node(
+        ntype = NodeType.CLIENT,
+        max_agents = args.agents,
+        inference_endpoint = _stub.endpoint,
+        max_inference_in_flight = args.agents,
+        worker_engine = "fake",
+        port = free_port(),
+        tracing = True,
+        max_queued_tasks = args.max_queued_tasks,
+        agent_kwargs = {"min_workers": 1, "max_workers": args.workers, "max_pages_per_worker": args.pages, "vision_preset": "full"}
+    )
+    _serving = asyncio.get_running_loop().create_task(_node.serve_and_listen())
+    try:
+        _connecting = websockets.connect(_node.url, ping_interval = None, open_timeout = 2).__aiter__() # Held on to, the connection closes with it
+        ws = await _connecting.__anext__() # Retried until the Node is serving
+        _protocol = await negotiate(ws, CLIENT_NAME, role = "script")
+
+        _start = time.perf_counter()
+        for _ in range(args.agents):
+            await _node.attach_agent(uses_inference_endpoint = True, inference_endpoint = _stub.endpoint, uid = uuid.uuid4())
+        await wait_for(lambda: len(_node.dispatcher.stats()['agents']) >= args.agents, args.timeout)
+        _startup = time.perf_counter() - _start
+
+        _tasks = make_tasks(_site, args.tasks, args.prompt_ratio)
+        _messages = _node.messages_received
+        _resent = []
+        _receiving = asyncio.get_running_loop().create_task(resend_rejected(ws, _protocol, _tasks, _resent))
+        _start = time.perf_counter()
+        for ref in range(len(_tasks)):
+            await send_task(ws, _protocol, _tasks, ref)
+        _counters = _node.dispatcher.counters
+        await wait_for(lambda: _counters['completed'] + _counters['failed'] >= args.tasks, args.timeout)
+        _elapsed = time.perf_counter() - _start
+        _receiving.cancel()
+        _messages = _node.messages_received - _messages
+
+        _metrics = _node.metrics.stats()
+        await ws.close()
+        return {
+            "commit": commit_hash(),
+            "timestamp": time.time(),
+            "config": vars(args),
+            "startup_seconds": round(_startup, 3),
+            "seconds": round(_elapsed, 3),
+            "completed": _counters['completed'],
+            "failed": _counters['failed'],
+            "tasks_per_second": round(args.tasks / _elapsed, 2),
+            "ws_messages": _messages,
+            "ws_messages_per_second": round(_messages / _elapsed, 1),
+            "tasks_resent": len(_resent),
+            "backpressure": _node.backpressure.stats(),
+            "stages": _metrics['stages'],
+            "inference": _node.inference_scheduler.stats()['wait_seconds'],
+            "rss_mb": process_rss()
+        }
+    finally:
+        for child in multiprocessing.active_children():
+            child.terminate() # Agents unwind on SIGTERM
+            child.join(10)
+        _node.spawner.stop()
+        _node.agent_task_queue.close()
+        _node.agent_task_queue.join_thread()
+        _serving.cancel()
+        await asyncio.gather(_serving, return_exceptions = True)
+        await _node.inference_scheduler.close()
+        _site.stop()
+
+if __name__ == "__main__":
+    _args = parse_args()
+    _report = asyncio.run(run(_args))
+    print(json.dumps(_report, indent = 4))
+    if _args.output:
+        with open(_args.output, "w") as f:
+            json.dump(_report, f, indent = 4)
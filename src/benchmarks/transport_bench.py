@@ -0,0 +1,114 @@
+'''Messages/sec and round trip latency between two processes on one machine, over the loopback WebSocket the Agents and
+Workers used to talk to the Node through, and over the local transport (Unix domain socket, large frames in shared memory).
+A child process echoes every frame back. Small frames are a binary `dispatch_task`, large ones carry a screenshot sized payload.
+Run from `src/`: `python -m benchmarks.transport_bench [messages] [large_kib]`'''
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import statistics
+import multiprocessing
+
+import websockets
+
+from utils.helpers import local_transport
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+from utils.helpers.wire_protocol import PROTOCOL_BINARY, decode_message, encode_message
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def small_frame():
+    _task = MultiInstruction([SingleInstruction(WorkerTask.GOTO, "https://google.com"), SingleInstruction(WorkerTask.SCREENSHOT, None)])
+    return encode_message("dispatch_task", "node", "Agent-5f0c0e7d6f7f4b1f9d6d0a6a9d9f2c11", {"task_id": "0b9e3d4c2a1f4e5d8c7b6a5f4e3d2c1b", "item": _task}, protocol = PROTOCOL_BINARY)
+
+def large_frame(kib: int):
+    return encode_message("worker_complete", "Agent-5f0c0e7d6f7f4b1f9d6d0a6a9d9f2c11_Worker-0", "node", {"result": "success", "screenshot": bytes(kib * 1024)}, protocol = PROTOCOL_BINARY)
+
+async def _echo(ws):
+    async for message in ws:
+        await ws.send(message)
+
+async def _serve(port: int, ready):
+    async with websockets.serve(_echo, "localhost", port, max_size = None), local_transport.serve(_echo, port):
+        ready.set()
+        await asyncio.Future()
+
+def _echo_server(port: int, ready):
+    asyncio.run(_serve(port, ready))
+
+async def _connect(url: str, local: bool):
+    if local:
+        return await local_transport.connect(url)
+    return await websockets.connect(url, max_size = None, ping_interval = None)
+
+async def round_trips(ws, frame, count: int):
+    '''One frame in flight at a time'''
+    _samples = []
+    for _ in range(count):
+        _start = time.perf_counter()
+        await ws.send(frame)
+        decode_message(await ws.recv())
+        _samples.append(time.perf_counter() - _start)
+    return {"p50_us": round(statistics.median(_samples) * 1e6, 1), "p99_us": round(sorted(_samples)[int(len(_samples) * 0.99) - 1] * 1e6, 1)}
+
+async def throughput(ws, frame, count: int, window = 64):
+    '''Up to `window` frames in flight, as when the Node streams tasks to a busy agent. Returns echoed messages per second'''
+    _start = time.perf_counter()
+    _sent = 0
+    for _ in range(min(window, count)):
+        await ws.send(frame)
+        _sent += 1
+    for _ in range(count):
+        decode_message(await ws.recv())
+        if _sent < count:
+            await ws.send(frame)
+            _sent += 1
+    return round(count / (time.perf_counter() - _start), 1)
+
+async def bench(url: str, local: bool, messages: int, large_kib: int):
+    _ws = await _connect(url, local)
+    try:
+        _small, _large = small_frame(), large_frame(large_kib)
+        await round_trips(_ws, _small, 100) # Warm up
+        _large_count = max(10, messages // 100)
+        return {
+            "small_bytes": len(_small),
+            "small_msgs_per_second": await throughput(_ws, _small, messages),
+            "small_round_trip": await round_trips(_ws, _small, min(messages, 2000)),
+            "large_bytes": len(_large),
+            "large_msgs_per_second": await throughput(_ws, _large, _large_count, window = 4),
+            "large_round_trip": await round_trips(_ws, _large, _large_count)
+        }
+    finally:
+        await _ws.close()
+
+def run(messages = 20000, large_kib = 2048):
+    _port = free_port()
+    _context = multiprocessing.get_context("spawn")
+    _ready = _context.Event()
+    _server = _context.Process(target = _echo_server, args = (_port, _ready), daemon = True)
+    _server.start()
+    try:
+        _ready.wait(30)
+        _url = f"ws://localhost:{_port}"
+        return {
+            "websocket": asyncio.run(bench(_url, False, messages, large_kib)),
+            "local": asyncio.run(bench(_url, True, messages, large_kib))
+        }
+    finally:
+        _server.terminate()
+        _server.join()
+        if os.path.exists(local_transport.socket_path(_port)): # Terminated before it could remove it
+            os.unlink(local_transport.socket_path(_port))
+
+if __name__ == "__main__":
+    _messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    _large_kib = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    print(json.dumps(run(_messages, _large_kib), indent = 4))
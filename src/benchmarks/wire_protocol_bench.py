@@ -0,0 +1,67 @@
+'''Micro-benchmark of the JSON + `jsonpickle` message path against the binary envelope.
+Run from `src/`: `python -m benchmarks.wire_protocol_bench [iterations]`'''
+
+import sys
+import json
+import timeit
+import jsonpickle
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+from utils.helpers.wire_protocol import PROTOCOL_BINARY, PROTOCOL_JSON, encode_message, decode_message, unpack_object
+
+AGENT_NAME = "Agent-5f0c0e7d6f7f4b1f9d6d0a6a9d9f2c11"
+WORKER_NAME = AGENT_NAME + "_Worker-0b9e3d4c2a1f4e5d8c7b6a5f4e3d2c1b"
+
+def sample_messages():
+    '''A representative mix of the messages that cross the Node on every task'''
+    _task = MultiInstruction([SingleInstruction(WorkerTask.GOTO, "https://google.com"), SingleInstruction(WorkerTask.SCREENSHOT, None)])
+    return [
+        ("agent_ready", AGENT_NAME, "node", {}),
+        ("agent_dequeue", "node", AGENT_NAME, {}),
+        ("function_invoke", "node", AGENT_NAME, {"function_to_invoke": "_put_queue", "params": {"item": _task}}),
+        ("worker_complete", WORKER_NAME, AGENT_NAME, {"result": "success", "task": _task})
+    ]
+
+def json_encode(type, origin, target, data):
+    # The path used before the binary envelope: objects are jsonpickled, then the whole message is json.dumps'd
+    return encode_message(type, origin, target, data, protocol = PROTOCOL_JSON)
+
+def json_decode(raw):
+    _msg = json.loads(raw)
+    _params = _msg['data'].get('params', {})
+    if "item" in _params:
+        _params['item'] = jsonpickle.decode(_params['item'])
+    if "task" in _msg['data']:
+        _msg['data']['task'] = jsonpickle.decode(_msg['data']['task'])
+    return _msg
+
+def binary_encode(type, origin, target, data):
+    return encode_message(type, origin, target, data, protocol = PROTOCOL_BINARY)
+
+def binary_decode(raw):
+    _msg = decode_message(raw)
+    _params = _msg['data'].get('params', {})
+    if "item" in _params:
+        _params['item'] = unpack_object(_params['item'])
+    return _msg
+
+def run(iterations: int = 20000):
+    _messages = sample_messages()
+    _results = {}
+    for name, encode, decode in [("json+jsonpickle", json_encode, json_decode), ("binary/1", binary_encode, binary_decode)]:
+        _frames = [encode(*m) for m in _messages]
+        _encode_s = timeit.timeit(lambda: [encode(*m) for m in _messages], number = iterations)
+        _decode_s = timeit.timeit(lambda: [decode(f) for f in _frames], number = iterations)
+        _count = iterations * len(_messages)
+        _results[name] = {
+            "encode_us_per_msg": round(_encode_s / _count * 1e6, 3),
+            "decode_us_per_msg": round(_decode_s / _count * 1e6, 3),
+            "bytes_per_msg": round(sum(len(f) for f in _frames) / len(_frames), 1)
+        }
+
+    return _results
+
+if __name__ == "__main__":
+    _iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(json.dumps(run(_iterations), indent = 4))
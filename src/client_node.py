@@ -1,5 +1,6 @@
+import os
 import asyncio
-import time
+import argparse
 import websockets
 import jsonpickle
 import uuid
@@ -9,25 +10,48 @@ from threading import Thread
 
 from node import Node
 
-from utils.helpers.constants import NodeType
+from utils.helpers.constants import NodeType, DEFAULT_NODE_HOST, DEFAULT_NODE_PORT, node_url
 from utils.helpers.all_helpers import create_ws_message
 
 from utils.console import *
 
-async def main():
+def parse_args():
+    _parser = argparse.ArgumentParser(description = "Starts a client Node with its Agents. Several can share a machine on different ports")
+    _parser.add_argument("--host", default = DEFAULT_NODE_HOST, help = "Interface the Node serves its Agents and Workers on")
+    _parser.add_argument("--port", type = int, default = DEFAULT_NODE_PORT)
+    _parser.add_argument("--join", default = None, metavar = "HOST_URL", help = "Host node to join, e.g. ws://localhost:5100. See cluster_host.py")
+    _parser.add_argument("--max-agents", type = int, default = 2)
+    _parser.add_argument("--durable-queue", default = None, metavar = "PATH", help = "SQLite file to keep the Node's queued and in-flight tasks in, so they survive a restart")
+    _parser.add_argument("--trace", action = "store_true", help = "Time every task through queue wait, inference, browser actions and websocket hops")
+    _parser.add_argument("--metrics-port", type = int, default = None, help = "Serve the per-stage latency percentiles at http://localhost:<port>/metrics (Prometheus) and /metrics.json")
+    _parser.add_argument("--heartbeat-deadline", type = float, default = 30, help = "Seconds an Agent may go without a message before its tasks are given to the others")
+    _parser.add_argument("--max-queued-tasks", type = int, default = 10000, help = "Tasks the Node holds before producers are told to retry later with queue_full")
+    _parser.add_argument("--log-level", default = None, choices = ["DEBUG", "INFO", "WARNING", "ERROR"], help = "DEBUG also logs every websocket message and worker instruction, rate limited")
+    _parser.add_argument("--log-json", default = None, metavar = "PATH", help = "Also write every log record to this JSON-lines file")
+    return _parser.parse_args()
+
+async def main(args):
+    # Through the environment so the Agent processes log the same way
+    if args.log_level:
+        os.environ['SOAP_LOG_LEVEL'] = args.log_level
+    if args.log_json:
+        os.environ['SOAP_LOG_JSON'] = args.log_json
+    configure_logging()
+    _url = node_url(args.host, args.port)
+
     # Listener
-    main_proc = Process(target = sync_localhost, args = (listen_localhost, True), name = "Process-NODE")
+    main_proc = Process(target = sync_localhost, args = (listen_localhost, True, _url), name = "Process-NODE")
     main_proc.start()
 
     # Keep alive thread
-    ka_thread = Process(target = sync_keep_alive, args = (keep_alive, True), name = "Thread-KeepAlive")
+    ka_thread = Process(target = sync_keep_alive, args = (keep_alive, True, _url), name = "Thread-KeepAlive")
     ka_thread.start()
 
     # Main process start node
-    await start_node()
+    await start_node(args)
 
-async def start_node():
-    node = Node(ntype = NodeType.CLIENT, max_agents = 2)
+async def start_node(args):
+    node = Node(ntype = NodeType.CLIENT, max_agents = args.max_agents, host = args.host, port = args.port, host_url = args.join, durable_queue = args.durable_queue, tracing = args.trace, metrics_port = args.metrics_port, heartbeat_deadline = args.heartbeat_deadline, max_queued_tasks = args.max_queued_tasks)
     node.set_metrics_config()
     await node.serve_and_listen()
     #agent = Agent(uses_inference_endpoint = True, inference_endpoint = "http://localhost:5001/")
@@ -39,38 +63,41 @@ async def start_node():
 async def send_ws(ws, message):
     await ws.send(message)
 
-def sync_localhost(awaitable, new_loop):
+def sync_localhost(awaitable, new_loop, url = node_url()):
     if new_loop:
         loop = asyncio.get_event_loop()
         asyncio.set_event_loop(loop)
-        loop.run_until_complete(listen_localhost())
+        loop.run_until_complete(listen_localhost(url))
         loop.close()
     else:
-        asyncio.run_coroutine_threadsafe(awaitable(), asyncio.get_running_loop())
+        asyncio.run_coroutine_threadsafe(awaitable(url), asyncio.get_running_loop())
 
-def sync_keep_alive(awaitable, new_loop):
+def sync_keep_alive(awaitable, new_loop, url = node_url()):
     if new_loop:
         loop = asyncio.get_event_loop()
         asyncio.set_event_loop(loop)
-        loop.run_until_complete(keep_alive())
+        loop.run_until_complete(keep_alive(url))
         loop.close()
     else:
-        asyncio.run_coroutine_threadsafe(awaitable(), asyncio.get_running_loop())
-
-async def keep_alive():
-    print_substep("SYSTEM: Starting Keep Alive thread on ws://localhost:5002", style = "bright_blue")
-    time.sleep(2) # Allow time for WebSocket to spin up
-    async with websockets.connect("ws://localhost:5002") as ws:
-        while True:
-            await ws.send(create_ws_message(type = "ping", origin = "entry_script", target = "any_agent"))
-            _r = await ws.recv()
-            #print(_r)
-            time.sleep(10)
-
-async def listen_localhost():
-    print_substep("SYSTEM: Starting listening process on ws://localhost:5002", style = "bright_blue")
-    time.sleep(2) # Allow time for WebSocket to spin up
-    async with websockets.connect("ws://localhost:5002", ping_timeout = None) as ws:
+        asyncio.run_coroutine_threadsafe(awaitable(url), asyncio.get_running_loop())
+
+async def keep_alive(url = node_url(), interval = 10):
+    print_substep(f"SYSTEM: Starting Keep Alive thread on {url}", style = "bright_blue")
+    async for ws in websockets.connect(url): # Retries until the WebSocket is up, and reconnects when it drops
+        try:
+            await ws.send(create_ws_message(type = "register", origin = "keep_alive", target = "node", data = {"role": "script"}))
+            while True:
+                await ws.send(create_ws_message(type = "heartbeat", origin = "keep_alive", target = "node"))
+                await asyncio.sleep(interval)
+        except websockets.ConnectionClosed:
+            continue
+
+async def listen_localhost(url = node_url()):
+    print_substep(f"SYSTEM: Starting listening process on {url}", style = "bright_blue")
+    _connecting = websockets.connect(url, ping_timeout = None).__aiter__() # Retries until the WebSocket is up. Held on to, the connection closes with it
+    ws = await _connecting.__anext__()
+    async with ws:
+        await ws.send(create_ws_message(type = "register", origin = "entry_script", target = "node", data = {"role": "script"}))
         await agent_deployer(ws)
         while True:
             # Receive a message from the server
@@ -82,12 +109,11 @@ async def listen_localhost():
 async def agent_deployer(ws): # TODO: Notify the agent when a worker is complete to receive next task. Node-agent-worker flow is success
     '''A temporary ws connection to deploy the initial :class:`Agent`'s and attach them to the node'''
     print_substep("SYSTEM: Starting Agent Deployer", style = "bright_blue")
-    time.sleep(2) # Allow time for WebSocket to spin up
     await ws.send(create_ws_message(type = "function_invoke", origin = "entry_script", target = "node", data = {"function_to_invoke": "attach_agent", "params": {"uses_inference_endpoint": True, "inference_endpoint": "http://localhost:5001", "uid": jsonpickle.encode(uuid.uuid4())}}))
     #await ws.send(create_ws_message(type = "function_invoke", origin = "entry_script", target = "node", data = {"function_to_invoke": "attach_agent", "params": {"uses_inference_endpoint": True, "inference_endpoint": "http://localhost:5001", "uid": jsonpickle.encode(uuid.uuid4())}}))
     print_substep("SYSTEM: Agent Deployer finished", style = "green1")
 
 if __name__ == "__main__":
     # Run listener
-    asyncio.get_event_loop().run_until_complete(main())
+    asyncio.get_event_loop().run_until_complete(main(parse_args()))
     asyncio.get_event_loop().run_forever()
\ No newline at end of file
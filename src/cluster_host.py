@@ -0,0 +1,28 @@
+import asyncio
+import argparse
+
+from node import Node
+
+from utils.helpers.constants import NodeType, DEFAULT_NODE_HOST, DEFAULT_HOST_PORT
+
+from utils.console import *
+
+# Starts the host Node of a cluster. Client nodes join it with `python client_node.py --port <port> --join ws://<host>:<host port>`,
+# so scaling out is a matter of starting more client nodes, on this machine or others.
+# Tasks sent to the host as `node_add_queue_item` are placed on the client nodes with the most free agent slots and resources.
+
+def parse_args():
+    _parser = argparse.ArgumentParser(description = "Starts the host Node that client Nodes join")
+    _parser.add_argument("--host", default = DEFAULT_NODE_HOST, help = "Interface to accept client nodes on. Use 0.0.0.0 to accept other machines")
+    _parser.add_argument("--port", type = int, default = DEFAULT_HOST_PORT)
+    _parser.add_argument("--report-timeout", type = float, default = 30, help = "Seconds without a capacity report before a client node is dropped")
+    return _parser.parse_args()
+
+async def start_host(args):
+    node = Node(ntype = NodeType.SERVER, max_agents = 0, host = args.host, port = args.port)
+    node.cluster.report_timeout = args.report_timeout
+    node.set_metrics_config()
+    await node.serve_and_listen()
+
+if __name__ == "__main__":
+    asyncio.run(start_host(parse_args()))
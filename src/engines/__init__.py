@@ -0,0 +1,41 @@
+from engines.base import BrowserEngine
+
+from utils.console import print_warning
+
+DEFAULT_ENGINE = "playwright"
+
+ENGINE_MODULES = { # What each engine imports, for processes that want it loaded before the first Worker starts
+    "playwright": ["engines.playwright_engine", "playwright.async_api"],
+    "selenium": ["engines.selenium_engine", "selenium.webdriver"],
+    "fake": ["engines.fake_engine"]
+}
+
+def get_engine(name: str = DEFAULT_ENGINE, **kwargs):
+    '''Builds the :class:`BrowserEngine` called `name`. Each backend is only imported when asked for, and Playwright
+    falls back to Selenium when it isn't installed.'''
+    if name == "playwright":
+        try:
+            from engines.playwright_engine import PlaywrightEngine
+        except ImportError as e:
+            print_warning(f"Playwright unavailable ({e}), falling back to the Selenium engine")
+            return get_engine("selenium", **kwargs)
+        return PlaywrightEngine(**kwargs)
+    if name == "selenium":
+        from engines.selenium_engine import SeleniumEngine
+        return SeleniumEngine(**kwargs)
+    if name == "fake":
+        from engines.fake_engine import FakeEngine
+        return FakeEngine(**kwargs)
+    raise ValueError(f"Unknown browser engine: {name}")
+
+def prepare_engine(name: str = DEFAULT_ENGINE, browser_pool_size = 2, max_leases_per_browser = 50):
+    '''Process-wide setup for an engine, run once when an :class:`Agent` process starts. Warms its browser pool'''
+    if name == "playwright":
+        try:
+            from engines.playwright_engine import get_playwright_pool
+        except ImportError: # get_engine falls back to Selenium too
+            return prepare_engine("selenium", browser_pool_size, max_leases_per_browser)
+        get_playwright_pool(size = browser_pool_size, max_leases_per_browser = max_leases_per_browser).warm()
+    elif name == "selenium":
+        from engines.selenium_engine import get_selenium_pool
+        get_selenium_pool(size = browser_pool_size, max_leases_per_browser = max_leases_per_browser).warm()
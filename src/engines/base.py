@@ -0,0 +1,101 @@
+import asyncio
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction
+
+class BrowserEngine():
+    '''Interface every :class:`Worker` execution backend implements. A page is whatever the backend uses as an isolated tab,
+    and at most `max_pages` pages are open at once, so one :class:`Worker` can drive several pages concurrently.
+    All methods are coroutines and must not block the event loop.'''
+
+    name = "base"
+
+    def __init__(self, max_pages = 4):
+        self.max_pages = max_pages
+        self._page_slots = None # Created on first use, inside the event loop that uses it
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def new_page(self):
+        raise NotImplementedError
+
+    async def close_page(self, page):
+        raise NotImplementedError
+
+    async def goto(self, page, url: str):
+        raise NotImplementedError
+
+    async def screenshot(self, page):
+        '''Returns the screenshot as PNG bytes'''
+        raise NotImplementedError
+
+    async def click(self, page, selector: str):
+        raise NotImplementedError
+
+    async def type(self, page, selector: str, text: str):
+        raise NotImplementedError
+
+    def _slots(self):
+        if self._page_slots is None:
+            self._page_slots = asyncio.Semaphore(self.max_pages)
+        return self._page_slots
+
+    def page(self):
+        '''Async context manager that waits for a free slot and opens a page, closing it again on exit'''
+        return _PageContext(self)
+
+    async def run(self, page, instruction: SingleInstruction):
+        '''Carries out a single instruction on `page`. Returns the screenshot bytes for `SCREENSHOT`, otherwise `None`'''
+        _task = instruction.task
+        if _task == WorkerTask.GOTO:
+            await self.goto(page, instruction.action)
+        elif _task == WorkerTask.SCREENSHOT:
+            return await self.screenshot(page)
+        elif _task == WorkerTask.CLICK:
+            await self.click(page, instruction.action)
+        elif _task == WorkerTask.TYPE:
+            await self.type(page, *split_type_action(instruction.action))
+        return None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def __str__(self):
+        return f"{self.name} engine"
+
+class _PageContext():
+    def __init__(self, engine: BrowserEngine):
+        self._engine = engine
+        self._page = None
+
+    async def __aenter__(self):
+        await self._engine._slots().acquire()
+        try:
+            self._page = await self._engine.new_page()
+        except BaseException:
+            self._engine._slots().release()
+            raise
+        return self._page
+
+    async def __aexit__(self, *exc):
+        try:
+            await self._engine.close_page(self._page)
+        finally:
+            self._engine._slots().release()
+
+def split_type_action(action):
+    '''`TYPE` actions are `(selector, text)`, `{"selector": ..., "text": ...}` or a `"<selector> <text>"` string as the model writes them'''
+    if isinstance(action, dict):
+        return action['selector'], action.get('text', "")
+    if isinstance(action, (list, tuple)):
+        return action[0], action[1]
+    _parts = str(action).split(None, 1)
+    return _parts[0], _parts[1] if len(_parts) > 1 else ""
@@ -0,0 +1,57 @@
+import os
+import zlib
+import struct
+import asyncio
+import urllib.request
+
+from engines.base import BrowserEngine
+
+def noise_png(width: int, height: int):
+    '''A valid grayscale PNG of random pixels, built with the standard library only. No two look alike to the dedupe'''
+    def _chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    _rows = b"".join(b"\x00" + os.urandom(width) for _ in range(height))
+    return b"\x89PNG\r\n\x1a\n" + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)) + _chunk(b"IDAT", zlib.compress(_rows, 1)) + _chunk(b"IEND", b"")
+
+class FakeEngine(BrowserEngine):
+    '''Simulated browser for benchmarks: no browser is launched, each action just takes a set time.
+    `goto_delay`, `screenshot_delay` and `action_delay` (CLICK and TYPE) are in seconds and default to the `SOAP_FAKE_*`
+    environment variables, so agent processes spawned by a :class:`Node` pick up the harness's settings.
+    With `fetch`, GOTO also downloads the page, so a local static site sees real requests.'''
+
+    name = "fake"
+
+    def __init__(self, max_pages = 4, goto_delay: float = None, screenshot_delay: float = None, action_delay: float = None, fetch: bool = None, screenshot_size = (320, 240)):
+        super().__init__(max_pages = max_pages)
+        self.goto_delay = goto_delay if goto_delay is not None else float(os.environ.get("SOAP_FAKE_GOTO_DELAY", 0.05))
+        self.screenshot_delay = screenshot_delay if screenshot_delay is not None else float(os.environ.get("SOAP_FAKE_SCREENSHOT_DELAY", 0.02))
+        self.action_delay = action_delay if action_delay is not None else float(os.environ.get("SOAP_FAKE_ACTION_DELAY", 0.01))
+        self.fetch = fetch if fetch is not None else os.environ.get("SOAP_FAKE_FETCH", "1") == "1"
+        self.screenshot_size = screenshot_size
+
+    async def new_page(self):
+        return {"url": None}
+
+    async def close_page(self, page):
+        pass
+
+    async def goto(self, page, url: str):
+        if self.fetch:
+            await asyncio.to_thread(self._download, url)
+        await asyncio.sleep(self.goto_delay)
+        page['url'] = url
+
+    @staticmethod
+    def _download(url):
+        with urllib.request.urlopen(url, timeout = 30) as r:
+            return r.read()
+
+    async def screenshot(self, page):
+        await asyncio.sleep(self.screenshot_delay)
+        return noise_png(*self.screenshot_size)
+
+    async def click(self, page, selector: str):
+        await asyncio.sleep(self.action_delay)
+
+    async def type(self, page, selector: str, text: str):
+        await asyncio.sleep(self.action_delay)
@@ -0,0 +1,150 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import subprocess
+
+from playwright.async_api import async_playwright
+
+from engines.base import BrowserEngine
+from utils.helpers.browser_pool import BrowserPool, get_browser_pool
+
+class _Chromium():
+    '''A pooled Chromium process and the CDP endpoint engines connect to it on'''
+
+    def __init__(self, process: subprocess.Popen, endpoint: str, user_data_dir: str):
+        self.process = process
+        self.endpoint = endpoint
+        self.user_data_dir = user_data_dir
+
+class PlaywrightBrowserFactory():
+    '''Launches headless Chromium for a :class:`BrowserPool`. Playwright objects belong to the event loop that made them, so the
+    pool holds the Chromium processes themselves and every :class:`PlaywrightEngine` connects to them over CDP from its own loop.
+    A browser takes `contexts_per_browser` leases at once, each in a browser context the engine opens on it.'''
+
+    def __init__(self, arguments: list = None, contexts_per_browser = 8, launch_timeout = 30):
+        self.arguments = arguments or ["--headless=new", "--no-first-run", "--no-default-browser-check"]
+        self.contexts_per_browser = contexts_per_browser
+        self.launch_timeout = launch_timeout
+        self._executable_path = None
+        self._lock = threading.Lock()
+
+    def _executable(self):
+        # The Chromium build Playwright installed. Asked once, on a pool thread, where no event loop is running
+        with self._lock:
+            if self._executable_path is None:
+                from playwright.sync_api import sync_playwright
+                with sync_playwright() as p:
+                    self._executable_path = p.chromium.executable_path
+            return self._executable_path
+
+    def launch(self):
+        _dir = tempfile.mkdtemp(prefix = "soap-chromium-")
+        _process = subprocess.Popen([self._executable(), f"--user-data-dir={_dir}", "--remote-debugging-port=0", *self.arguments], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        _port_file = os.path.join(_dir, "DevToolsActivePort") # Written by Chromium once it listens: port, then browser path
+        _deadline = time.monotonic() + self.launch_timeout
+        while True:
+            try:
+                with open(_port_file) as f:
+                    _port = f.readline().strip()
+                if _port.isdigit():
+                    return _Chromium(_process, f"http://127.0.0.1:{_port}", _dir)
+            except FileNotFoundError:
+                pass
+            if _process.poll() is not None or time.monotonic() > _deadline:
+                _code = _process.poll()
+                self.quit(_Chromium(_process, None, _dir))
+                raise RuntimeError(f"Chromium exited with {_code} on launch" if _code is not None else f"Chromium didn't start within {self.launch_timeout} seconds")
+            time.sleep(0.05)
+
+    def open_context(self, browser: _Chromium):
+        return browser # The engine opens the actual browser context, in its own event loop
+
+    def close_context(self, browser: _Chromium, context):
+        pass # Closed by the engine before it releases the lease
+
+    def quit(self, browser: _Chromium):
+        browser.process.terminate()
+        try:
+            browser.process.wait(5)
+        except subprocess.TimeoutExpired:
+            browser.process.kill()
+            browser.process.wait()
+        shutil.rmtree(browser.user_data_dir, ignore_errors = True)
+
+def get_playwright_pool(**kwargs):
+    '''This process's shared pool of warm Chromium browsers'''
+    return get_browser_pool(factory = PlaywrightBrowserFactory(), **kwargs)
+
+class PlaywrightEngine(BrowserEngine):
+    '''Async Playwright backend. Each page is a lease on a warm Chromium from the process's :class:`BrowserPool`, shared by every
+    :class:`Worker` of the :class:`Agent`, and gets a browser context of its own so concurrent tasks don't share cookies or
+    storage. The engine connects to the pooled browsers over CDP, once each, and leases wait in a thread, so nothing here blocks
+    the event loop.'''
+
+    name = "playwright"
+
+    def __init__(self, max_pages = 4, navigation_timeout = 30, browser_pool: BrowserPool = None):
+        super().__init__(max_pages = max_pages)
+        self.navigation_timeout = navigation_timeout
+        self._browser_pool = browser_pool
+        self._playwright = None
+        self._connections = {} # _Chromium -> Browser connected over CDP from this engine's event loop
+        self._leases = {} # page -> its BrowserLease
+
+    async def start(self):
+        if self._browser_pool is None:
+            self._browser_pool = get_playwright_pool()
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+
+    async def stop(self):
+        for browser in self._connections.values():
+            await browser.close() # Only disconnects, the pool owns the browser
+        self._connections = {}
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._playwright = None
+
+    async def _connect(self, chromium: _Chromium):
+        # Browsers the pool recycled are gone, along with the connections to them
+        self._connections = {c: browser for c, browser in self._connections.items() if browser.is_connected()}
+        if chromium not in self._connections:
+            self._connections[chromium] = await self._playwright.chromium.connect_over_cdp(chromium.endpoint)
+        return self._connections[chromium]
+
+    async def new_page(self):
+        await self.start()
+        _lease = await asyncio.to_thread(self._browser_pool.lease)
+        _context = None
+        try:
+            _context = await (await self._connect(_lease.browser)).new_context()
+            _page = await _context.new_page()
+        except BaseException:
+            if _context is not None:
+                await _context.close()
+            await asyncio.to_thread(_lease.release)
+            raise
+        _page.set_default_timeout(self.navigation_timeout * 1000)
+        self._leases[_page] = _lease
+        return _page
+
+    async def close_page(self, page):
+        try:
+            await page.context.close()
+        finally:
+            await asyncio.to_thread(self._leases.pop(page).release)
+
+    async def goto(self, page, url: str):
+        await page.goto(url)
+
+    async def screenshot(self, page):
+        return await page.screenshot(full_page = True)
+
+    async def click(self, page, selector: str):
+        await page.click(selector)
+
+    async def type(self, page, selector: str, text: str):
+        await page.fill(selector, text)
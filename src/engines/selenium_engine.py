@@ -0,0 +1,75 @@
+import asyncio
+
+from selenium import webdriver
+from selenium.webdriver import ChromeOptions
+from selenium.webdriver.common.by import By
+
+from engines.base import BrowserEngine
+from utils.helpers.browser_pool import BrowserPool, get_browser_pool
+
+class SeleniumBrowserFactory():
+    '''Launches headless Chrome through Selenium for a :class:`BrowserPool`.
+    A WebDriver can only run one command at a time, so each browser holds a single lease, isolated in a fresh tab with cleared cookies.'''
+
+    contexts_per_browser = 1
+
+    def __init__(self, arguments: list = None):
+        self.arguments = arguments or ["--headless=new", "--log-level=3"]
+
+    def launch(self):
+        _options = ChromeOptions()
+        for argument in self.arguments:
+            _options.add_argument(argument)
+        return webdriver.Chrome(options = _options)
+
+    def open_context(self, browser):
+        browser.switch_to.new_window("tab")
+        return browser.current_window_handle
+
+    def close_context(self, browser, context):
+        _handles = browser.window_handles
+        if context in _handles and len(_handles) > 1:
+            browser.switch_to.window(context)
+            browser.close()
+        browser.switch_to.window(browser.window_handles[0])
+        browser.delete_all_cookies()
+
+    def quit(self, browser):
+        browser.quit()
+
+def get_selenium_pool(**kwargs):
+    '''This process's shared pool of warm Selenium browsers'''
+    return get_browser_pool(factory = SeleniumBrowserFactory(), **kwargs)
+
+class SeleniumEngine(BrowserEngine):
+    '''Selenium fallback backend. Each page is a lease on a warm browser from the process's :class:`BrowserPool`,
+    and every WebDriver call runs in a thread so the event loop keeps going. Pages can't outnumber the pool's browsers.'''
+
+    name = "selenium"
+
+    def __init__(self, max_pages = 4, browser_pool: BrowserPool = None):
+        super().__init__(max_pages = max_pages)
+        self._browser_pool = browser_pool
+
+    async def start(self):
+        if self._browser_pool is None:
+            self._browser_pool = get_selenium_pool()
+
+    async def new_page(self):
+        await self.start()
+        return await asyncio.to_thread(self._browser_pool.lease)
+
+    async def close_page(self, page):
+        await asyncio.to_thread(page.release)
+
+    async def goto(self, page, url: str):
+        await asyncio.to_thread(page.browser.get, url)
+
+    async def screenshot(self, page):
+        return await asyncio.to_thread(page.browser.get_screenshot_as_png)
+
+    async def click(self, page, selector: str):
+        await asyncio.to_thread(lambda: page.browser.find_element(By.CSS_SELECTOR, selector).click())
+
+    async def type(self, page, selector: str, text: str):
+        await asyncio.to_thread(lambda: page.browser.find_element(By.CSS_SELECTOR, selector).send_keys(text))
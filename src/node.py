@@ -1,37 +1,91 @@
 import json
-import jsonpickle
+import time
 import websockets
+import uuid
 import asyncio
-import multiprocessing
 
-from multiprocessing import Queue
+from contextlib import nullcontext
 
-from agent import Agent
+from agent import run_agent
+from engines import ENGINE_MODULES
 
-from utils.helpers.constants import NodeType
-from utils.helpers.all_helpers import create_ws_message
+from utils.helpers.backpressure import Backpressure
+from utils.helpers.constants import NodeType, InferencePriority, TaskPriority, DEFAULT_NODE_HOST, DEFAULT_NODE_PORT, node_url
+from utils.helpers.cluster import ClusterManager
+from utils.helpers.durable_queue import DurableQueue
+from utils.helpers.inference_scheduler import InferenceScheduler
+from utils.helpers.liveness import LivenessTracker
+from utils.helpers import local_transport
+from utils.helpers.routing import MessageRouter
+from utils.helpers.spawner import WarmSpawner, spawn_context
+from utils.helpers.task_dispatcher import TaskDispatcher
+from utils.helpers.tracing import QUEUE_WAIT, TASK_TOTAL, MetricsRegistry, MetricsServer, Trace
+from utils.helpers.wire_protocol import PROTOCOL_JSON, choose_protocol, decode_message, encode_message, negotiate, unpack_object
 from utils.console import *
 
 from platform import system, node, version, machine, processor
 from socket import gethostname
-from psutil import virtual_memory, cpu_count
+from psutil import virtual_memory, cpu_count, cpu_percent
 
 class Node():
     '''Defines a single device that can either be an agentless server, or a client with `n` agents.
     A :class:`Node` manages each of its agents and the communication between the server and other clients.
     A server :class:`Node` MUST be initialized before clients can connect and being working their :class:`Agents`.
-    A machine can NOT have more than one :class:`Node` running on it.
-    :class:`Node`'s server a localhost that all :class:`Agent`'s and :class:`Worker`'s communicate through'''
+    :class:`Node`'s serve a websocket on `host`:`port` that all of their :class:`Agent`'s and :class:`Worker`'s communicate through,
+    so several can run on one machine on different ports.
+    A `NodeType.SERVER` node is the host of a cluster: client nodes started with `host_url` pointing at it join it, report
+    their capacity every `capacity_interval` seconds, and receive the tasks submitted to the host.
+    An agent that sends nothing, not even a heartbeat, for `heartbeat_deadline` seconds is treated as dead: the tasks it held
+    go to the other agents and its connection is dropped.
+    At most `max_queued_tasks` tasks are held at once. Past the high watermark of `queue_watermarks` (fractions of that) new tasks
+    are answered with `queue_full` and a `retry_after` in seconds, until the backlog drained to the low watermark.
+    With `local_transport` the peers on this machine connect through a Unix domain socket instead of the WebSocket, with large
+    frames in shared memory (see :mod:`utils.helpers.local_transport`). Both are served and routed alike.'''
 
     agents = [] # A lits of all attached agents
 
-    def __init__(self, ntype: NodeType, max_agents: int):
+    def __init__(self, ntype: NodeType, max_agents: int, inference_endpoint = "http://localhost:5001", max_inference_in_flight = 1, browser_pool_size = 2, worker_engine = "playwright", host = DEFAULT_NODE_HOST, port = DEFAULT_NODE_PORT, host_url: str = None, capacity_interval = 5, durable_queue: str = None, task_lease_seconds = 30, tracing = False, metrics_port: int = None, agent_kwargs: dict = None, warm_agents = 1, heartbeat_deadline = 30, max_queued_tasks = 10000, queue_watermarks = (0.9, 0.7), local_transport = True):
         self._node_type = ntype
         self._max_agents = max_agents
         self.ready = False # Defines whether the node is ready to receive instruction or not
-        self.clients = [] # A list of connected WebSocket clients and their respective info
-        self.agent_task_queue = Queue()
-        self.node_name = f"Node-{gethostname()}"
+        self.router = MessageRouter() # Maps registered client names to their WebSocket for targeted delivery
+        self.agent_task_queue = spawn_context().Queue(maxsize = max_queued_tasks) # Same context the agents are started with
+        self.host = host
+        self.port = port
+        self.node_name = f"Node-{gethostname()}-{port}" # The port keeps nodes sharing a machine apart
+        self.inference_scheduler = InferenceScheduler(backends = inference_endpoint, max_in_flight = max_inference_in_flight) # Every attached Agent's generations go through here
+        self._inference_slots = {} # (agent name, request_id) -> backend of a scheduler slot held for the agent's stream
+        self._browser_pool_size = browser_pool_size # Warm browsers per attached Agent
+        self._worker_engine = worker_engine # Browser engine used by the Workers of attached Agents
+        self._agent_kwargs = agent_kwargs or {} # Any other Agent settings for attached Agents, e.g. worker pool sizing
+        _preload = ["websockets", "aiohttp", "PIL.Image", "agent", *ENGINE_MODULES.get(worker_engine, [])] # Imported once, ahead of any attach
+        self.spawner = WarmSpawner(_preload, warm = warm_agents, inherited = (self.agent_task_queue,), name = "WarmAgent") # Keeps agent processes ready to take over
+        _store = DurableQueue(durable_queue, visibility_timeout = task_lease_seconds) if durable_queue else None # Path of an SQLite file to keep queued and in-flight tasks in across restarts
+        self.dispatcher = TaskDispatcher(send = self._dispatch_send, store = _store, lease_seconds = task_lease_seconds) # Hands queued tasks to agents by priority, deadline and load
+        self.backpressure = Backpressure(max_queued_tasks, high = queue_watermarks[0], low = queue_watermarks[1]) # Admission of new tasks against the backlog
+        self.liveness = LivenessTracker(deadline = heartbeat_deadline) # Last message from each agent the dispatcher knows
+        self.cluster = ClusterManager(send = self._cluster_send) if ntype == NodeType.SERVER else None # Places tasks on client nodes when hosting a cluster
+        self.host_url = host_url # Host node to join as a client, e.g. ws://10.0.0.2:5100
+        self._local_transport = local_transport # Also serve the Agents and Workers on this machine over a Unix domain socket
+        self.capacity_interval = capacity_interval
+        self._remote_tasks = {} # Local dispatcher task_id -> the host's cluster task_id
+        self._uplink = None # Connection to the host node
+        self._uplink_protocol = PROTOCOL_JSON
+        self._background_tasks = set()
+        self.tracing = tracing # Trace every submitted task through the agents and workers. Untraced tasks carry nothing extra
+        self._traces = {} # task_id -> Trace of a task submitted here and not done yet
+        self.metrics = MetricsRegistry() # Per-stage latency histograms fed by finished traces
+        self.metrics.gauge("pending_tasks", lambda: self.dispatcher.capacity()[1])
+        self.metrics.gauge("inference_queue_depth", self.inference_scheduler.queue_depth)
+        self.messages_received = 0 # Every message through ws_main, for messages per second
+        self.metrics.gauge("ws_messages_received", lambda: self.messages_received)
+        self.metrics.gauge("agents_expired", lambda: self.liveness.counters['expired'])
+        self.metrics.gauge("queue_depth", lambda: self.backpressure.depth)
+        self.metrics.gauge("queue_capacity", lambda: self.backpressure.capacity)
+        self.metrics.gauge("queue_admission_open", lambda: int(self.backpressure.open))
+        self.metrics.gauge("tasks_rejected", lambda: self.backpressure.counters['rejected'])
+        self.metrics.gauge("producers_blocked_seconds", lambda: round(self.backpressure.blocked_seconds, 3))
+        self._metrics_server = MetricsServer(self.metrics, port = metrics_port) if metrics_port is not None else None # Local HTTP endpoint, port 0 picks a free one
 
     def set_metrics_config(self):
         d = {
@@ -54,66 +108,321 @@ class Node():
 
     async def serve_and_listen(self):
         '''Serves a WebSocket server that listens for any and all messages. This is how function calls will be made.
-        Only ONE server can be active at a given time, and this is why there can only be one :class:`Node` instance on a single machine.'''
-        self.host = "localhost"
-        self.port = 5002
-
-        async with websockets.serve(self.ws_main, self.host, self.port) as ws: # Serve the WS
+        Only ONE server can be active on a given port.'''
+        _local = local_transport.serve(self.ws_main, self.port) if self._local_transport and local_transport.enabled() else nullcontext()
+        async with websockets.serve(self.ws_main, self.host, self.port) as ws, _local: # Serve the WS, and the local socket next to it
             self.ws = ws
+            self.inference_scheduler.start() # Begin health probing the inference backends
+            if self._max_agents > 0:
+                self.spawner.start()
+            self._spawn(self._watch_agents())
+            _recovered = self.dispatcher.recover()
+            if _recovered:
+                print_substep(f"NODE: Recovered {_recovered} in-flight tasks from the durable queue", style = "bright_blue")
+            if self.cluster is not None:
+                self._spawn(self._expire_nodes())
+            if self.host_url is not None:
+                self._spawn(self._join_host())
+            if self._metrics_server is not None:
+                self._metrics_server.start()
+                print_substep(f"NODE: Metrics served at {self._metrics_server.url}", style = "bright_blue")
             print_step(f"Node on {gethostname()} started!", justification = "center", style = "green1")
             print_substep(f"NODE: WebSocket served at {self.host} on port {self.port}", style = "bright_blue")
+            if not isinstance(_local, nullcontext):
+                print_substep(f"NODE: Local peers served at {_local.path}", style = "bright_blue")
             await asyncio.Future()
 
+    @property
+    def url(self):
+        return node_url(self.host, self.port)
+
     async def inference(self):
         '''Inferences the LLM with the main prompt that is then to be split up into tasks amongst the :class:`Agent`'s'''
         pass
 
     async def ws_main(self, websocket):
-        # Store a copy of the connected client
-        self.clients.append(websocket)
         # Handle incoming messages
         try:
             async for message in websocket:
+                self.messages_received += 1
                 # Parse incomming message
-                print(f"INCOMING MESSAGE: {message}")
-                to_all = await self._parse(json.loads(message), websocket)
-                print("done parsing")
-                if to_all:
-                    #Send a response to all connected clients except sender
-                    for conn in self.clients:
-                        if conn != websocket:
-                            await conn.send(message)
+                log_debug("INCOMING MESSAGE: %s", message, category = "ws") # Formatted on the log thread, and only at DEBUG
+                msg = decode_message(message)
+                if msg['type'] == "register":
+                    _protocol = choose_protocol(msg['data'].get('protocols'))
+                    self.router.register(msg['origin'], websocket, role = msg['data'].get('role'), groups = msg['data'].get('groups'), protocol = _protocol)
+                    if msg['data'].get('protocols'): # Only clients that negotiate expect an answer
+                        await websocket.send(encode_message(type = "register_ack", origin = "node", target = msg['origin'], data = {"protocol": _protocol}))
+                    continue
+                if not self.router.is_registered(websocket): # Older clients that never registered are known by their first message
+                    self.router.register(msg['origin'], websocket)
+                if msg['origin'] in self.dispatcher: # Any message from an agent shows it is alive
+                    self.liveness.beat(msg['origin'])
+
+                if msg['target'] == "node":
+                    await self._parse(msg, websocket)
+                    log_debug("done parsing %s", msg['type'], category = "ws")
+                else:
+                    # Only deliver the message to the client(s) it is addressed to
+                    await self.router.route(message, msg['target'], sender = websocket, msg = msg)
         # Handle disconnecting clients
         except websockets.exceptions.ConnectionClosed as e:
             print_warning("A client just disconnected") # TODO: Handle graceful disconnection of agents and workers
         finally:
-            self.clients.remove(websocket)
+            _name = self.router.unregister(websocket)
+            self.liveness.forget(_name)
+            self._release_inference_slots(_name)
+            if _name is not None and self.dispatcher.remove_agent(_name): # Whatever a lost agent held goes to the others
+                await self.dispatcher.pump()
+            if _name is not None and self.cluster is not None and self.cluster.leave(_name): # Likewise for a lost client node
+                print_warning(f"NODE: {_name} left the cluster, rebalancing its tasks")
+                await self.cluster.pump()
 
     async def _parse(self, msg, sender):
         if msg['type'] == "heartbeat":
-            #print_substep(f"NODE: Heartbeat from {sender}", style = "bright_blue")
-            if sender in self.clients:
-                print("Found sender in client list.")
-        if msg['target'] == "node":
-            if msg['type'] == "function_invoke":
-                if msg['data']['function_to_invoke'] == "attach_agent": # Specific bc of the way the parameters are serialized
-                    _params = msg['data']['params']
-                    await self.attach_agent(uses_inference_endpoint = _params['uses_inference_endpoint'], inference_endpoint = _params['inference_endpoint'], uid = jsonpickle.decode(_params['uid']))
-            elif msg['type'] == "agent_ready":
-                for client in self.clients:
-                    await client.send(create_ws_message(type = "agent_dequeue", origin = "node", target = msg['origin'])) # Send dequeue to all clients, targetting send ready agent
-            elif msg['type'] == "node_add_queue_item":
-                self.agent_task_queue.put(msg['data']['item'])
+            log_debug("Heartbeat from %s", msg['origin'], category = "ws") # Already counted as a sign of life by ws_main
+            if self.dispatcher.renew(msg['origin']): # The durable queue leases of the tasks it holds run for as long as it beats
+                await self.dispatcher.flush()
+        elif msg['type'] == "function_invoke":
+            if msg['data']['function_to_invoke'] == "attach_agent": # Specific bc of the way the parameters are serialized
+                _params = msg['data']['params']
+                await self.attach_agent(uses_inference_endpoint = _params['uses_inference_endpoint'], inference_endpoint = _params['inference_endpoint'], uid = unpack_object(_params['uid']))
+        elif msg['type'] == "agent_ready":
+            # The agent says how many tasks it runs at once. The dispatcher keeps it topped up from here on
+            self.dispatcher.add_agent(msg['origin'], slots = msg['data'].get('slots'), prefetch = msg['data'].get('prefetch'))
+            self.liveness.beat(msg['origin'])
+            await self.dispatcher.pump()
+        elif msg['type'] == "node_add_queue_item" and not self.backpressure.admit(self._queue_depth()):
+            await self.router.send(msg['origin'], type = "queue_full", data = self._queue_full(ref = msg['data'].get('ref'))) # The producer keeps the task and retries later
+        elif msg['type'] == "node_add_queue_item":
+            _priority = TaskPriority(msg['data']['priority']) if msg['data'].get('priority') is not None else None
+            if self.cluster is not None: # The host only places tasks, its client nodes run them
+                self.cluster.submit(unpack_object(msg['data']['item']), priority = _priority, deadline = msg['data'].get('deadline'))
+                await self.cluster.pump()
+            else:
+                self._submit(unpack_object(msg['data']['item']), priority = _priority, deadline = msg['data'].get('deadline'))
+                await self.dispatcher.pump()
+        elif msg['type'] == "task_started":
+            self.dispatcher.started(msg['origin'], msg['data']['task_id'])
+        elif msg['type'] == "task_done" and msg['data'].get('result') == "requeue":
+            # The agent lost the Worker running it, or it ran past the agent's task deadline. Any agent may take it again
+            self.dispatcher.requeue(msg['origin'], msg['data']['task_id'])
+            self._sync_load(msg['origin'])
+            await self.dispatcher.pump()
+        elif msg['type'] == "task_done":
+            self.backpressure.drained()
+            self.dispatcher.done(msg['origin'], msg['data']['task_id'], ok = msg['data'].get('result') == "success")
+            self._finish_trace(msg['data']['task_id'], msg['data'].get('trace'))
+            self._sync_load(msg['origin'])
+            _cluster_task_id = self._remote_tasks.pop(msg['data']['task_id'], None)
+            if _cluster_task_id is not None: # Placed here by the host, which frees the slot on its side too
+                await self._send_host("cluster_task_done", {"cluster_task_id": _cluster_task_id, "result": msg['data'].get('result')})
+            await self.dispatcher.pump()
+        elif msg['type'] == "task_returned":
+            self.dispatcher.returned(msg['origin'], msg['data']['task_id'], msg['data'].get('returned', False))
+            await self.dispatcher.pump()
+        elif msg['type'] == "get_dispatch_stats":
+            await self.router.send(msg['origin'], type = "dispatch_stats", data = self.dispatcher.stats())
+        elif msg['type'] == "node_capacity" and self.cluster is not None:
+            self.cluster.join(msg['origin'], msg['data'])
+            await self.cluster.pump()
+        elif msg['type'] == "queue_full" and self.cluster is not None: # A client node turned a placed task away
+            self.cluster.rejected(msg['origin'], msg['data']['cluster_task_id'], msg['data'].get('retry_after', 1.0))
+            await self.cluster.pump()
+        elif msg['type'] == "cluster_task_done" and self.cluster is not None:
+            self.backpressure.drained()
+            self.cluster.done(msg['origin'], msg['data']['cluster_task_id'], ok = msg['data'].get('result') == "success")
+            await self.cluster.pump()
+        elif msg['type'] == "get_cluster_stats" and self.cluster is not None:
+            await self.router.send(msg['origin'], type = "cluster_stats", data = self.cluster.stats())
+        elif msg['type'] == "inference_request":
+            self._spawn(self._serve_inference(msg)) # Answered once the scheduler gets to it, without holding up this client's messages
+        elif msg['type'] == "inference_reserve":
+            self._spawn(self._reserve_inference(msg))
+        elif msg['type'] == "inference_release":
+            _backend = self._inference_slots.pop((msg['origin'], msg['data']['request_id']), None)
+            if _backend is not None:
+                self.inference_scheduler.release(_backend, ok = msg['data'].get('ok', True))
+        elif msg['type'] == "get_metrics":
+            await self.router.send(msg['origin'], type = "metrics", data = self.metrics.stats())
+        elif msg['type'] == "get_inference_stats":
+            await self.router.send(msg['origin'], type = "inference_stats", data = self.inference_scheduler.stats())
+
+    def _queue_depth(self):
+        '''Tasks held on this Node: for a host those waiting or placed on a client node, otherwise those queued or on its agents'''
+        return self.cluster.backlog() if self.cluster is not None else self.dispatcher.capacity()[1]
+
+    def _queue_full(self, **data):
+        return dict(data, retry_after = self.backpressure.retry_after(), depth = self.backpressure.depth, capacity = self.backpressure.capacity)
+
+    def _submit(self, item, priority: TaskPriority = None, deadline: float = None):
+        '''Queues a task on the dispatcher, starting its trace when tracing is on'''
+        _task_id = self.dispatcher.submit(item, priority = priority, deadline = deadline)
+        if self.tracing:
+            _trace = Trace()
+            _trace.mark("queued")
+            self._traces[_task_id] = _trace
+        return _task_id
+
+    def _finish_trace(self, task_id: str, data: dict):
+        '''Feeds the stages of a task the agent reported done into the histograms'''
+        _trace = self._traces.pop(task_id, None)
+        if _trace is None:
+            return
+        _finished = Trace.receive(data) or _trace # The returning trace holds every stage recorded along the way
+        _finished.add(TASK_TOTAL, time.time() - _trace.started_at)
+        self.metrics.observe_trace(_finished)
+
+    async def _dispatch_send(self, target: str, type: str, data: dict):
+        _trace = self._traces.get(data.get('task_id')) if type == "dispatch_task" and self._traces else None
+        if _trace is not None:
+            _trace.since("queued", QUEUE_WAIT) # Only timed up to the first dispatch. Marks are consumed, so a redispatch adds nothing
+            data['trace'] = _trace.to_dict()
+        _start = time.perf_counter()
+        _sent = await self.router.send(target, type = type, data = data)
+        self.metrics.observe("dispatch_send", time.perf_counter() - _start) # Waits on the connection's write buffer when the agent reads slowly
+        self._sync_load(target)
+        return _sent
+
+    def _sync_load(self, agent_name: str):
+        '''Mirrors the dispatcher's in-flight count into the router, so anycast messages also favour the least busy agent'''
+        _in_flight = self.dispatcher.in_flight(agent_name)
+        self.router.add_load(agent_name, _in_flight - self.router.load_of(agent_name))
+        self.router.set_idle(agent_name, _in_flight == 0)
+
+    async def _cluster_send(self, target: str, type: str, data: dict):
+        return await self.router.send(target, type = type, data = data)
+
+    async def _expire_nodes(self):
+        '''Drops client nodes that stopped reporting without disconnecting'''
+        while True:
+            await asyncio.sleep(self.cluster.report_timeout / 2)
+            for name in self.cluster.expire():
+                print_warning(f"NODE: {name} stopped reporting, rebalancing its tasks")
+            await self.cluster.pump()
+
+    async def _watch_agents(self):
+        '''Puts the tasks of agents that went quiet past the heartbeat deadline back in line and drops their connection.
+        A hung agent that recovers reconnects and announces itself again with agent_ready. Also forgets agent processes that exited,
+        so their places can be taken by new ones'''
+        while True:
+            await asyncio.sleep(self.liveness.deadline / 4)
+            _requeued = 0
+            for name in self.liveness.expired():
+                _held = self.dispatcher.remove_agent(name)
+                _requeued += _held
+                print_warning(f"NODE: {name} missed its heartbeat deadline, {_held} tasks requeued")
+                _websocket = self.router.socket_of(name)
+                if _websocket is not None:
+                    self._spawn(_websocket.close()) # Closing waits on the peer, which may never answer
+            _alive = [process for process in self.agents if process.is_alive()]
+            if len(_alive) < len(self.agents):
+                print_warning(f"NODE: {len(self.agents) - len(_alive)} agent processes exited")
+                self.agents = _alive
+            if _requeued:
+                await self.dispatcher.pump()
+
+    def capacity_report(self):
+        '''What the host needs to place tasks on this node'''
+        _slots, _held = self.dispatcher.capacity()
+        _memory = virtual_memory()
+        return {
+            "slots": _slots,
+            "held": _held,
+            "max_agents": self._max_agents,
+            "agents": len(self.agents),
+            "cpu_count": cpu_count(),
+            "cpu_percent": cpu_percent(),
+            "total_memory": round(_memory.total / (1024.0 **3), 2),
+            "available_memory": round(_memory.available / (1024.0 **3), 2)
+        }
+
+    async def _send_host(self, type: str, data: dict = {}):
+        if self._uplink is None:
+            return False
+        try:
+            await self._uplink.send(encode_message(type = type, origin = self.node_name, target = "node", data = data, protocol = self._uplink_protocol))
+            return True
+        except websockets.ConnectionClosed:
             return False
-        return False
+
+    async def _report_capacity(self):
+        while True:
+            await self._send_host("node_capacity", self.capacity_report())
+            await asyncio.sleep(self.capacity_interval)
+
+    async def _join_host(self):
+        '''Keeps this node joined to the host at `host_url`, reconnecting when the connection drops, and runs the tasks the host places here'''
+        async for ws in websockets.connect(self.host_url, ping_interval = None):
+            _reporter = None
+            try:
+                self._uplink_protocol = await negotiate(ws, self.node_name, role = "node")
+                self._uplink = ws
+                _reporter = self._spawn(self._report_capacity())
+                print_substep(f"NODE: Joined the cluster hosted at {self.host_url}", style = "green1")
+                async for message in ws:
+                    msg = decode_message(message)
+                    if msg['type'] == "node_add_queue_item" and not self.backpressure.admit(self._queue_depth()):
+                        await self._send_host("queue_full", self._queue_full(cluster_task_id = msg['data']['cluster_task_id'])) # The host places it elsewhere
+                    elif msg['type'] == "node_add_queue_item":
+                        _priority = TaskPriority(msg['data']['priority']) if msg['data'].get('priority') is not None else None
+                        _task_id = self._submit(unpack_object(msg['data']['item']), priority = _priority, deadline = msg['data'].get('deadline'))
+                        self._remote_tasks[_task_id] = msg['data']['cluster_task_id']
+                        await self.dispatcher.pump()
+            except websockets.ConnectionClosed:
+                print_warning(f"NODE: Lost the cluster host at {self.host_url}, reconnecting")
+                continue
+            finally:
+                self._uplink = None
+                if _reporter is not None:
+                    _reporter.cancel()
+
+    def _spawn(self, coro):
+        _task = asyncio.get_running_loop().create_task(coro)
+        self._background_tasks.add(_task)
+        _task.add_done_callback(self._background_tasks.discard)
+        return _task
+
+    async def _serve_inference(self, msg):
+        '''Runs an :class:`Agent`'s generation through the :class:`InferenceScheduler` and sends the response back to it'''
+        _data = msg['data']
+        _priority = InferencePriority(_data['priority']) if _data.get('priority') is not None else None
+        try:
+            _result = await self.inference_scheduler.submit(msg['origin'], _data['prompt'], _data['body'], priority = _priority, path = _data.get('path', "api/v1/generate"))
+            _reply = {"request_id": _data['request_id'], "ok": True, "result": _result}
+        except Exception as e:
+            _reply = {"request_id": _data['request_id'], "ok": False, "error": f"{type(e).__name__}: {e}"}
+        await self.router.send(msg['origin'], type = "inference_result", data = _reply)
+
+    async def _reserve_inference(self, msg):
+        '''Holds a slot of the :class:`InferenceScheduler` for a generation an :class:`Agent` streams itself, and tells it which
+        backend to stream from. The slot is held until the agent sends `inference_release`, or disconnects'''
+        _data = msg['data']
+        _priority = InferencePriority(_data['priority']) if _data.get('priority') is not None else None
+        try:
+            _backend = await self.inference_scheduler.reserve(msg['origin'], _data['prompt'], priority = _priority)
+        except Exception as e:
+            await self.router.send(msg['origin'], type = "inference_result", data = {"request_id": _data['request_id'], "ok": False, "error": f"{type(e).__name__}: {e}"})
+            return
+        self._inference_slots[(msg['origin'], _data['request_id'])] = _backend
+        if not await self.router.send(msg['origin'], type = "inference_result", data = {"request_id": _data['request_id'], "ok": True, "result": {"endpoint": _backend.endpoint}}):
+            self._release_inference_slots(msg['origin']) # Gone before it could use the slot
+
+    def _release_inference_slots(self, name: str):
+        '''Gives back the scheduler slots `name` still held for its streams'''
+        for key in [key for key in self._inference_slots if key[0] == name]:
+            self.inference_scheduler.release(self._inference_slots.pop(key), ok = False)
 
     async def attach_agent(self, uses_inference_endpoint = True, inference_endpoint = "http://localhost:5001", uid = ""):
-        '''Attaches an agent to this :class:`Node`. No more agents can be added that exceed the `max_agents` count.'''
-        _new_agent = Agent(uses_inference_endpoint = uses_inference_endpoint, inference_endpoint = inference_endpoint, uid = uid, agent_task_queue = self.agent_task_queue)
-        if len(self.agents) < self._max_agents: # If there is still room for more agents
-            print_substep(f"NODE: Adding Agent: {_new_agent}", style = "bright_blue")
-            self.agents.append(_new_agent) # Add agent to a list of agents. List length contains the amount of currently attached agents
-            _p = multiprocessing.Process(target = _new_agent.sync_start, name = f"Process-{_new_agent.agent_name}")
-            _p.start() # Start the new agent process
-        else:
-            print_warning("Max agents for this node has already been reached")
\ No newline at end of file
+        '''Attaches an agent to this :class:`Node`. No more agents can be added that exceed the `max_agents` count.
+        The agent is built inside a warm process from the :class:`WarmSpawner`, so attaching doesn't wait on imports or the agent's setup.'''
+        if len(self.agents) >= self._max_agents:
+            print_warning("Max agents for this node has already been reached")
+            return None
+        _uid = uid or uuid.uuid4()
+        _agent_name = f"Agent-{_uid.hex}"
+        print_substep(f"NODE: Adding Agent: {_agent_name}", style = "bright_blue")
+        _p = self.spawner.spawn(run_agent, name = f"Process-{_agent_name}", uses_inference_endpoint = uses_inference_endpoint, inference_endpoint = inference_endpoint, uid = _uid, use_node_scheduler = True, browser_pool_size = self._browser_pool_size, worker_engine = self._worker_engine, node_url = self.url, **self._agent_kwargs)
+        self.agents.append(_p) # List length contains the amount of currently attached agents
+        print_substep(f"NODE: {_agent_name} started {'warm' if _p.warm else 'cold'} in {_p.spawn_seconds * 1000:.1f} ms", style = "bright_blue")
+        return _p
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other from `src/`, as when the Node or an Agent is run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
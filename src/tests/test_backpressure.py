@@ -0,0 +1,40 @@
+import time
+
+from utils.helpers.backpressure import Backpressure
+from utils.helpers.liveness import LivenessTracker
+
+def test_admission_closes_at_high_and_reopens_at_low():
+    _pressure = Backpressure(10, high = 0.8, low = 0.5)
+    assert (_pressure.high_watermark, _pressure.low_watermark) == (8, 5)
+    assert _pressure.admit(7)
+    assert not _pressure.admit(8)
+    assert not _pressure.admit(6) # Below high, but not drained to low yet
+    assert _pressure.admit(5)
+    assert _pressure.counters == {"admitted": 2, "rejected": 2, "closed": 1}
+
+def test_admission_never_overfills():
+    _pressure = Backpressure(10, high = 1.0, low = 0.5)
+    assert not _pressure.admit(8, count = 3)
+    assert _pressure.admit(8, count = 2)
+
+def test_tiny_queue_watermarks():
+    _pressure = Backpressure(1)
+    assert (_pressure.high_watermark, _pressure.low_watermark) == (1, 0)
+
+def test_retry_after_without_drain_rate():
+    _pressure = Backpressure(10, min_retry = 0.5)
+    assert _pressure.retry_after() == 0.5
+
+def test_liveness_expiry(monkeypatch):
+    _now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: _now[0])
+    _tracker = LivenessTracker(deadline = 30)
+    _tracker.beat("quiet", info = ["task-1"])
+    _tracker.beat("busy")
+    _now[0] += 20
+    _tracker.beat("busy")
+    assert _tracker.reported_by("task-1") == "quiet"
+    _now[0] += 20
+    assert _tracker.expired() == {"quiet": ["task-1"]}
+    assert "quiet" not in _tracker and "busy" in _tracker
+    assert _tracker.expired() == {}
@@ -0,0 +1,72 @@
+import pytest
+
+from utils.helpers.durable_queue import DurableQueue
+
+@pytest.fixture
+def store(tmp_path):
+    _queue = DurableQueue(str(tmp_path / "task_queue.db"), visibility_timeout = 60, max_deliveries = 2)
+    yield _queue
+    _queue.close()
+
+def test_priority_deadline_then_arrival_order(store):
+    store.put("normal")
+    store.put("late", priority = 0, deadline = 200.0)
+    store.put("low", priority = 2)
+    store.put("soon", priority = 0, deadline = 100.0)
+    store.put("no deadline", priority = 0)
+    assert [lease.item for lease in store.lease(10)] == ["soon", "late", "no deadline", "normal", "low"]
+
+def test_put_many_returns_ids_in_order(store):
+    _ids = store.put_many(["a", "b", "c"])
+    assert [lease.id for lease in store.lease(3)] == _ids
+
+def test_leased_tasks_are_invisible_until_acked(store):
+    _id = store.put({"task": 1})
+    _lease, = store.lease(5)
+    assert (_lease.item, _lease.deliveries) == ({"task": 1}, 1)
+    assert store.lease(5) == []
+    assert store.ack(_id) == 1
+    assert store.qsize() == 0
+
+def test_expired_lease_is_delivered_again(store):
+    store.put("task")
+    _first, = store.lease(1, visibility_timeout = 0)
+    _second, = store.lease(1)
+    assert (_second.id, _second.deliveries) == (_first.id, 2)
+    assert _second.lease_token != _first.lease_token
+    assert store.counters['redelivered'] == 1
+
+def test_extended_lease_stays_invisible(store):
+    store.put("task")
+    _lease, = store.lease(1, visibility_timeout = 0)
+    store.extend(_lease.id, 60)
+    assert store.lease(1) == []
+
+def test_task_out_of_deliveries_is_parked_as_dead(store):
+    store.put("poison")
+    store.lease(1, visibility_timeout = 0)
+    store.lease(1, visibility_timeout = 0)
+    assert store.lease(1) == []
+    _stats = store.stats()
+    assert (_stats['dead_parked'], _stats['ready'], _stats['leased'], _stats['dead']) == (1, 0, 0, 1)
+    assert store.qsize() == 0
+    assert store.purge_dead() == 1
+
+def test_release_does_not_count_as_a_delivery(store):
+    store.put("task")
+    for _ in range(3):
+        _lease, = store.lease(1)
+        store.release(_lease.id)
+    assert _lease.deliveries == 1
+    assert store.stats()['ready'] == 1
+
+def test_release_all_after_a_restart(tmp_path):
+    _path = str(tmp_path / "task_queue.db")
+    _queue = DurableQueue(_path)
+    _queue.put_many(["a", "b"])
+    _queue.lease(2)
+    _queue.close()
+    _restarted = DurableQueue(_path)
+    assert _restarted.release_all() == 2
+    assert sorted(lease.item for lease in _restarted.lease(2)) == ["a", "b"]
+    _restarted.close()
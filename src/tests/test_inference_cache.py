@@ -0,0 +1,60 @@
+import asyncio
+
+from utils.helpers.inference_cache import InferenceCache, cache_key, is_deterministic, normalize_prompt
+
+_GREEDY = {"temperature": 0, "max_tokens": 256}
+
+def test_normalize_prompt():
+    assert normalize_prompt("  a   b\t c \n\n  d  ") == "a b c\n\nd"
+
+def test_cache_key_ignores_whitespace_and_non_sampling_fields():
+    assert cache_key("take  a screenshot ", {"temperature": 0, "quiet": True, "prompt": "x"}) == cache_key("take a screenshot", {"temperature": 0})
+
+def test_cache_key_changes_with_sampling_and_prompt():
+    _key = cache_key("take a screenshot", {"temperature": 0})
+    assert _key != cache_key("take a screenshot", {"temperature": 0, "top_k": 1})
+    assert _key != cache_key("take a screenshot", {"temperature": 0.5})
+    assert _key != cache_key("Take a screenshot", {"temperature": 0})
+
+def test_cache_key_ignores_field_order():
+    assert cache_key("p", {"temperature": 0, "top_k": 1}) == cache_key("p", {"top_k": 1, "temperature": 0})
+
+def test_is_deterministic():
+    assert is_deterministic({"temperature": 0})
+    assert is_deterministic({"temperature": 0.7, "top_k": 1})
+    assert not is_deterministic({"temperature": 0.7})
+    assert not is_deterministic({})
+    assert not is_deterministic(None)
+
+def test_memory_cache_hit_and_miss():
+    _cache = InferenceCache(path = None)
+    assert _cache.get("p", _GREEDY) is None
+    _cache.put("p", _GREEDY, {"response": "plan"})
+    assert _cache.get(" p ", _GREEDY) == {"response": "plan"}
+    assert _cache.get("p", dict(_GREEDY, max_tokens = 512)) is None
+    assert (_cache.counters['memory_hits'], _cache.counters['misses']) == (1, 2)
+
+def test_sampled_requests_bypass_the_cache():
+    _cache = InferenceCache(path = None)
+    _cache.put("p", {"temperature": 0.8}, {"response": "plan"})
+    assert _cache.get("p", {"temperature": 0.8}) is None
+    assert _cache.counters['stores'] == 0
+    _cache = InferenceCache(path = None, deterministic_only = False)
+    _cache.put("p", {"temperature": 0.8}, {"response": "plan"})
+    assert _cache.get("p", {"temperature": 0.8}) == {"response": "plan"}
+
+def test_discard():
+    _cache = InferenceCache(path = None)
+    _cache.put("p", _GREEDY, {"response": "plan"})
+    _cache.discard("p", _GREEDY)
+    assert _cache.get("p", _GREEDY) is None
+
+def test_disk_tier_is_shared(tmp_path):
+    _path = str(tmp_path / "inference_cache.db")
+    _writer = InferenceCache(path = _path)
+    asyncio.run(_writer.aput("p", _GREEDY, {"response": "plan"}))
+    _reader = InferenceCache(path = _path)
+    assert asyncio.run(_reader.aget("p", _GREEDY)) == {"response": "plan"}
+    assert _reader.counters['disk_hits'] == 1
+    _writer.close()
+    _reader.close()
@@ -0,0 +1,67 @@
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+from utils.helpers.plan_cache import PlanCache, task_template
+
+def _screenshot_plan(url):
+    return MultiInstruction([SingleInstruction(WorkerTask.GOTO, url), SingleInstruction(WorkerTask.SCREENSHOT, None)])
+
+def test_template_lifts_urls_and_quoted_text():
+    _template, _slots = task_template('  Go to https://example.com/a?b=1 and  type "hello world" into the search box.')
+    assert _template == 'go to {url0} and type "{text0}" into the search box.'
+    assert _slots == {"url0": "https://example.com/a?b=1", "text0": "hello world"}
+
+def test_template_leaves_trailing_punctuation_and_apostrophes():
+    _template, _slots = task_template("Don't click 'Login' on http://localhost:8000/.")
+    assert _template == "don't click '{text0}' on {url0}."
+    assert _slots == {"url0": "http://localhost:8000/", "text0": "Login"}
+
+def test_template_is_case_and_whitespace_insensitive():
+    assert task_template("Take a screenshot of http://a.test/")[0] == task_template("take  a SCREENSHOT of http://b.test/X")[0]
+
+def test_put_then_get_fills_in_the_new_slots():
+    _cache = PlanCache()
+    assert _cache.put("Take a screenshot of http://a.test/", _screenshot_plan("http://a.test/"), inference_seconds = 2.0)
+    _plan = _cache.get("take a screenshot of http://b.test/page")
+    assert [(i.task, i.action) for i in _plan.get_action_list()] == [(WorkerTask.GOTO, "http://b.test/page"), (WorkerTask.SCREENSHOT, None)]
+    assert _cache.counters['hits'] == 1
+    assert _cache.stats()['inference_seconds_saved'] == 2.0
+
+def test_get_misses_on_another_shape():
+    _cache = PlanCache()
+    _cache.put("Take a screenshot of http://a.test/", _screenshot_plan("http://a.test/"))
+    assert _cache.get("Click the button on http://a.test/") is None
+    assert _cache.counters['misses'] == 1
+
+def test_braces_in_values_survive():
+    _cache = PlanCache()
+    _plan = MultiInstruction([SingleInstruction(WorkerTask.TYPE, '#q {literal} hello')])
+    assert _cache.put('Type "hello" into #q', _plan)
+    _hit = _cache.get('Type "{bye}" into #q')
+    assert _hit.get_action_list()[0].action == '#q {literal} {bye}'
+
+def test_plan_ignoring_a_slot_is_not_cached():
+    _cache = PlanCache()
+    assert not _cache.put("Take a screenshot of http://a.test/", _screenshot_plan("http://elsewhere.test/"))
+    assert _cache.counters['uncacheable'] == 1
+    assert _cache.get("Take a screenshot of http://a.test/") is None
+
+def test_invalidate():
+    _cache = PlanCache()
+    _cache.put("Take a screenshot of http://a.test/", _screenshot_plan("http://a.test/"))
+    assert _cache.invalidate("take a screenshot of http://c.test/")
+    assert not _cache.invalidate("take a screenshot of http://c.test/")
+    assert _cache.get("Take a screenshot of http://a.test/") is None
+
+def test_lru_eviction():
+    _cache = PlanCache(max_entries = 1)
+    _cache.put("Take a screenshot of http://a.test/", _screenshot_plan("http://a.test/"))
+    _cache.put("Open http://a.test/ and take a screenshot", _screenshot_plan("http://a.test/"))
+    assert _cache.counters['evicted'] == 1
+    assert _cache.get("Take a screenshot of http://a.test/") is None
+    assert _cache.get("Open http://b.test/ and take a screenshot") is not None
+
+def test_expiry():
+    _cache = PlanCache(ttl = -1)
+    _cache.put("Take a screenshot of http://a.test/", _screenshot_plan("http://a.test/"))
+    assert _cache.get("Take a screenshot of http://a.test/") is None
+    assert _cache.counters['expired'] == 1
@@ -0,0 +1,171 @@
+import time
+import asyncio
+
+import pytest
+
+from utils.helpers.constants import TaskPriority
+from utils.helpers.durable_queue import DurableQueue
+from utils.helpers.task_dispatcher import TaskDispatcher
+
+class _Agents():
+    '''Stands in for the Node's connections: records what was sent to whom, and drops messages to agents that left'''
+
+    def __init__(self):
+        self.sent = [] # (target, type, data)
+        self.gone = set()
+
+    async def send(self, target, type, data):
+        if target in self.gone:
+            return 0
+        self.sent.append((target, type, data))
+        return 1
+
+    def dispatched(self, target = None):
+        return [data['task_id'] for to, type, data in self.sent if type == "dispatch_task" and target in (None, to)]
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''Wall clock the test moves by hand, so leases run out without waiting'''
+    _now = [1_000_000.0]
+    monkeypatch.setattr(time, "time", lambda: _now[0])
+    return _now
+
+@pytest.fixture
+def store(tmp_path):
+    _queue = DurableQueue(str(tmp_path / "task_queue.db"))
+    yield _queue
+    _queue.close()
+
+def test_agents_are_filled_to_their_credit_window():
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 2)
+    _dispatcher.add_agent("a")
+    _dispatcher.add_agent("b", slots = 2, prefetch = 0)
+    _dispatcher.submit_many(list(range(10)))
+    asyncio.run(_dispatcher.pump())
+    assert (_dispatcher.in_flight("a"), _dispatcher.in_flight("b")) == (3, 2)
+    assert _dispatcher.capacity() == (5, 10)
+    assert _dispatcher.stats()['pending'] == 5
+
+def test_done_frees_exactly_its_credit():
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 1)
+    _dispatcher.add_agent("a")
+    _dispatcher.submit_many(list(range(5)))
+    asyncio.run(_dispatcher.pump())
+    _first = _agents.dispatched()[0]
+    assert _dispatcher.done("a", _first).task_id == _first
+    assert _dispatcher.done("a", _first) is None # Reported twice, credited once
+    asyncio.run(_dispatcher.pump())
+    assert _dispatcher.in_flight("a") == 2
+    assert len(_agents.dispatched()) == 3
+    assert _dispatcher.counters['completed'] == 1
+
+def test_dispatch_order():
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 0)
+    _normal = _dispatcher.submit("normal")
+    _low = _dispatcher.submit("low", TaskPriority.LOW)
+    _late = _dispatcher.submit("late", TaskPriority.HIGH, deadline = 200.0)
+    _soon = _dispatcher.submit("soon", TaskPriority.HIGH, deadline = 100.0)
+    _dispatcher.add_agent("a")
+    for _ in range(4):
+        asyncio.run(_dispatcher.pump())
+        _dispatcher.done("a", _agents.dispatched()[-1])
+    assert _agents.dispatched() == [_soon, _late, _normal, _low]
+
+def test_lost_agent_tasks_go_to_the_others():
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 1, steal = False)
+    _dispatcher.add_agent("a")
+    _dispatcher.submit_many(list(range(2)))
+    asyncio.run(_dispatcher.pump())
+    _held = _agents.dispatched("a")
+    assert _dispatcher.remove_agent("a") == 2
+    _dispatcher.add_agent("b")
+    asyncio.run(_dispatcher.pump())
+    assert _agents.dispatched("b") == _held
+    assert _dispatcher.counters['requeued'] == 2
+
+def test_failed_send_requeues():
+    _agents = _Agents()
+    _agents.gone.add("a")
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 0)
+    _dispatcher.add_agent("a")
+    _dispatcher.add_agent("b")
+    _dispatcher.submit_many(list(range(2)))
+    asyncio.run(_dispatcher.pump())
+    assert "a" not in _dispatcher
+    assert _dispatcher.in_flight("b") == 1
+    assert _dispatcher.stats()['pending'] == 1
+
+def test_idle_agent_steals_the_least_urgent_queued_task():
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 2)
+    _dispatcher.add_agent("a")
+    _dispatcher.submit("urgent", TaskPriority.HIGH)
+    _dispatcher.submit("normal")
+    _last = _dispatcher.submit("low", TaskPriority.LOW)
+    asyncio.run(_dispatcher.pump())
+    _dispatcher.started("a", _agents.dispatched()[0])
+    _dispatcher.add_agent("b")
+    asyncio.run(_dispatcher.pump())
+    assert _agents.sent[-1] == ("a", "steal_task", {"task_id": _last})
+    _dispatcher.returned("a", _last, True)
+    asyncio.run(_dispatcher.pump())
+    assert _agents.dispatched("b") == [_last]
+    assert (_dispatcher.in_flight("a"), _dispatcher.counters['stolen']) == (2, 1)
+
+def test_store_only_leases_what_agents_have_credit_for(clock, store):
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 1, store = store)
+    _dispatcher.add_agent("a")
+    _dispatcher.submit_many(list(range(10)))
+    assert _dispatcher.capacity() == (2, 10) # Not in the store yet, still held
+    asyncio.run(_dispatcher.pump())
+    assert (store.stats()['ready'], store.stats()['leased']) == (8, 2)
+    assert _dispatcher.capacity() == (2, 10)
+    _dispatcher.done("a", _agents.dispatched()[0])
+    asyncio.run(_dispatcher.pump())
+    assert (store.stats()['ready'], store.stats()['leased'], store.counters['acked']) == (7, 2, 1)
+    assert _dispatcher.capacity() == (2, 9)
+
+def test_store_expired_lease_is_not_dispatched_twice(clock, store):
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 1, store = store, lease_seconds = 30)
+    _dispatcher.add_agent("a")
+    _dispatcher.submit_many(list(range(4)))
+    asyncio.run(_dispatcher.pump())
+    clock[0] += 60 # Both leases ran out while the agent still has the tasks
+    _dispatcher.done("a", _agents.dispatched()[0])
+    asyncio.run(_dispatcher.pump())
+    _dispatched = _agents.dispatched()
+    assert len(_dispatched) == 3 and len(set(_dispatched)) == 3
+    assert _dispatcher.counters['lease_expired'] == 1
+    assert _dispatcher.capacity() == (2, 3)
+
+def test_store_leases_are_renewed(clock, store):
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 0, store = store, lease_seconds = 30)
+    _dispatcher.add_agent("a")
+    _dispatcher.submit("task")
+    asyncio.run(_dispatcher.pump())
+    clock[0] += 10
+    assert not _dispatcher.renew("a") # Not half way through yet
+    clock[0] += 10
+    assert _dispatcher.renew("a")
+    asyncio.run(_dispatcher.flush())
+    clock[0] += 20 # Past the first lease, within the renewed one
+    assert store.lease(1) == []
+
+def test_recover_releases_a_previous_run_leases(store):
+    _agents = _Agents()
+    _dispatcher = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 0, store = store)
+    _dispatcher.add_agent("a")
+    _ids = _dispatcher.submit_many(["a", "b"])
+    asyncio.run(_dispatcher.pump())
+    _restarted = TaskDispatcher(_agents.send, default_slots = 1, default_prefetch = 1, store = store)
+    assert _restarted.recover() == 1
+    _restarted.add_agent("b")
+    asyncio.run(_restarted.pump())
+    assert sorted(_agents.dispatched("b")) == sorted(_ids)
@@ -0,0 +1,89 @@
+import uuid
+
+import pytest
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+from utils.helpers.wire_protocol import PROTOCOL_BINARY, PROTOCOL_JSON, MESSAGE_TYPES, WireProtocolError, choose_protocol, decode_message, encode_message, protocol_of
+
+def _roundtrip(type, data):
+    _raw = encode_message(type = type, origin = "agent", target = "node", data = data, protocol = PROTOCOL_BINARY)
+    assert protocol_of(_raw) == PROTOCOL_BINARY
+    return decode_message(_raw)
+
+def test_roundtrip_plain_values():
+    _data = {"none": None, "yes": True, "no": False, "int": -(2 ** 63), "float": 1.5, "str": "héllo", "bytes": b"\x00\xff", "list": [1, "two", [3.0]], "nested": {"a": {"b": 2}}}
+    _msg = _roundtrip("heartbeat", _data)
+    assert _msg == {"type": "heartbeat", "origin": "agent", "target": "node", "data": _data}
+
+def test_roundtrip_tuples_come_back_as_lists():
+    assert _roundtrip("heartbeat", {"t": (1, 2)})['data'] == {"t": [1, 2]}
+
+def test_roundtrip_uncoded_message_type():
+    assert "not_a_known_type" not in MESSAGE_TYPES
+    assert _roundtrip("not_a_known_type", {})['type'] == "not_a_known_type"
+
+def test_roundtrip_objects():
+    _id = uuid.uuid4()
+    _data = decode_message(encode_message("dispatch_task", "node", "agent", {"uid": _id, "task": WorkerTask.CLICK}, protocol = PROTOCOL_BINARY))['data']
+    assert _data == {"uid": _id, "task": WorkerTask.CLICK}
+
+def test_roundtrip_instructions():
+    _plan = MultiInstruction([
+        SingleInstruction(WorkerTask.GOTO, "http://localhost/a", id = "a"),
+        SingleInstruction(WorkerTask.GOTO, "http://localhost/b", new_page = True),
+        SingleInstruction(WorkerTask.SCREENSHOT, None, after = "a")
+    ])
+    _decoded = _roundtrip("dispatch_task", {"item": _plan, "single": SingleInstruction(WorkerTask.TYPE, "#q hello")})['data']
+    _instructions = _decoded['item'].get_action_list()
+    assert [(i.task, i.action, i.id, i.after, bool(i.new_page)) for i in _instructions] == [
+        (WorkerTask.GOTO, "http://localhost/a", "a", None, False),
+        (WorkerTask.GOTO, "http://localhost/b", None, None, True),
+        (WorkerTask.SCREENSHOT, None, None, "a", False)
+    ]
+    assert len(_decoded['item'].branches()) == 2
+    assert (_decoded['single'].task, _decoded['single'].action) == (WorkerTask.TYPE, "#q hello")
+
+def test_ints_past_64_bits_fall_back_to_json():
+    _raw = encode_message("heartbeat", "agent", "node", {"n": 2 ** 64}, protocol = PROTOCOL_BINARY)
+    assert protocol_of(_raw) == PROTOCOL_JSON
+    assert decode_message(_raw)['data'] == {"n": 2 ** 64}
+
+def test_unencodable_value():
+    with pytest.raises(WireProtocolError):
+        encode_message("heartbeat", "agent", "node", {"x": object()}, protocol = PROTOCOL_BINARY)
+
+def test_every_truncation_raises_wire_protocol_error():
+    _raw = encode_message("dispatch_task", "node", "agent", {"item": MultiInstruction([SingleInstruction(WorkerTask.GOTO, "http://localhost/")]), "n": 7, "s": "text", "id": uuid.uuid4()}, protocol = PROTOCOL_BINARY)
+    for end in range(len(_raw)):
+        with pytest.raises(WireProtocolError):
+            decode_message(_raw[:end])
+
+def test_bad_magic():
+    _raw = bytearray(encode_message("heartbeat", "a", "b", {}, protocol = PROTOCOL_BINARY))
+    _raw[:2] = b"XX"
+    with pytest.raises(WireProtocolError):
+        decode_message(bytes(_raw))
+
+def test_newer_version():
+    _raw = bytearray(encode_message("heartbeat", "a", "b", {}, protocol = PROTOCOL_BINARY))
+    _raw[2] = 255
+    with pytest.raises(WireProtocolError):
+        decode_message(bytes(_raw))
+
+def test_unknown_type_code():
+    _raw = bytearray(encode_message("heartbeat", "a", "b", {}, protocol = PROTOCOL_BINARY))
+    _raw[3] = len(MESSAGE_TYPES) + 1
+    with pytest.raises(WireProtocolError):
+        decode_message(bytes(_raw))
+
+def test_unknown_value_tag():
+    _raw = bytearray(encode_message("heartbeat", "a", "b", None, protocol = PROTOCOL_BINARY))
+    _raw[-1] = 200 # The None tag
+    with pytest.raises(WireProtocolError):
+        decode_message(bytes(_raw))
+
+def test_choose_protocol():
+    assert choose_protocol([PROTOCOL_JSON, PROTOCOL_BINARY]) == PROTOCOL_BINARY
+    assert choose_protocol([PROTOCOL_JSON]) == PROTOCOL_JSON
+    assert choose_protocol(None) == PROTOCOL_JSON
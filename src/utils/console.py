@@ -1,4 +1,11 @@
 import re
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
 
 from rich.columns import Columns
 from rich.console import Console
@@ -11,33 +18,228 @@ from rich.style import StyleType
 
 console = Console()
 
+# Log levels, the same numbers the standard `logging` module uses
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+DEFAULT_RATE_LIMITS = {"ws": 20, "worker": 50, "agent": 50} # Messages per second per category on the hot paths
+DEFAULT_SAMPLE_RATES = {} # category -> share of messages kept, e.g. {"ws": 0.01}
+
+
+class LogConfig():
+    '''What gets logged and where. Defaults come from the environment so processes spawned by a Node inherit them:
+    `SOAP_LOG_LEVEL` (DEBUG, INFO, WARNING or ERROR), `SOAP_LOG_RICH` (1 for the rich output, 0 for plain lines, default is
+    whether stdout is a terminal) and `SOAP_LOG_JSON` (path of a JSON-lines file every record is also written to)'''
+
+    def __init__(self, level = None, interactive = None, json_path = None, rate_limits: dict = None, sample_rates: dict = None, queue_size = 10000):
+        _level = level if level is not None else os.environ.get("SOAP_LOG_LEVEL", "INFO")
+        self.level = _level if isinstance(_level, int) else {name: value for value, name in _LEVEL_NAMES.items()}.get(str(_level).upper(), INFO)
+        self.interactive = interactive if interactive is not None else os.environ.get("SOAP_LOG_RICH", "1" if sys.stdout.isatty() else "0") == "1"
+        self.json_path = json_path if json_path is not None else os.environ.get("SOAP_LOG_JSON") or None
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS, **(rate_limits or {}))
+        self.sample_rates = dict(DEFAULT_SAMPLE_RATES, **(sample_rates or {}))
+        self.queue_size = queue_size
+
+
+class _RateLimit():
+    '''Token bucket allowing `rate` messages per second, with bursts of up to one second's worth'''
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self.suppressed = 0 # Since the last message let through
+
+    def allow(self):
+        _now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (_now - self._last) * self.rate)
+        self._last = _now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+
+class LogWriter():
+    '''Renders log records on a background thread, so callers never wait on the terminal.
+    Records go through a bounded queue: when it is full, DEBUG and INFO records are dropped and counted, while warnings and
+    errors wait briefly for room. Categories can be rate limited and sampled before anything is queued.'''
+
+    def __init__(self, config: LogConfig):
+        self.config = config
+        self._queue = queue.Queue(maxsize = config.queue_size)
+        self._limits = {category: _RateLimit(rate) for category, rate in config.rate_limits.items() if rate}
+        self._sampled = {} # category -> messages seen, for sampling
+        self._lock = threading.Lock()
+        self._json = open(config.json_path, "a", encoding = "utf-8") if config.json_path else None
+        self.counters = {"written": 0, "dropped": 0, "rate_limited": 0, "sampled_out": 0}
+        self._thread = threading.Thread(target = self._run, name = "Thread-LogWriter", daemon = True)
+        self._thread.start()
+
+    def enabled(self, level: int):
+        return level >= self.config.level
+
+    def submit(self, level: int, category: str, text, args = (), style = "", render = None):
+        '''Queues a record. `text % args` is only formatted on the writer thread, and `render` builds a rich renderable there'''
+        if level < self.config.level:
+            return False
+        _suppressed = 0
+        with self._lock:
+            _rate = self.config.sample_rates.get(category)
+            if _rate is not None and level < WARNING:
+                _seen = self._sampled.get(category, 0)
+                self._sampled[category] = _seen + 1
+                if _rate <= 0 or _seen % max(1, round(1 / _rate)) != 0:
+                    self.counters['sampled_out'] += 1
+                    return False
+            _limit = self._limits.get(category)
+            if _limit is not None and level < WARNING:
+                if not _limit.allow():
+                    self.counters['rate_limited'] += 1
+                    return False
+                _suppressed, _limit.suppressed = _limit.suppressed, 0
+        _record = (time.time(), level, category, text, args, style, render, _suppressed)
+        try:
+            if level >= WARNING:
+                self._queue.put(_record, timeout = 0.5)
+            else:
+                self._queue.put_nowait(_record)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.counters['dropped'] += 1
+            return False
+
+    def flush(self, timeout = 2):
+        '''Waits until everything queued so far is written'''
+        _done = threading.Event()
+        try:
+            self._queue.put(_done, timeout = timeout)
+        except queue.Full:
+            return False
+        return _done.wait(timeout)
+
+    def _run(self):
+        while True:
+            _record = self._queue.get()
+            if isinstance(_record, threading.Event):
+                if self._json is not None:
+                    self._json.flush()
+                _record.set()
+                continue
+            try:
+                self._write(*_record)
+            except Exception as e:
+                sys.stderr.write(f"Couldn't write log record: {type(e).__name__}: {e}\n")
+            if self._json is not None and self._queue.empty():
+                self._json.flush()
+
+    def _write(self, created, level, category, text, args, style, render, suppressed):
+        _text = (text % args if args else text) if isinstance(text, str) else str(text)
+        if suppressed:
+            _text = f"{_text} ({suppressed} more {category} messages suppressed)"
+        if self.config.interactive:
+            console.print(render() if render is not None else _text, style = style)
+        else:
+            sys.stdout.write(f"{time.strftime('%H:%M:%S', time.localtime(created))} {_LEVEL_NAMES.get(level, level)} [{category}] {_text}\n")
+            sys.stdout.flush()
+        if self._json is not None:
+            self._json.write(json.dumps({"ts": round(created, 6), "level": _LEVEL_NAMES.get(level, level), "category": category, "pid": os.getpid(), "message": _text}) + "\n")
+        self.counters['written'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, queued = self._queue.qsize())
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+_config = None
+
+
+def configure_logging(level = None, interactive = None, json_path = None, rate_limits: dict = None, sample_rates: dict = None, queue_size = 10000):
+    '''Sets up logging for this process. Optional, the first log call configures it from the environment otherwise'''
+    global _writer, _writer_pid, _config
+    with _writer_lock:
+        _config = LogConfig(level, interactive, json_path, rate_limits, sample_rates, queue_size)
+        if _writer is not None and _writer_pid == os.getpid():
+            _writer.flush()
+        _writer = None # The next log call starts a writer with the new config
+
+
+def get_log_writer():
+    '''This process's :class:`LogWriter`. A forked process starts its own, the parent's thread doesn't come along'''
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer_pid != os.getpid():
+                _writer = LogWriter(_config or LogConfig())
+                _writer_pid = os.getpid()
+    return _writer
+
+
+def log(text, *args, level = INFO, category = "general", style = ""):
+    '''Logs `text % args` without waiting on the terminal. Formatting is deferred, so pass arguments rather than an f-string on hot paths'''
+    return get_log_writer().submit(level, category, text, args, style)
+
+
+def log_debug(text, *args, category = "general", style = ""):
+    return log(text, *args, level = DEBUG, category = category, style = style)
+
+
+def log_enabled(level: int):
+    '''Whether `level` is logged at all, to skip building expensive messages'''
+    return get_log_writer().enabled(level)
+
+
+def log_table(title, items: list, columns: list, color = "yellow", level = INFO, category = "general"):
+    '''Logs items as a table. The rich table is only built on the writer thread, and only in interactive mode'''
+    def _render():
+        table = Table(title = title)
+        for column in columns:
+            table.add_column(column)
+        for item in items:
+            table.add_row(*item, style = color)
+        return table
+
+    _text = f"{title}: " + "; ".join(", ".join(f"{column}={value}" for column, value in zip(columns, item)) for item in items)
+    return get_log_writer().submit(level, category, _text, render = _render)
+
+
+def flush_logs(timeout = 2):
+    if _writer is not None and _writer_pid == os.getpid():
+        return _writer.flush(timeout)
+    return True
+
+
+def log_stats():
+    return get_log_writer().stats()
+
+
+atexit.register(flush_logs)
+
 
 def print_markdown(text):
     """Prints a rich info message. Support Markdown syntax."""
 
-    md = Padding(Markdown(text), 2)
-    console.print(md)
+    get_log_writer().submit(INFO, "general", text, render = lambda: Padding(Markdown(text), 2))
 
 
 def print_step(text, justification='left', style =""):
     """Prints a rich info message."""
 
-    panel = Panel(Text(text, justify=justification), style=style)
-    console.print(panel)
+    get_log_writer().submit(INFO, "general", text, render = lambda: Panel(Text(text, justify=justification), style=style))
 
 
 def print_table(title, items: list, columns: list, color="yellow"):
     """Prints items in a table."""
 
-    table = Table(title = title)
-
-    for column in columns:
-        table.add_column(column)
-
-    for item in items:
-        table.add_row(*item, style = color)
-
-    console.print(table)
+    log_table(title, items = items, columns = columns, color = color)
 
 
 def make_table(title, items: list, columns: list, color="yellow"):
@@ -54,15 +256,15 @@ def make_table(title, items: list, columns: list, color="yellow"):
     return
 
 
-def print_substep(text, style=""):
+def print_substep(text, style="", level = INFO, category = "general"):
     """Prints a rich info message without the panelling."""
-    console.print(text, style=style)
+    get_log_writer().submit(level, category, text, style = style)
 
-def print_warning(text):
-    print_substep(text = f"WARNING: {text}", style = "gold3")
+def print_warning(text, category = "general"):
+    print_substep(text = f"WARNING: {text}", style = "gold3", level = WARNING, category = category)
 
-def print_error(text):
-    print_substep(text = f"ERROR: {text}", style = "red1")
+def print_error(text, category = "general"):
+    print_substep(text = f"ERROR: {text}", style = "red1", level = ERROR, category = category)
 
 def handle_input(
     message: str = "",
@@ -77,6 +279,7 @@ def handle_input(
     default=NotImplemented,
     optional=False,
 ):
+    flush_logs() # Let queued output land before the prompt
     if optional:
         console.print(
             message
@@ -1,6 +1,5 @@
 import json
 import os
-import requests
 
 def get_inference_config():
     if os.getcwd().endswith("src"):
@@ -24,11 +23,19 @@ def get_inference_config():
 
             return None
 
+def completion_text(response):
+    '''The generated text of a KoboldCpp generate response (`{"results": [{"text": ...}]}`), or the response itself when it is already text'''
+    if isinstance(response, dict):
+        return "".join(result.get('text', "") for result in response.get('results', []))
+    return response if isinstance(response, str) else ""
+
 def validate_endpoint(endpoint):
     '''Ensures an endpoint is reachable. If not, returns `False`.'''
 
+    import requests # Only needed for this check, and slow to import
+
     try:
-        r = requests.get(endpoint)
+        r = requests.get(endpoint, timeout = 5)
         return True
     except Exception as e:
         return False
\ No newline at end of file
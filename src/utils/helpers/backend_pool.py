@@ -0,0 +1,235 @@
+import time
+import asyncio
+
+from utils.helpers.constants import HTTPMethod
+from utils.helpers.inference_client import InferenceClient, InferenceError
+
+class Backend():
+    '''Health and load bookkeeping for one inference endpoint in a :class:`BackendPool`'''
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.healthy = True # Optimistic until a probe or request says otherwise
+        self.outstanding = 0 # Requests currently sent to this backend
+        self.ewma_latency = None # Seconds, smoothed over requests
+        self.probe_latency = None # Seconds, smoothed over health probes. Kept apart, a probe answers far quicker than a generation
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_probe = 0.0
+
+    def record_success(self, latency: float, alpha: float):
+        self.ewma_latency = latency if self.ewma_latency is None else alpha * latency + (1 - alpha) * self.ewma_latency
+        self.consecutive_failures = 0
+
+    def record_probe(self, latency: float, alpha: float):
+        self.probe_latency = latency if self.probe_latency is None else alpha * latency + (1 - alpha) * self.probe_latency
+        self.consecutive_failures = 0
+        self.healthy = True
+
+    def record_failure(self, eject_after: int):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= eject_after:
+            self.healthy = False
+
+    def stats(self):
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "ewma_latency": None if self.ewma_latency is None else round(self.ewma_latency, 4),
+            "probe_latency": None if self.probe_latency is None else round(self.probe_latency, 4),
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+    def __str__(self):
+        return self.endpoint
+
+class BackendPool():
+    '''Spreads inference requests over several KoboldCpp instances.
+    Each request goes to the healthy backend with the fewest outstanding requests (`least_outstanding`, ties broken by latency)
+    or the lowest smoothed latency (`ewma`). A backend that fails `eject_after` times in a row is ejected, and a background
+    probe re-admits it once it answers again. Probes have a client of their own, so they never queue behind generations.
+    A request that fails on one backend is retried on the next one, and once every backend failed it, on all of them again
+    after a backoff, `retries` times over. With a single backend that is the same retry and backoff as
+    :class:`InferenceClient`'s own.'''
+
+    STRATEGIES = ("least_outstanding", "ewma")
+
+    def __init__(self, endpoints, client: InferenceClient = None, strategy = "least_outstanding", probe_interval = 10, probe_path = "api/v1/model", probe_timeout = 3, eject_after = 3, ewma_alpha = 0.3, retries = 3):
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        assert endpoints, "A BackendPool needs at least one endpoint"
+        assert strategy in self.STRATEGIES, f"Unknown strategy {strategy}, expected one of {self.STRATEGIES}"
+
+        self.backends = [Backend(endpoint) for endpoint in endpoints]
+        self.strategy = strategy
+        self.probe_interval = probe_interval
+        self.probe_path = probe_path
+        self.probe_timeout = probe_timeout
+        self.eject_after = eject_after
+        self.ewma_alpha = ewma_alpha
+        self.retries = retries # Rounds over every backend after the first, with the client's backoff in between
+        self._client = client or InferenceClient(retries = 0) # The pool retries, over every backend instead of the same one
+        self._probe_client = InferenceClient(max_connections = 4, max_per_endpoint = 1, timeout = probe_timeout, retries = 0) # A session and limits of its own, so a backend busy generating still answers its probes
+        self._probe_task = None
+
+    def set_endpoints(self, endpoints):
+        '''Replaces the set of backends. Backends that stay keep their health and latency history'''
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        _existing = {backend.endpoint: backend for backend in self.backends}
+        self.backends = [_existing.get(endpoint) or Backend(endpoint) for endpoint in endpoints]
+
+    def __getstate__(self):
+        _state = self.__dict__.copy()
+        _state['_probe_task'] = None
+        return _state
+
+    @property
+    def is_valid(self):
+        '''`True` while at least one backend is healthy'''
+        return any(backend.healthy for backend in self.backends)
+
+    @property
+    def endpoints(self):
+        return [backend.endpoint for backend in self.backends]
+
+    def _score(self, backend: Backend):
+        _latency = backend.ewma_latency if backend.ewma_latency is not None else 0.0
+        if self.strategy == "ewma":
+            # Expected wait: every outstanding request ahead of us takes about one latency
+            return ((backend.outstanding + 1) * _latency, backend.outstanding)
+        return (backend.outstanding, _latency)
+
+    def pick(self, exclude = (), max_outstanding: int = None):
+        '''Returns the best backend to send the next request to, or `None` when every candidate is excluded or full.
+        Ejected backends are only used when no healthy one is left.'''
+        _candidates = [b for b in self.backends if b not in exclude and (max_outstanding is None or b.outstanding < max_outstanding)]
+        _healthy = [b for b in _candidates if b.healthy]
+        _pool = _healthy or _candidates
+        if not _pool:
+            return None
+        return min(_pool, key = self._score)
+
+    def capacity(self, max_outstanding: int):
+        '''How many more requests fit on healthy backends at `max_outstanding` each'''
+        return sum(max(0, max_outstanding - b.outstanding) for b in self.backends if b.healthy)
+
+    def backend_for(self, endpoint: str):
+        '''The :class:`Backend` of `endpoint`, or a new one outside the pool when it isn't one of its backends'''
+        return next((backend for backend in self.backends if backend.endpoint == endpoint), None) or Backend(endpoint)
+
+    async def _candidates(self, backend: Backend = None, max_outstanding: int = None, failover = True):
+        '''Yields the backends to try a request on in turn: each one once, best first, then every one again after a backoff,
+        `retries` times over. `backend` goes first if given, and is the only one tried without `failover`.
+        Backends with `max_outstanding` requests already are skipped'''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self._client.backoff_delay(attempt - 1))
+            if not failover:
+                yield backend
+                continue
+            _tried = []
+            _backend = backend if attempt == 0 and backend is not None else self.pick(max_outstanding = max_outstanding)
+            while _backend is not None:
+                _tried.append(_backend)
+                yield _backend
+                _backend = self.pick(exclude = _tried, max_outstanding = max_outstanding)
+
+    def _exhausted(self, failed: list, error):
+        if not failed:
+            return InferenceError("No backend had room for the request")
+        return InferenceError(f"Every backend failed ({', '.join(dict.fromkeys(map(str, failed)))}): {error}")
+
+    async def request(self, method: HTTPMethod, path: str, body = None, backend: Backend = None, max_outstanding: int = None):
+        '''Sends a request, failing over to the remaining backends when one is unreachable or errors'''
+        _failed = []
+        _last_error = None
+        async for _backend in self._candidates(backend, max_outstanding):
+            _backend.outstanding += 1
+            _backend.requests += 1
+            _start = time.perf_counter()
+            try:
+                _result = await self._client.request(method, _backend.endpoint, path, body)
+                _backend.record_success(time.perf_counter() - _start, self.ewma_alpha)
+                return _result
+            except InferenceError as e:
+                if not e.retriable:
+                    raise
+                _backend.record_failure(self.eject_after)
+                _failed.append(_backend)
+                _last_error = e
+            finally:
+                _backend.outstanding -= 1
+
+        raise self._exhausted(_failed, _last_error)
+
+    async def post(self, path: str, body = None):
+        return await self.request(HTTPMethod.POST, path, body)
+
+    async def get(self, path: str, body = None):
+        return await self.request(HTTPMethod.GET, path, body)
+
+    async def stream(self, path: str, body = None, backend: Backend = None, max_outstanding: int = None, failover = True):
+        '''Streams tokens from one backend. Fails over to another backend only if no token has been yielded yet.
+        Without `failover` only `backend` is used, as when the :class:`InferenceScheduler` gave out a slot on it'''
+        _failed = []
+        _last_error = None
+        async for _backend in self._candidates(backend, max_outstanding, failover = failover):
+            _backend.outstanding += 1
+            _backend.requests += 1
+            _start = time.perf_counter()
+            _first = True
+            try:
+                async for token in self._client.stream(_backend.endpoint, path, body):
+                    if _first:
+                        _backend.record_success(time.perf_counter() - _start, self.ewma_alpha) # Time to first token
+                        _first = False
+                    yield token
+                return
+            except InferenceError as e:
+                if not e.retriable or not _first:
+                    raise
+                _backend.record_failure(self.eject_after)
+                _failed.append(_backend)
+                _last_error = e
+            finally:
+                _backend.outstanding -= 1
+
+        raise self._exhausted(_failed, _last_error)
+
+    async def probe(self, backend: Backend):
+        '''Checks one backend and updates its health and probe latency. Ejected backends are re-admitted here'''
+        _start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._probe_client.get(backend.endpoint, self.probe_path), self.probe_timeout)
+            backend.record_probe(time.perf_counter() - _start, self.ewma_alpha)
+        except (InferenceError, asyncio.TimeoutError):
+            backend.record_failure(self.eject_after)
+        backend.last_probe = time.time()
+        return backend.healthy
+
+    async def probe_all(self):
+        return await asyncio.gather(*[self.probe(backend) for backend in self.backends])
+
+    async def _probe_loop(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self):
+        '''Starts probing in the background of the running event loop'''
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        await self._client.close()
+        await self._probe_client.close()
+
+    def stats(self):
+        return {backend.endpoint: backend.stats() for backend in self.backends}
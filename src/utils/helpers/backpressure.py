@@ -0,0 +1,83 @@
+import time
+
+from collections import deque
+
+class Backpressure():
+    '''Admission control for a bounded queue, with hysteresis. Producers are turned away once the queue reaches the high watermark
+    (`high` x `capacity`) and admitted again only after it drained to the low watermark (`low` x `capacity`), so a queue at its
+    limit doesn't flap between accepting and rejecting every other item. Rejected producers are told when to retry
+    (:meth:`retry_after`), estimated from how fast the queue has been draining.
+    Tracks how long admission was closed in total, which is the time producers spent blocked.'''
+
+    def __init__(self, capacity: int, high = 0.9, low = 0.7, min_retry = 0.5, max_retry = 30.0, window = 256):
+        assert 0 < low <= high <= 1, "Need 0 < low <= high <= 1"
+        self.capacity = capacity
+        self.high_watermark = max(1, int(capacity * high))
+        self.low_watermark = max(0, min(self.high_watermark - 1, int(capacity * low))) # Always below the high one, even for tiny queues
+        self.min_retry = min_retry
+        self.max_retry = max_retry
+        self.open = True
+        self.depth = 0 # As of the last update
+        self._closed_at = None
+        self._blocked_seconds = 0.0
+        self._drained = deque(maxlen = window) # Recent times an item left the queue, for the drain rate
+        self.counters = {"admitted": 0, "rejected": 0, "closed": 0}
+
+    def update(self, depth: int):
+        '''Moves between open and closed for the current `depth`. Returns whether the queue is open'''
+        self.depth = depth
+        if self.open and depth >= self.high_watermark:
+            self.open = False
+            self._closed_at = time.perf_counter()
+            self.counters['closed'] += 1
+        elif not self.open and depth <= self.low_watermark:
+            self.open = True
+            self._blocked_seconds += time.perf_counter() - self._closed_at
+            self._closed_at = None
+        return self.open
+
+    def admit(self, depth: int, count = 1):
+        '''Whether `count` more items may join a queue holding `depth`. Counts them as admitted or rejected'''
+        if self.update(depth) and depth + count <= self.capacity:
+            self.counters['admitted'] += count
+            return True
+        self.counters['rejected'] += count
+        return False
+
+    def drained(self, count = 1):
+        '''Records `count` items leaving the queue'''
+        _now = time.perf_counter()
+        for _ in range(min(count, self._drained.maxlen)):
+            self._drained.append(_now)
+
+    def drain_rate(self):
+        '''Items per second leaving the queue lately, 0 when unknown'''
+        if len(self._drained) < 2:
+            return 0.0
+        _span = time.perf_counter() - self._drained[0]
+        return len(self._drained) / _span if _span > 0 else 0.0
+
+    def retry_after(self):
+        '''Seconds a rejected producer should wait: the time to drain down to the low watermark at the recent rate.
+        `min_retry` as long as nothing drained yet, the next rejection has a better estimate'''
+        _rate = self.drain_rate()
+        if _rate <= 0:
+            return self.min_retry
+        return round(min(self.max_retry, max(self.min_retry, (self.depth - self.low_watermark) / _rate)), 3)
+
+    @property
+    def blocked_seconds(self):
+        '''Total time admission was closed, including the current stretch'''
+        return self._blocked_seconds + (time.perf_counter() - self._closed_at if self._closed_at is not None else 0.0)
+
+    def stats(self):
+        return dict(
+            self.counters,
+            capacity = self.capacity,
+            depth = self.depth,
+            high_watermark = self.high_watermark,
+            low_watermark = self.low_watermark,
+            open = self.open,
+            blocked_seconds = round(self.blocked_seconds, 3),
+            drain_rate = round(self.drain_rate(), 3)
+        )
@@ -0,0 +1,164 @@
+import time
+import threading
+
+class _PooledBrowser():
+    def __init__(self, browser):
+        self.browser = browser
+        self.active = 0 # Leases currently out on this browser
+        self.leases = 0 # Leases handed out over the browser's lifetime
+        self.retiring = False
+
+class BrowserLease():
+    '''An isolated context (tab or browser context) on a pooled browser. Hand it back with :meth:`BrowserPool.release`, or use it as a context manager.'''
+
+    def __init__(self, pool, pooled: _PooledBrowser, context):
+        self._pool = pool
+        self._pooled = pooled
+        self.browser = pooled.browser
+        self.context = context
+        self.leased_at = time.perf_counter()
+
+    def release(self):
+        self._pool.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class BrowserPool():
+    '''Keeps `size` browsers warm so a :class:`Worker` can start on a task without waiting on a browser cold start.
+    Workers lease an isolated context, and leasing blocks once every browser is busy, so memory is bounded by the pool size
+    rather than by the number of workers. A browser is recycled after `max_leases_per_browser` leases to contain leaks.
+    Thread-safe: every :class:`Worker` thread of an :class:`Agent` process shares the same pool.
+    `factory` launches and quits browsers and opens and closes contexts on them, see `SeleniumBrowserFactory` and `PlaywrightBrowserFactory`.'''
+
+    def __init__(self, factory, size = 2, max_leases_per_browser = 50):
+        self.size = size
+        self.max_leases_per_browser = max_leases_per_browser
+        self.factory = factory
+        self._browsers = []
+        self._launching = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._launch_error = None # Last launch failure, surfaced to waiting leases instead of relaunching forever
+        self.counters = {"leases": 0, "launches": 0, "recycled": 0, "wait_seconds": 0.0}
+
+    def warm(self, wait = False):
+        '''Launches browsers until the pool is full. Launches run in parallel on background threads'''
+        with self._cond:
+            _missing = self.size - len(self._browsers) - self._launching
+            self._launching += max(0, _missing)
+        _threads = [threading.Thread(target = self._launch, name = "Thread-BrowserPoolWarm", daemon = True) for _ in range(max(0, _missing))]
+        for thread in _threads:
+            thread.start()
+        if wait:
+            for thread in _threads:
+                thread.join()
+
+    def _launch(self):
+        try:
+            _browser = self.factory.launch()
+        except Exception as e:
+            with self._cond:
+                self._launching -= 1
+                self._launch_error = e
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._launching -= 1
+            self.counters['launches'] += 1
+            self._launch_error = None
+            if self._closed:
+                self.factory.quit(_browser)
+            else:
+                self._browsers.append(_PooledBrowser(_browser))
+            self._cond.notify_all()
+
+    def _free_browser(self):
+        _capacity = self.factory.contexts_per_browser
+        _free = [b for b in self._browsers if not b.retiring and b.active < _capacity]
+        return min(_free, key = lambda b: b.active) if _free else None
+
+    def lease(self, timeout: float = None):
+        '''Blocks until a context is free and returns a :class:`BrowserLease`. Raises `TimeoutError` after `timeout` seconds'''
+        _start = time.perf_counter()
+        _deadline = None if timeout is None else _start + timeout
+        with self._cond:
+            while True:
+                assert not self._closed, "BrowserPool is closed"
+                _pooled = self._free_browser()
+                if _pooled is not None:
+                    break
+                if self._launch_error is not None and not self._browsers and not self._launching:
+                    _error, self._launch_error = self._launch_error, None
+                    raise RuntimeError(f"BrowserPool couldn't launch a browser: {_error}")
+                if len(self._browsers) + self._launching < self.size:
+                    self._launching += 1
+                    threading.Thread(target = self._launch, name = "Thread-BrowserPoolLaunch", daemon = True).start()
+                _remaining = None if _deadline is None else _deadline - time.perf_counter()
+                if _remaining is not None and _remaining <= 0:
+                    raise TimeoutError(f"No browser became free within {timeout} seconds")
+                self._cond.wait(_remaining)
+
+            _pooled.active += 1
+            _pooled.leases += 1
+            self.counters['leases'] += 1
+            self.counters['wait_seconds'] += time.perf_counter() - _start
+
+        try:
+            _context = self.factory.open_context(_pooled.browser)
+        except Exception:
+            with self._cond:
+                _pooled.active -= 1
+                self._cond.notify_all()
+            raise
+        return BrowserLease(self, _pooled, _context)
+
+    def release(self, lease: BrowserLease):
+        '''Returns a context to the pool, recycling its browser once it has served enough leases'''
+        _pooled = lease._pooled
+        try:
+            self.factory.close_context(_pooled.browser, lease.context)
+        except Exception:
+            _pooled.retiring = True # A browser that can't clean up after itself isn't reused
+
+        _quit = False
+        with self._cond:
+            _pooled.active -= 1
+            if _pooled.leases >= self.max_leases_per_browser:
+                _pooled.retiring = True
+            if _pooled.retiring and _pooled.active == 0:
+                self._browsers.remove(_pooled)
+                self.counters['recycled'] += 1
+                _quit = True
+            self._cond.notify_all()
+
+        if _quit:
+            self.warm() # Replace it in the background
+            threading.Thread(target = self.factory.quit, args = (_pooled.browser,), name = "Thread-BrowserPoolQuit", daemon = True).start()
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counters, browsers = len(self._browsers), launching = self._launching, active = sum(b.active for b in self._browsers), size = self.size)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            _browsers, self._browsers = self._browsers, []
+            self._cond.notify_all()
+        for pooled in _browsers:
+            self.factory.quit(pooled.browser)
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def get_browser_pool(factory, **kwargs):
+    '''Returns this process's shared :class:`BrowserPool`, creating it from `factory` and `kwargs` on first use'''
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = BrowserPool(factory, **kwargs)
+        return _shared_pool
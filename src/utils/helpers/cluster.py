@@ -0,0 +1,161 @@
+import time
+import heapq
+import uuid
+
+from collections import OrderedDict
+
+from utils.helpers.constants import TaskPriority
+from utils.helpers.wire_protocol import pack_object
+
+class NodeCapacity():
+    '''What a client :class:`Node` last reported about itself to the host'''
+
+    def __init__(self, name: str, report: dict = None):
+        self.name = name
+        self.slots = 0 # Tasks its agents take at once, counting their prefetch window
+        self.held = 0 # Tasks it holds, whoever sent them
+        self.max_agents = 0
+        self.agents = 0
+        self.cpu_count = 1
+        self.cpu_percent = 0.0
+        self.total_memory = 0.0 # GB
+        self.available_memory = 0.0 # GB
+        self.reported_at = 0.0
+        self.paused_until = 0.0 # Set when it turned a task away with queue_full, nothing is placed on it before then
+        self.assigned = OrderedDict() # cluster task_id -> entry the host placed on this node
+        self.completed = 0
+        if report:
+            self.update(report)
+
+    def update(self, report: dict):
+        for field in ("slots", "held", "max_agents", "agents", "cpu_count", "cpu_percent", "total_memory", "available_memory"):
+            if report.get(field) is not None:
+                setattr(self, field, report[field])
+        self.reported_at = time.time()
+
+    @property
+    def free_slots(self):
+        # The host's own count is fresher than the last report for the tasks it placed itself
+        return max(0, self.slots - max(self.held, len(self.assigned)))
+
+    def resource_factor(self):
+        '''Between 0.25 and 1. A node short on CPU or memory gets proportionally fewer tasks per free slot'''
+        _cpu = 1 - 0.5 * min(1.0, self.cpu_percent / 100)
+        _memory = 0.5 + 0.5 * (self.available_memory / self.total_memory) if self.total_memory else 1.0
+        return _cpu * _memory
+
+    def weight(self):
+        return self.free_slots * self.resource_factor()
+
+    def stats(self):
+        return {"slots": self.slots, "free_slots": self.free_slots, "assigned": len(self.assigned), "completed": self.completed, "agents": self.agents, "cpu_percent": self.cpu_percent, "available_memory": self.available_memory, "weight": round(self.weight(), 3)}
+
+class _ClusterTask():
+    def __init__(self, item, priority: TaskPriority, deadline: float, seq: int):
+        self.task_id = uuid.uuid4().hex
+        self.item = item
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+        self.node = None
+
+    def __lt__(self, other):
+        return (self.priority.value, self.deadline or float("inf"), self.seq) < (other.priority.value, other.deadline or float("inf"), other.seq)
+
+class ClusterManager():
+    '''Runs on the host :class:`Node` (`NodeType.SERVER`). Client nodes join over websocket and report their capacity,
+    and every task submitted to the host is placed on the client node with the highest weight: its free agent slots scaled
+    by how much CPU and memory it has to spare. Tasks wait on the host while no node has a free slot. When a node leaves,
+    or stops reporting for `report_timeout` seconds, the tasks placed on it go back in line for the other nodes.
+    `send(target, type, data)` delivers a message to a node and returns the number of recipients.'''
+
+    def __init__(self, send, report_timeout = 30):
+        self._send = send
+        self.report_timeout = report_timeout
+        self.nodes = {} # name -> NodeCapacity
+        self._pending = [] # Heap of tasks not placed on any node
+        self._seq = 0
+        self.counters = {"submitted": 0, "placed": 0, "completed": 0, "failed": 0, "rebalanced": 0, "rejected": 0, "nodes_joined": 0, "nodes_left": 0}
+
+    def join(self, name: str, report: dict):
+        '''Adds a node, or refreshes the capacity of one that already joined'''
+        if name in self.nodes:
+            self.nodes[name].update(report)
+        else:
+            self.nodes[name] = NodeCapacity(name, report)
+            self.counters['nodes_joined'] += 1
+
+    def leave(self, name: str):
+        '''Drops a node and puts the tasks it still held back in line. Returns how many were rebalanced'''
+        _node = self.nodes.pop(name, None)
+        if _node is None:
+            return 0
+        self.counters['nodes_left'] += 1
+        for task in _node.assigned.values():
+            task.node = None
+            heapq.heappush(self._pending, task)
+        self.counters['rebalanced'] += len(_node.assigned)
+        return len(_node.assigned)
+
+    def expire(self):
+        '''Drops nodes that went quiet without disconnecting. Returns the names dropped'''
+        _cutoff = time.time() - self.report_timeout
+        _stale = [name for name, capacity in self.nodes.items() if capacity.reported_at < _cutoff]
+        for name in _stale:
+            self.leave(name)
+        return _stale
+
+    def submit(self, item, priority: TaskPriority = None, deadline: float = None):
+        '''Queues a task for placement and returns its cluster id. Call :meth:`pump` afterwards to place it'''
+        self._seq += 1
+        _task = _ClusterTask(item, priority if priority is not None else TaskPriority.NORMAL, deadline, self._seq)
+        heapq.heappush(self._pending, _task)
+        self.counters['submitted'] += 1
+        return _task.task_id
+
+    def done(self, name: str, task_id: str, ok = True):
+        _node = self.nodes.get(name)
+        if _node is None or _node.assigned.pop(task_id, None) is None:
+            return
+        _node.completed += 1
+        self.counters['completed' if ok else 'failed'] += 1
+
+    def rejected(self, name: str, task_id: str, retry_after: float):
+        '''The node's queue was full. The task goes back in line and the node gets nothing more for `retry_after` seconds'''
+        _node = self.nodes.get(name)
+        if _node is None:
+            return
+        _node.paused_until = time.time() + retry_after
+        _task = _node.assigned.pop(task_id, None)
+        if _task is not None:
+            _task.node = None
+            heapq.heappush(self._pending, _task)
+            self.counters['rejected'] += 1
+
+    def backlog(self):
+        '''Tasks on the host, waiting or placed and not done yet'''
+        return len(self._pending) + sum(len(capacity.assigned) for capacity in self.nodes.values())
+
+    def pick_node(self):
+        _now = time.time()
+        _candidates = [capacity for capacity in self.nodes.values() if capacity.free_slots > 0 and capacity.paused_until <= _now]
+        if not _candidates:
+            return None
+        return max(_candidates, key = lambda capacity: (capacity.weight(), -len(capacity.assigned)))
+
+    async def pump(self):
+        '''Places pending tasks while some node has a free slot'''
+        while self._pending:
+            _node = self.pick_node()
+            if _node is None:
+                return
+            _task = heapq.heappop(self._pending)
+            _task.node = _node.name
+            _node.assigned[_task.task_id] = _task
+            self.counters['placed'] += 1
+            _data = {"item": pack_object(_task.item), "cluster_task_id": _task.task_id, "priority": _task.priority.value, "deadline": _task.deadline}
+            if not await self._send(_node.name, "node_add_queue_item", _data):
+                self.leave(_node.name)
+
+    def stats(self):
+        return dict(self.counters, pending = len(self._pending), nodes = {name: capacity.stats() for name, capacity in self.nodes.items()})
@@ -1,5 +1,12 @@
 from enum import Enum
 
+DEFAULT_NODE_HOST = "localhost"
+DEFAULT_NODE_PORT = 5002 # Where a Node serves its Agents and Workers
+DEFAULT_HOST_PORT = 5100 # Where a host Node (NodeType.SERVER) accepts client Nodes
+
+def node_url(host: str = DEFAULT_NODE_HOST, port: int = DEFAULT_NODE_PORT):
+    return f"ws://{host}:{port}"
+
 class NodeType(Enum):
     AGENTLESS = 0
     SERVER = 1
@@ -25,4 +32,16 @@ class WorkerState(Enum):
     SCREENSHOTTING = 5
     GOING = 6
     CLICKING = 7
-    TYPING = 8
\ No newline at end of file
+    TYPING = 8
+
+# Scheduling class of an inference request. Lower values are served first
+class InferencePriority(Enum):
+    HIGH = 0 # Short planning prompts
+    NORMAL = 1
+    LOW = 2 # Long, throughput oriented generations
+
+# Dispatch class of a task on the Node. Lower values are dispatched first
+class TaskPriority(Enum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
@@ -0,0 +1,213 @@
+import os
+import time
+import queue
+import uuid
+import pickle
+import sqlite3
+import threading
+
+class QueueLease():
+    '''A task taken off a :class:`DurableQueue`. It stays invisible to other consumers until `visible_at`, and comes back
+    unless it is acked before then'''
+
+    def __init__(self, id, item, priority, deadline, deliveries, lease_token, visible_at):
+        self.id = id
+        self.item = item
+        self.priority = priority
+        self.deadline = deadline
+        self.deliveries = deliveries # 1 on the first delivery
+        self.lease_token = lease_token
+        self.visible_at = visible_at
+
+class DurableQueue():
+    '''Crash-safe task queue kept in SQLite in WAL mode, so the backlog and what is in flight survive a restart of the process.
+    Tasks come out in priority, deadline, arrival order. Taking tasks leases them for `visibility_timeout` seconds. A task that
+    isn't acked in time is delivered again, and one delivered `max_deliveries` times without an ack is parked as dead instead.
+    `put_many`, `put_entries`, `lease` and `ack` work on batches in a single transaction each, which is what keeps throughput
+    in the thousands of tasks per second. Acked rows are deleted, and the file is compacted every `compact_every` acks.
+    Items are pickled, so only open files you trust. Thread-safe, and several processes can share one file.'''
+
+    READY = 0
+    LEASED = 1
+    DEAD = 2
+
+    def __init__(self, path = "../cache/task_queue.db", visibility_timeout = 300, max_deliveries = 5, compact_every = 5000):
+        self.path = path # ":memory:" keeps it in this process only
+        self.visibility_timeout = visibility_timeout
+        self.max_deliveries = max_deliveries
+        self.compact_every = compact_every
+        self.counters = {"enqueued": 0, "delivered": 0, "redelivered": 0, "acked": 0, "released": 0, "dead": 0, "compactions": 0}
+        self._acks_since_compaction = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    def __getstate__(self):
+        # The connection stays behind, each process opens its own
+        _state = self.__dict__.copy()
+        _state['_db'] = None
+        _state['_lock'] = None
+        return _state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_db(self):
+        if self._db is None:
+            _dir = os.path.dirname(self.path)
+            if _dir and self.path != ":memory:":
+                os.makedirs(_dir, exist_ok = True)
+            self._db = sqlite3.connect(self.path, timeout = 10, check_same_thread = False, isolation_level = None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL") # Durable across process crashes. Only an OS crash can lose the last commits
+            self._db.execute("CREATE TABLE IF NOT EXISTS task_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, item BLOB NOT NULL, priority INTEGER NOT NULL, deadline REAL, state INTEGER NOT NULL, visible_at REAL NOT NULL, deliveries INTEGER NOT NULL DEFAULT 0, lease_token TEXT, enqueued_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS task_queue_order ON task_queue (state, priority, deadline, id)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS task_queue_leases ON task_queue (state, visible_at)")
+        return self._db
+
+    def put(self, item, priority: int = 1, deadline: float = None):
+        '''Enqueues one task and returns its id'''
+        return self.put_many([item], priority, deadline)[0]
+
+    def put_many(self, items: list, priority: int = 1, deadline: float = None):
+        '''Enqueues `items` in one transaction and returns their ids in order'''
+        return self.put_entries([(item, priority, deadline) for item in items])
+
+    def put_entries(self, entries: list):
+        '''Enqueues `(item, priority, deadline)` tuples of their own priority and deadline in one transaction, and returns their ids in order'''
+        _now = time.time()
+        _rows = [(pickle.dumps(item, pickle.HIGHEST_PROTOCOL), priority, deadline, self.READY, _now, _now) for item, priority, deadline in entries]
+        with self._lock:
+            _db = self._get_db()
+            _db.execute("BEGIN IMMEDIATE")
+            try:
+                _db.executemany("INSERT INTO task_queue (item, priority, deadline, state, visible_at, enqueued_at) VALUES (?, ?, ?, ?, ?, ?)", _rows)
+                _last = _db.execute("SELECT last_insert_rowid()").fetchone()[0]
+                _db.execute("COMMIT")
+            except BaseException:
+                _db.execute("ROLLBACK")
+                raise
+            self.counters['enqueued'] += len(_rows)
+        # AUTOINCREMENT ids of one transaction are consecutive
+        return list(range(_last - len(_rows) + 1, _last + 1)) if _rows else []
+
+    def lease(self, max_items: int = 1, visibility_timeout: float = None):
+        '''Takes up to `max_items` ready tasks, including leased ones whose lease ran out, and returns them as :class:`QueueLease`'s'''
+        _now = time.time()
+        _timeout = visibility_timeout if visibility_timeout is not None else self.visibility_timeout
+        _token = uuid.uuid4().hex
+        with self._lock:
+            _db = self._get_db()
+            _db.execute("BEGIN IMMEDIATE")
+            try:
+                # Tasks that ran out of deliveries are parked instead of being handed out forever
+                _dead = _db.execute("UPDATE task_queue SET state = ? WHERE state = ? AND visible_at <= ? AND deliveries >= ?", (self.DEAD, self.LEASED, _now, self.max_deliveries)).rowcount
+                _rows = _db.execute(
+                    "SELECT id, item, priority, deadline, deliveries FROM task_queue WHERE state IN (?, ?) AND visible_at <= ? ORDER BY priority, deadline IS NULL, deadline, id LIMIT ?",
+                    (self.READY, self.LEASED, _now, max_items)
+                ).fetchall()
+                _db.executemany("UPDATE task_queue SET state = ?, visible_at = ?, deliveries = deliveries + 1, lease_token = ? WHERE id = ?", [(self.LEASED, _now + _timeout, _token, row[0]) for row in _rows])
+                _db.execute("COMMIT")
+            except BaseException:
+                _db.execute("ROLLBACK")
+                raise
+            self.counters['dead'] += max(_dead, 0)
+            self.counters['delivered'] += len(_rows)
+            self.counters['redelivered'] += sum(1 for row in _rows if row[4] > 0)
+        return [QueueLease(row[0], pickle.loads(row[1]), row[2], row[3], row[4] + 1, _token, _now + _timeout) for row in _rows]
+
+    def get(self, block = True, timeout: float = None, poll_interval = 0.05):
+        '''`multiprocessing.Queue` style single get. Returns a :class:`QueueLease`, which still has to be acked'''
+        _deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            _leases = self.lease(1)
+            if _leases:
+                return _leases[0]
+            if not block or (_deadline is not None and time.perf_counter() >= _deadline):
+                raise queue.Empty
+            time.sleep(poll_interval)
+
+    def ack(self, ids):
+        '''Marks tasks done and removes them. Returns how many were still in the queue'''
+        _ids = [ids] if isinstance(ids, int) else list(ids)
+        with self._lock:
+            _db = self._get_db()
+            _db.execute("BEGIN IMMEDIATE")
+            try:
+                _removed = _db.executemany("DELETE FROM task_queue WHERE id = ?", [(id,) for id in _ids]).rowcount
+                _db.execute("COMMIT")
+            except BaseException:
+                _db.execute("ROLLBACK")
+                raise
+            self.counters['acked'] += _removed
+            self._acks_since_compaction += _removed
+            _compact = self.compact_every and self._acks_since_compaction >= self.compact_every
+        if _compact:
+            self.compact()
+        return _removed
+
+    def release(self, ids, delay: float = 0):
+        '''Hands leased tasks back so they can be taken again after `delay` seconds, without counting as a failed delivery'''
+        _ids = [ids] if isinstance(ids, int) else list(ids)
+        _visible_at = time.time() + delay
+        with self._lock:
+            _db = self._get_db()
+            _db.execute("BEGIN IMMEDIATE")
+            try:
+                _db.executemany("UPDATE task_queue SET state = ?, visible_at = ?, deliveries = MAX(0, deliveries - 1), lease_token = NULL WHERE id = ? AND state = ?", [(self.READY, _visible_at, id, self.LEASED) for id in _ids])
+                _db.execute("COMMIT")
+            except BaseException:
+                _db.execute("ROLLBACK")
+                raise
+            self.counters['released'] += len(_ids)
+
+    def release_all(self):
+        '''Makes every leased task ready again. For the single consumer of a queue to call after a restart, since nothing it leased before is still being worked on'''
+        with self._lock:
+            return self._get_db().execute("UPDATE task_queue SET state = ?, visible_at = ?, lease_token = NULL WHERE state = ?", (self.READY, time.time(), self.LEASED)).rowcount
+
+    def extend(self, ids, visibility_timeout: float = None):
+        '''Pushes the lease of tasks that are still being worked on further out'''
+        _ids = [ids] if isinstance(ids, int) else list(ids)
+        _visible_at = time.time() + (visibility_timeout if visibility_timeout is not None else self.visibility_timeout)
+        with self._lock:
+            _db = self._get_db()
+            _db.execute("BEGIN IMMEDIATE")
+            try:
+                _db.executemany("UPDATE task_queue SET visible_at = ? WHERE id = ? AND state = ?", [(_visible_at, id, self.LEASED) for id in _ids])
+                _db.execute("COMMIT")
+            except BaseException:
+                _db.execute("ROLLBACK")
+                raise
+
+    def compact(self):
+        '''Folds the WAL back into the database and gives the pages freed by acked tasks back to the file system'''
+        with self._lock:
+            _db = self._get_db()
+            _db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            _pages = _db.execute("PRAGMA page_count").fetchone()[0]
+            _free = _db.execute("PRAGMA freelist_count").fetchone()[0]
+            if _pages and _free / _pages > 0.5:
+                _db.execute("VACUUM")
+            self._acks_since_compaction = 0
+            self.counters['compactions'] += 1
+
+    def purge_dead(self):
+        '''Drops the tasks parked as dead and returns how many there were'''
+        with self._lock:
+            return self._get_db().execute("DELETE FROM task_queue WHERE state = ?", (self.DEAD,)).rowcount
+
+    def qsize(self):
+        '''Tasks not yet acked, counting leased ones'''
+        with self._lock:
+            return self._get_db().execute("SELECT COUNT(*) FROM task_queue WHERE state != ?", (self.DEAD,)).fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            _states = dict(self._get_db().execute("SELECT state, COUNT(*) FROM task_queue GROUP BY state").fetchall())
+        return dict(self.counters, ready = _states.get(self.READY, 0), leased = _states.get(self.LEASED, 0), dead_parked = _states.get(self.DEAD, 0))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
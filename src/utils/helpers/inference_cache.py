@@ -0,0 +1,258 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+NON_SAMPLING_FIELDS = {"prompt", "quiet"} # Body fields that don't change what the model generates
+
+def normalize_prompt(prompt: str):
+    '''Collapses insignificant whitespace so prompts that only differ in spacing share a cache entry'''
+    _lines = [re.sub(r"[ \t]+", " ", line).strip() for line in prompt.strip().splitlines()]
+    return "\n".join(_lines)
+
+def cache_key(prompt: str, config: dict = None):
+    '''Hash of the normalized prompt and every sampling field of the generate body, so changing e.g. `temperature` or `top_k` misses'''
+    _sampling = {k: v for k, v in (config or {}).items() if k not in NON_SAMPLING_FIELDS}
+    _material = json.dumps({"prompt": normalize_prompt(prompt), "sampling": _sampling}, sort_keys = True)
+    return hashlib.sha256(_material.encode("utf-8")).hexdigest()
+
+def is_deterministic(config: dict = None):
+    '''Greedy sampling always gives the same completion for the same prompt'''
+    _config = config or {}
+    return _config.get("temperature", 1) == 0 or _config.get("top_k", 0) == 1
+
+class InferenceCache():
+    '''Two tier cache of generate responses. Lookups hit an in-process LRU first, then an SQLite store on disk
+    that is shared by every :class:`Agent` process on the machine. Both tiers expire entries after `ttl` seconds
+    and evict least recently used entries once they grow past their size limits, the disk tier down to 90% of them in one go.
+    With `deterministic_only`, requests using non-greedy sampling always bypass the cache: a sampled completion is one draw,
+    serving it for every later identical prompt would make the sampling pointless.
+    :meth:`aget` and :meth:`aput` are for event loops: they run the disk tier on a thread, so a store locked by another
+    process only holds up the lookup waiting on it.'''
+
+    def __init__(self, path = "../cache/inference_cache.db", max_memory_entries = 256, max_disk_entries = 10000, max_disk_bytes = 256 * 1024 * 1024, ttl = 24 * 3600, deterministic_only = True, purge_interval = 256):
+        self.path = path # None keeps the cache in memory only
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.deterministic_only = deterministic_only
+        self.purge_interval = purge_interval # Puts between sweeps of expired entries off the disk tier
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "expired": 0, "evicted": 0, "stores": 0}
+        self._memory = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock() # Guards the memory tier
+        self._db_lock = threading.Lock() # Guards the connection, used from whichever thread runs the disk tier
+        self._db = None
+        self._disk_count = 0 # Running totals of the disk tier, recounted whenever it is swept
+        self._disk_bytes = 0
+        self._puts = 0
+
+    def __getstate__(self):
+        # The connection stays behind, each process opens its own
+        _state = self.__dict__.copy()
+        _state['_db'] = None
+        _state['_lock'] = None
+        _state['_db_lock'] = None
+        return _state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+    def _get_db(self):
+        if self._db is None and self.path is not None:
+            _dir = os.path.dirname(self.path)
+            if _dir:
+                os.makedirs(_dir, exist_ok = True)
+            self._db = sqlite3.connect(self.path, timeout = 5, check_same_thread = False, isolation_level = None)
+            self._db.execute("PRAGMA journal_mode=WAL") # Lets agent processes read while another writes
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS inference_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS inference_cache_last_used ON inference_cache (last_used)")
+            self._recount(self._db)
+        return self._db
+
+    def _recount(self, db):
+        self._disk_count, self._disk_bytes = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM inference_cache").fetchone()
+
+    def _should_bypass(self, config, bypass):
+        return bypass or (self.deterministic_only and not is_deterministic(config))
+
+    def _lookup(self, prompt, config, bypass):
+        '''The key to look up, or `None` when the request bypasses the cache'''
+        if self._should_bypass(config, bypass):
+            self.counters['bypassed'] += 1
+            return None
+        return cache_key(prompt, config)
+
+    def _memory_get(self, key, now):
+        with self._lock:
+            _entry = self._memory.get(key)
+            if _entry is None:
+                return None
+            if _entry[0] > now:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return _entry[1]
+            del self._memory[key]
+            self.counters['expired'] += 1
+            return None
+
+    def _disk_get(self, key, now):
+        with self._db_lock:
+            _db = self._get_db()
+            if _db is None:
+                return None
+            _row = _db.execute("SELECT value, expires_at, size FROM inference_cache WHERE key = ?", (key,)).fetchone()
+            if _row is None:
+                return None
+            if _row[1] <= now:
+                _db.execute("DELETE FROM inference_cache WHERE key = ?", (key,))
+                self._disk_count -= 1
+                self._disk_bytes -= _row[2]
+                self.counters['expired'] += 1
+                return None
+            _db.execute("UPDATE inference_cache SET last_used = ? WHERE key = ?", (now, key))
+        _value = json.loads(_row[0])
+        self._remember(key, _row[1], _value) # Promote to the memory tier
+        self.counters['disk_hits'] += 1
+        return _value
+
+    def get(self, prompt: str, config: dict = None, bypass = False):
+        '''Returns the cached response for this prompt and sampling config, or `None` on a miss'''
+        _key = self._lookup(prompt, config, bypass)
+        if _key is None:
+            return None
+        _now = time.time()
+        _value = self._memory_get(_key, _now)
+        if _value is None:
+            _value = self._disk_get(_key, _now)
+        if _value is None:
+            self.counters['misses'] += 1
+        return _value
+
+    async def aget(self, prompt: str, config: dict = None, bypass = False):
+        ''':meth:`get` with the disk tier off the event loop'''
+        _key = self._lookup(prompt, config, bypass)
+        if _key is None:
+            return None
+        _now = time.time()
+        _value = self._memory_get(_key, _now)
+        if _value is None and self.path is not None:
+            _value = await asyncio.to_thread(self._disk_get, _key, _now)
+        if _value is None:
+            self.counters['misses'] += 1
+        return _value
+
+    def _store(self, prompt, config, value, bypass):
+        '''Stores `value` in the memory tier. Returns what the disk tier needs, or `None` when the request bypasses the cache'''
+        if self._should_bypass(config, bypass):
+            return None
+        _key = cache_key(prompt, config)
+        _now = time.time()
+        _expires_at = _now + self.ttl
+        self._remember(_key, _expires_at, value)
+        self.counters['stores'] += 1
+        return _key, value, _expires_at, _now
+
+    def _disk_put(self, key, value, expires_at, now):
+        with self._db_lock:
+            _db = self._get_db()
+            if _db is None:
+                return
+            _serialized = json.dumps(value)
+            _old = _db.execute("SELECT size FROM inference_cache WHERE key = ?", (key,)).fetchone()
+            _db.execute("INSERT OR REPLACE INTO inference_cache (key, value, size, expires_at, last_used) VALUES (?, ?, ?, ?, ?)", (key, _serialized, len(_serialized), expires_at, now))
+            self._disk_count += 0 if _old else 1
+            self._disk_bytes += len(_serialized) - (_old[0] if _old else 0)
+            self._puts += 1
+            if self._disk_count > self.max_disk_entries or self._disk_bytes > self.max_disk_bytes or self._puts % self.purge_interval == 0:
+                self._evict_disk(_db, now)
+
+    def put(self, prompt: str, config: dict, value, bypass = False):
+        '''Stores a response. `value` must be JSON serializable'''
+        _stored = self._store(prompt, config, value, bypass)
+        if _stored is not None:
+            self._disk_put(*_stored)
+
+    async def aput(self, prompt: str, config: dict, value, bypass = False):
+        ''':meth:`put` with the disk tier off the event loop'''
+        _stored = self._store(prompt, config, value, bypass)
+        if _stored is not None and self.path is not None:
+            await asyncio.to_thread(self._disk_put, *_stored)
+
+    def _disk_discard(self, key):
+        with self._db_lock:
+            _db = self._get_db()
+            if _db is None:
+                return
+            _row = _db.execute("SELECT size FROM inference_cache WHERE key = ?", (key,)).fetchone()
+            if _row is not None:
+                _db.execute("DELETE FROM inference_cache WHERE key = ?", (key,))
+                self._disk_count -= 1
+                self._disk_bytes -= _row[0]
+
+    def discard(self, prompt: str, config: dict = None):
+        '''Drops the response for this prompt and sampling config from both tiers, e.g. because what it planned failed'''
+        _key = cache_key(prompt, config)
+        with self._lock:
+            self._memory.pop(_key, None)
+        self._disk_discard(_key)
+
+    async def adiscard(self, prompt: str, config: dict = None):
+        ''':meth:`discard` with the disk tier off the event loop'''
+        _key = cache_key(prompt, config)
+        with self._lock:
+            self._memory.pop(_key, None)
+        if self.path is not None:
+            await asyncio.to_thread(self._disk_discard, _key)
+
+    def _remember(self, key, expires_at, value):
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last = False)
+                self.counters['evicted'] += 1
+
+    def _evict_disk(self, db, now):
+        '''Sweeps expired entries off the disk tier and, when it is over a limit, drops the least recently used entries until
+        it is back under 90% of its limits, so the next puts don't evict again right away'''
+        _expired = db.execute("DELETE FROM inference_cache WHERE expires_at <= ?", (now,)).rowcount
+        self.counters['expired'] += max(_expired, 0)
+        self._recount(db) # Other processes write to the same store
+        if self._disk_count <= self.max_disk_entries and self._disk_bytes <= self.max_disk_bytes:
+            return
+        _max_entries, _max_bytes = int(self.max_disk_entries * 0.9), int(self.max_disk_bytes * 0.9)
+        while self._disk_count > _max_entries or self._disk_bytes > _max_bytes:
+            _batch = max(1, self._disk_count - _max_entries, self._disk_count // 10)
+            _removed = db.execute("DELETE FROM inference_cache WHERE key IN (SELECT key FROM inference_cache ORDER BY last_used LIMIT ?)", (_batch,)).rowcount
+            self.counters['evicted'] += _removed
+            self._recount(db)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        with self._db_lock:
+            _db = self._get_db()
+            if _db is not None:
+                _db.execute("DELETE FROM inference_cache")
+                self._recount(_db)
+
+    def stats(self):
+        _hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        _lookups = _hits + self.counters['misses']
+        return dict(self.counters, memory_entries = len(self._memory), disk_entries = self._disk_count, disk_bytes = self._disk_bytes, hit_rate = round(_hits / _lookups, 4) if _lookups else 0.0)
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,143 @@
+import json
+import random
+import asyncio
+
+from urllib import parse
+
+from utils.helpers.constants import HTTPMethod
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504} # Statuses worth retrying. Other 4xx mean the request itself is wrong
+
+def _aiohttp():
+    # Imported with the first request, so processes that never inference don't pay for it
+    import aiohttp
+    return aiohttp
+
+class InferenceError(Exception):
+    def __init__(self, message, retriable = True):
+        super().__init__(message)
+        self.retriable = retriable # False when the request itself was rejected, so trying another backend won't help
+
+class InferenceClient():
+    '''An asyncio HTTP client for inference endpoints. A single keep-alive session is shared by every request made through it,
+    each endpoint has its own concurrency limit, and failed requests are retried with exponential backoff and jitter.
+    The session is created lazily on first use so the client can be built before the event loop that uses it exists.'''
+
+    def __init__(self, max_connections = 16, max_per_endpoint = 4, timeout = 300, connect_timeout = 5, retries = 3, backoff = 0.5, max_backoff = 8):
+        self.max_connections = max_connections
+        self.max_per_endpoint = max_per_endpoint
+        self.timeout = timeout # Total seconds allowed for a request. Generations can take a while on CPU
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+        self._limits = {} # endpoint -> asyncio.Semaphore
+
+    def __getstate__(self):
+        # Sessions and semaphores belong to an event loop and can't follow the client into a new process
+        _state = self.__dict__.copy()
+        _state['_session'] = None
+        _state['_limits'] = {}
+        return _state
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            aiohttp = _aiohttp()
+            _connector = aiohttp.TCPConnector(limit = self.max_connections, keepalive_timeout = 60)
+            _timeout = aiohttp.ClientTimeout(total = self.timeout, connect = self.connect_timeout)
+            self._session = aiohttp.ClientSession(connector = _connector, timeout = _timeout)
+        return self._session
+
+    def _get_limit(self, endpoint: str):
+        if endpoint not in self._limits:
+            self._limits[endpoint] = asyncio.Semaphore(self.max_per_endpoint)
+        return self._limits[endpoint]
+
+    def backoff_delay(self, attempt: int):
+        # Full jitter keeps agents that failed together from retrying together
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    async def request(self, method: HTTPMethod, endpoint: str, path: str, body = None):
+        '''Sends a request and returns the decoded JSON response (or text if the response isn't JSON).
+        Raises :class:`InferenceError` once every retry has been used up.'''
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        _url = parse.urljoin(endpoint, path)
+        _method = "POST" if method == HTTPMethod.POST else "GET" if method == HTTPMethod.GET else "DELETE"
+        aiohttp = _aiohttp()
+
+        _last_error = None
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._get_limit(endpoint):
+                    async with self._get_session().request(_method, _url, data = body, headers = {"Content-Type": "application/json"}) as r:
+                        if r.status in RETRY_STATUSES:
+                            _last_error = InferenceError(f"{_method} {_url} returned {r.status}")
+                        elif r.status >= 400:
+                            raise InferenceError(f"{_method} {_url} returned {r.status}: {await r.text()}", retriable = False)
+                        else:
+                            _text = await r.text()
+                            try:
+                                return json.loads(_text)
+                            except ValueError:
+                                return _text
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _last_error = e
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff_delay(attempt))
+
+        raise InferenceError(f"{_method} {_url} failed after {self.retries + 1} attempts: {_last_error}")
+
+    async def post(self, endpoint: str, path: str, body = None):
+        return await self.request(HTTPMethod.POST, endpoint, path, body)
+
+    async def get(self, endpoint: str, path: str, body = None):
+        return await self.request(HTTPMethod.GET, endpoint, path, body)
+
+    async def stream(self, endpoint: str, path: str, body = None):
+        '''Sends a POST to a Server-Sent Events endpoint (KoboldCpp's `api/extra/generate/stream`) and yields each token as it arrives.
+        Connecting is retried like :meth:`request`, but once tokens have started flowing a dropped stream raises :class:`InferenceError`.'''
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        _url = parse.urljoin(endpoint, path)
+        aiohttp = _aiohttp()
+
+        _last_error = None
+        for attempt in range(self.retries + 1):
+            _started = False
+            try:
+                async with self._get_limit(endpoint):
+                    async with self._get_session().post(_url, data = body, headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}) as r:
+                        if r.status >= 400 and r.status not in RETRY_STATUSES:
+                            raise InferenceError(f"POST {_url} returned {r.status}: {await r.text()}", retriable = False)
+                        if r.status < 400:
+                            _started = True
+                            _event = "message"
+                            async for _raw in r.content: # One line at a time
+                                _line = _raw.decode("utf-8").rstrip("\r\n")
+                                if _line.startswith("event:"):
+                                    _event = _line[6:].strip()
+                                elif _line.startswith("data:") and _event == "message":
+                                    _token = json.loads(_line[5:].strip()).get("token", "")
+                                    if _token:
+                                        yield _token
+                                elif _line == "":
+                                    _event = "message"
+                            return
+                        _last_error = InferenceError(f"POST {_url} returned {r.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if _started:
+                    raise InferenceError(f"Stream from {_url} dropped: {e}", retriable = False) # Tokens were already yielded
+                _last_error = e
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff_delay(attempt))
+
+        raise InferenceError(f"POST {_url} failed after {self.retries + 1} attempts: {_last_error}")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,185 @@
+import time
+import uuid
+import asyncio
+
+from collections import OrderedDict, deque
+
+from utils.helpers.constants import HTTPMethod, InferencePriority
+from utils.helpers.inference_cache import cache_key
+from utils.helpers.backend_pool import BackendPool
+
+class _InferenceJob():
+    '''One unique generation. Every :class:`Agent` that asked for the same prompt and sampling config waits on the same job.'''
+
+    def __init__(self, key, agent_name, path, body, priority, reservation = False):
+        self.key = key
+        self.agent_name = agent_name
+        self.path = path
+        self.body = body
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted_at = time.perf_counter()
+        self.waiters = 1
+        self.reservation = reservation # Only holds a slot for a generation the caller streams itself, see :meth:`InferenceScheduler.reserve`
+
+class InferenceScheduler():
+    '''Node-level queue that every :class:`Agent` on the :class:`Node` submits its generations to, instead of each agent hitting
+    the backend on its own. Requests are served highest :class:`InferencePriority` first, and within a priority round-robin
+    across agents so one busy agent can't starve the rest. At most `max_in_flight` requests are sent to each backend at once,
+    and identical requests that are queued or in flight share a single generation. Streamed generations :meth:`reserve` a slot
+    the same way and hold it until they :meth:`release` it.
+    `backends` is a :class:`BackendPool`, or one or more endpoints to build one from.'''
+
+    def __init__(self, backends = "http://localhost:5001", max_in_flight = 1, short_prompt_chars = 1500, sample_size = 1024):
+        self.backends = backends if isinstance(backends, BackendPool) else BackendPool(backends)
+        self.max_in_flight = max_in_flight # Per backend. KoboldCpp with `multiuser` still generates one request at a time
+        self.short_prompt_chars = short_prompt_chars # Prompts up to this length are HIGH priority when no priority is given
+        self._queues = {priority: OrderedDict() for priority in InferencePriority} # priority -> agent name -> deque of jobs
+        self._jobs = {} # key -> job, for every queued or in-flight job
+        self._in_flight = 0
+        self._waits = deque(maxlen = sample_size) # Recent queue wait times in seconds
+        self.counters = {"submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0, "reserved": 0}
+        self.max_queue_depth = 0
+
+    def classify(self, prompt: str, body: dict = None):
+        '''Default priority for requests that didn't ask for one'''
+        if len(prompt) <= self.short_prompt_chars:
+            return InferencePriority.HIGH
+        return InferencePriority.NORMAL
+
+    async def submit(self, agent_name: str, prompt: str, body: dict, priority: InferencePriority = None, path = "api/v1/generate"):
+        '''Queues a generation and waits for its response. Raises whatever the backend request raised.'''
+        priority = priority if priority is not None else self.classify(prompt, body)
+        _key = (path, cache_key(prompt, body))
+        self.counters['submitted'] += 1
+
+        _job = self._jobs.get(_key)
+        if _job is not None:
+            # Someone already asked for exactly this. Ride along, and bump the shared job up if this request is more urgent
+            _job.waiters += 1
+            self.counters['deduplicated'] += 1
+            if priority.value < _job.priority.value and not _job.future.done():
+                self._requeue(_job, priority)
+            return await asyncio.shield(_job.future)
+
+        _job = _InferenceJob(_key, agent_name, path, body, priority)
+        self._jobs[_key] = _job
+        self._queues[priority].setdefault(agent_name, deque()).append(_job)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        self._pump()
+
+        return await asyncio.shield(_job.future)
+
+    async def reserve(self, agent_name: str, prompt: str, priority: InferencePriority = None):
+        '''Waits for a slot on a backend for a generation the caller streams from it itself, and returns that :class:`Backend`.
+        The slot is queued for like any request and counts against `max_in_flight` until it is given back with :meth:`release`.
+        Streams aren't deduplicated, every caller consumes tokens of its own'''
+        priority = priority if priority is not None else self.classify(prompt)
+        self.counters['submitted'] += 1
+        _job = _InferenceJob(("reservation", uuid.uuid4().hex), agent_name, None, None, priority, reservation = True)
+        self._queues[priority].setdefault(agent_name, deque()).append(_job)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        self._pump()
+        try:
+            return await asyncio.shield(_job.future)
+        except asyncio.CancelledError:
+            if _job.future.done() and not _job.future.cancelled(): # Granted just as the caller gave up
+                self.release(_job.future.result())
+            else:
+                _job.future.cancel() # Skipped once its turn comes
+            raise
+
+    def release(self, backend, ok = True):
+        '''Gives back a slot taken with :meth:`reserve`. `ok` is whether the stream went through'''
+        backend.outstanding -= 1
+        self._in_flight -= 1
+        if ok:
+            self.counters['completed'] += 1
+        else:
+            backend.record_failure(self.backends.eject_after)
+            self.counters['failed'] += 1
+        self._pump()
+
+    def _requeue(self, job, priority):
+        _agents = self._queues[job.priority]
+        _pending = _agents.get(job.agent_name)
+        if _pending is None or job not in _pending:
+            return # Already in flight
+        _pending.remove(job)
+        if not _pending:
+            del _agents[job.agent_name]
+        job.priority = priority
+        self._queues[priority].setdefault(job.agent_name, deque()).append(job)
+
+    def _next_job(self):
+        for priority in InferencePriority:
+            _agents = self._queues[priority]
+            if not _agents:
+                continue
+            _agent_name, _pending = next(iter(_agents.items()))
+            _job = _pending.popleft()
+            if _pending:
+                _agents.move_to_end(_agent_name) # This agent goes to the back of the line for its class
+            else:
+                del _agents[_agent_name]
+            return _job
+        return None
+
+    def _pump(self):
+        while True:
+            _backend = self.backends.pick(max_outstanding = self.max_in_flight)
+            if _backend is None:
+                return # Every backend is full
+            _job = self._next_job()
+            if _job is None:
+                return
+            if _job.future.done(): # A reservation its caller gave up on
+                continue
+            self._in_flight += 1
+            _backend.outstanding += 1 # Reserve the slot now, the request itself only starts on the next loop iteration
+            self._waits.append(time.perf_counter() - _job.submitted_at)
+            if _job.reservation:
+                self.counters['reserved'] += 1
+                _job.future.set_result(_backend) # Held by the caller's stream until it is released
+            else:
+                asyncio.get_running_loop().create_task(self._run(_job, _backend))
+
+    async def _run(self, job, backend):
+        try:
+            backend.outstanding -= 1 # Hand the reserved slot over to the request
+            _result = await self.backends.request(HTTPMethod.POST, job.path, job.body, backend = backend, max_outstanding = self.max_in_flight)
+            job.future.set_result(_result)
+            self.counters['completed'] += 1
+        except Exception as e:
+            job.future.set_exception(e)
+            self.counters['failed'] += 1
+        finally:
+            self._jobs.pop(job.key, None)
+            self._in_flight -= 1
+            self._pump()
+
+    def queue_depth(self):
+        return sum(len(pending) for agents in self._queues.values() for pending in agents.values())
+
+    def stats(self):
+        '''Queue depth and wait times, for sizing backend capacity'''
+        _waits = sorted(self._waits)
+
+        def _percentile(p):
+            return round(_waits[min(len(_waits) - 1, int(p * len(_waits)))], 4) if _waits else 0.0
+
+        return dict(
+            self.counters,
+            in_flight = self._in_flight,
+            queue_depth = self.queue_depth(),
+            queue_depth_by_priority = {priority.name: sum(len(p) for p in self._queues[priority].values()) for priority in InferencePriority},
+            max_queue_depth = self.max_queue_depth,
+            backends = self.backends.stats(),
+            wait_seconds = {"p50": _percentile(0.5), "p95": _percentile(0.95), "max": round(_waits[-1], 4) if _waits else 0.0, "samples": len(_waits)}
+        )
+
+    def start(self):
+        self.backends.start()
+
+    async def close(self):
+        await self.backends.close()
@@ -0,0 +1,55 @@
+import time
+
+class LivenessTracker():
+    '''Last sign of life of every peer watched by a :class:`Node` or an :class:`Agent`. Any message from a peer counts, so a busy
+    one doesn't have to send heartbeats on top of its own traffic, and only a quiet one is expected to send them.
+    A peer that hasn't been heard from for `deadline` seconds is considered dead: :meth:`expired` hands it back once so the owner
+    can put its in-flight tasks back in line. Uses the monotonic clock, so wall clock changes can't expire anyone.'''
+
+    def __init__(self, deadline = 30):
+        self.deadline = deadline
+        self._seen = {} # name -> monotonic time it was last heard from
+        self._info = {} # name -> whatever its last heartbeat carried
+        self.counters = {"beats": 0, "expired": 0}
+
+    def __contains__(self, name):
+        return name in self._seen
+
+    def beat(self, name: str, info = None):
+        '''Records a sign of life from `name`, with what its heartbeat carried when there was one'''
+        self._seen[name] = time.monotonic()
+        if info is not None:
+            self._info[name] = info
+        self.counters['beats'] += 1
+
+    def info(self, name: str):
+        return self._info.get(name)
+
+    def reported_by(self, item):
+        '''Name of the peer whose last heartbeat listed `item`, e.g. the Worker running a task'''
+        for name, info in self._info.items():
+            if info is not None and item in info:
+                return name
+        return None
+
+    def forget(self, name: str):
+        '''Stops watching `name`, e.g. once it disconnected and was cleaned up already'''
+        self._seen.pop(name, None)
+        self._info.pop(name, None)
+
+    def silent_for(self, name: str):
+        _seen = self._seen.get(name)
+        return time.monotonic() - _seen if _seen is not None else None
+
+    def expired(self):
+        '''Stops watching peers silent for longer than `deadline`. Returns name -> what their last heartbeat carried'''
+        _cutoff = time.monotonic() - self.deadline
+        _dead = {name: self._info.get(name) for name, seen in self._seen.items() if seen < _cutoff}
+        for name in _dead:
+            self.forget(name)
+        self.counters['expired'] += len(_dead)
+        return _dead
+
+    def stats(self):
+        _now = time.monotonic()
+        return dict(self.counters, deadline = self.deadline, watched = {name: round(_now - seen, 3) for name, seen in self._seen.items()})
@@ -0,0 +1,273 @@
+'''Same-host transport between a :class:`Node` and the :class:`Agent`'s and :class:`Worker`'s running next to it.
+Next to its WebSocket, a Node serves a Unix domain socket at :func:`socket_path` for its port. :func:`connect` takes the usual
+`ws://` url and goes through that socket instead whenever the url points at this machine and the socket is there, so the
+peers on a host skip TCP and the WebSocket framing. Either way the caller gets an object with the same `send`, `recv`, `close`
+and `async for` API, and the same `websockets.ConnectionClosed` exceptions.
+
+Frames are length-prefixed. Those of `shared_threshold` bytes or more (screenshots and other large payloads) don't go through
+the socket at all: the sender writes them once into a `multiprocessing.shared_memory` segment and only sends its name.
+The receiver maps the segment and hands out a `memoryview` of it, so a binary frame is read in place instead of being
+copied through the kernel. The receiver unlinks the segment right away, the mapping goes once the frame is released.
+Set `SOAP_LOCAL_TRANSPORT=0` to always use the WebSocket.'''
+
+import os
+import socket
+import struct
+import asyncio
+import tempfile
+
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+from urllib.parse import urlsplit
+
+import websockets
+
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+
+SHARED_THRESHOLD = 1 << 20 # Frames this large travel through shared memory
+
+_FRAME = struct.Struct(">BI") # kind, length of what follows
+_SEGMENT = struct.Struct(">I") # Size of the frame in a shared segment, followed by the segment name
+_TEXT = 0
+_BYTES = 1
+_SHARED_TEXT = 2
+_SHARED_BYTES = 3
+
+_LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1", "0.0.0.0", socket.gethostname()}
+
+def enabled():
+    return hasattr(socket, "AF_UNIX") and os.environ.get("SOAP_LOCAL_TRANSPORT", "1") != "0"
+
+def socket_path(port: int):
+    '''Where the :class:`Node` serving WebSockets on `port` serves its local peers'''
+    return os.path.join(tempfile.gettempdir(), f"soap-node-{port}.sock")
+
+def local_path(url: str):
+    '''The socket to use for `url` instead of its WebSocket, or `None` when the Node isn't on this machine or doesn't serve one'''
+    if not enabled():
+        return None
+    _url = urlsplit(url)
+    if _url.hostname not in _LOCAL_HOSTS or _url.port is None:
+        return None
+    _path = socket_path(_url.port)
+    return _path if os.path.exists(_path) else None
+
+def _closed(clean = True):
+    return ConnectionClosedOK(None, None) if clean else ConnectionClosedError(None, None)
+
+class LocalConnection():
+    '''One end of a local connection. Behaves like a websockets connection for everything the Node, Agents and Workers use'''
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, shared_threshold = SHARED_THRESHOLD):
+        self._reader = reader
+        self._writer = writer
+        self.shared_threshold = shared_threshold
+        self._closed = False
+        self._mapped = deque() # Shared segments handed out as frames, unmapped once nothing holds them
+        self._sent_segments = deque(maxlen = 1024) # Names of segments sent, unlinked on close in case the peer never read them
+        self.counters = {"frames_sent": 0, "frames_received": 0, "shared_sent": 0, "shared_received": 0, "bytes_sent": 0, "bytes_received": 0}
+
+    @property
+    def remote_address(self):
+        return self._writer.get_extra_info("peername")
+
+    def send_nowait(self, message):
+        '''Queues `message` on the connection without waiting for it to go out, like `websockets.broadcast`'''
+        if self._closed or self._writer.is_closing():
+            raise _closed(self._closed)
+        if isinstance(message, str):
+            _kind, _payload = _TEXT, message.encode()
+        else:
+            _kind, _payload = _BYTES, message
+        self.counters['frames_sent'] += 1
+        self.counters['bytes_sent'] += len(_payload)
+        if len(_payload) >= self.shared_threshold:
+            _kind, _payload = _kind + 2, self._share(_payload)
+            self.counters['shared_sent'] += 1
+        self._writer.write(_FRAME.pack(_kind, len(_payload)))
+        self._writer.write(_payload)
+
+    async def send(self, message):
+        '''Sends a text or binary frame, waiting while the peer reads slower than it is written to'''
+        self.send_nowait(message)
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            self._closed = True
+            raise _closed(False)
+
+    async def recv(self):
+        '''Returns the next frame: `str` for text, `bytes` for binary, or a `memoryview` for a binary frame in shared memory'''
+        self._release()
+        try:
+            _kind, _length = _FRAME.unpack(await self._reader.readexactly(_FRAME.size))
+            _payload = await self._reader.readexactly(_length)
+        except asyncio.IncompleteReadError as e:
+            self._closed = True
+            raise _closed(not e.partial)
+        except ConnectionError:
+            self._closed = True
+            raise _closed(False)
+        self.counters['frames_received'] += 1
+        if _kind == _TEXT:
+            self.counters['bytes_received'] += len(_payload)
+            return _payload.decode()
+        if _kind == _BYTES:
+            self.counters['bytes_received'] += len(_payload)
+            return _payload
+        _frame = self._attach(_payload)
+        self.counters['shared_received'] += 1
+        self.counters['bytes_received'] += len(_frame)
+        return _frame if _kind == _SHARED_BYTES else str(_frame, "utf-8")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionClosedOK:
+            raise StopAsyncIteration
+
+    async def close(self, code = 1000, reason = ""):
+        if self._closed and self._writer.is_closing():
+            return
+        self._closed = True
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        for name in self._sent_segments: # Already gone unless the peer quit before reading them
+            try:
+                _segment = shared_memory.SharedMemory(name = name)
+            except FileNotFoundError:
+                continue
+            _segment.close()
+            _segment.unlink()
+        self._sent_segments.clear()
+        self._release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _share(self, payload):
+        '''Writes `payload` into a new shared segment and returns what to send in its place'''
+        _segment = shared_memory.SharedMemory(create = True, size = len(payload))
+        try:
+            _segment.buf[:len(payload)] = payload
+        finally:
+            _segment.close()
+        resource_tracker.unregister(_segment._name, "shared_memory") # The receiver unlinks it, this process mustn't at exit
+        self._sent_segments.append(_segment.name)
+        return _SEGMENT.pack(len(payload)) + _segment.name.encode()
+
+    def _attach(self, reference: bytes):
+        (_size,) = _SEGMENT.unpack_from(reference)
+        try:
+            _segment = shared_memory.SharedMemory(name = reference[_SEGMENT.size:].decode())
+        except FileNotFoundError: # The sender closed the connection and cleaned up before this frame was read
+            self._closed = True
+            raise _closed(False)
+        _segment.unlink() # Only the name goes, the memory stays mapped for as long as the frame is used
+        self._mapped.append(_segment)
+        return _segment.buf[:_size]
+
+    def _release(self):
+        '''Unmaps the shared segments of frames nobody holds on to anymore'''
+        for _ in range(len(self._mapped)):
+            _segment = self._mapped.popleft()
+            try:
+                _segment.close()
+            except BufferError: # Still in use
+                self._mapped.append(_segment)
+
+class serve():
+    '''Serves `handler(connection)` on the local socket of `port` for as long as the `async with` block runs, like
+    `websockets.serve` does for the WebSocket'''
+
+    def __init__(self, handler, port: int, shared_threshold = SHARED_THRESHOLD):
+        self.handler = handler
+        self.path = socket_path(port)
+        self.shared_threshold = shared_threshold
+        self.server = None
+        self._connections = set()
+
+    async def _accept(self, reader, writer):
+        _connection = LocalConnection(reader, writer, shared_threshold = self.shared_threshold)
+        self._connections.add(_connection)
+        try:
+            await self.handler(_connection)
+        except asyncio.CancelledError: # Shutting down. The connection task is ours, there is no one to pass this on to
+            pass
+        finally:
+            self._connections.discard(_connection)
+            await _connection.close()
+
+    async def __aenter__(self):
+        if os.path.exists(self.path): # Left behind by a Node that didn't exit cleanly. The WebSocket port being free says it is gone
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._accept, self.path)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        if os.path.exists(self.path): # Before anything that waits, so it goes even when shutting down is cut short
+            os.unlink(self.path)
+        for connection in list(self._connections): # Lets their handlers see the end of the stream and return
+            await connection.close()
+        await self.server.wait_closed()
+
+class connect():
+    '''Drop-in for `websockets.connect(url, **kwargs)` that uses the local socket when the Node at `url` serves one.
+    Works the same ways: awaited, with `async with`, or with `async for` to reconnect whenever the connection drops.
+    `kwargs` only apply to the WebSocket'''
+
+    def __init__(self, url: str, shared_threshold = SHARED_THRESHOLD, **kwargs):
+        self.url = url
+        self.shared_threshold = shared_threshold
+        self._kwargs = kwargs
+        self._connection = None
+
+    @property
+    def local(self):
+        return local_path(self.url) is not None
+
+    async def _open(self):
+        _path = local_path(self.url)
+        if _path is None:
+            return await websockets.connect(self.url, **self._kwargs)
+        _reader, _writer = await asyncio.open_unix_connection(_path, limit = 1 << 20)
+        return LocalConnection(_reader, _writer, shared_threshold = self.shared_threshold)
+
+    def __await__(self):
+        return self._open().__await__()
+
+    async def __aenter__(self):
+        self._connection = await self._open()
+        return self._connection
+
+    async def __aexit__(self, *exc):
+        await self._connection.close()
+
+    async def __aiter__(self):
+        if local_path(self.url) is None: # Keep the WebSocket's own retry and backoff
+            async for ws in websockets.connect(self.url, **self._kwargs):
+                yield ws
+            return
+        _delay = 0.1
+        while True:
+            try:
+                _connection = await self._open()
+            except OSError: # The Node is restarting
+                await asyncio.sleep(_delay)
+                _delay = min(_delay * 2, 10)
+                continue
+            _delay = 0.1
+            try:
+                yield _connection
+            finally:
+                await _connection.close()
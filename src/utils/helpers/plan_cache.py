@@ -0,0 +1,144 @@
+import re
+import time
+import threading
+
+from collections import OrderedDict
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.inference_cache import normalize_prompt
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+
+# Parameters lifted out of a task before it is matched against cached plans, in the order they are looked for.
+# A task is reduced to its template, e.g. `Take a screenshot of {url0}`, and every plan made for that template is reused with
+# the new values filled in.
+SLOT_PATTERNS = [
+    ("url", re.compile(r"""\bhttps?://[^\s"'<>]+[^\s"'<>.,;:!?)\]]""")),
+    # Quoted text, e.g. what to type. A single quote only opens and closes one next to a non-word character, so apostrophes
+    # as in "don't click 'Login'" aren't taken for quotes
+    ("text", re.compile(r""""([^"\n]*)"|(?<!\w)'([^'\n]*)'(?!\w)""")),
+]
+
+def task_template(prompt: str):
+    '''Returns `(template, slots)`: the normalized, lowercased prompt with every slot replaced by `{<kind><n>}`, and the
+    values taken out of it by name. Quotes around text slots stay in the template, only what is between them is a value'''
+    _template = normalize_prompt(prompt)
+    _slots = {}
+    for kind, pattern in SLOT_PATTERNS:
+        _count = 0
+        def _replace(match):
+            nonlocal _count
+            _name = f"{kind}{_count}"
+            _count += 1
+            if match.lastindex: # Quoted text: keep the quotes, the value is the group that matched
+                _group = next(n for n in range(1, match.lastindex + 1) if match.group(n) is not None)
+                _slots[_name] = match.group(_group)
+                _quote = match.group(0)[0]
+                return f"{_quote}{{{_name}}}{_quote}"
+            _slots[_name] = match.group(0)
+            return f"{{{_name}}}"
+        _template = pattern.sub(_replace, _template)
+    # Everything outside the slots is matched case-insensitively. The slot names themselves are lowercase already
+    return _template.lower(), _slots
+
+def _parametrize(value, slots: dict):
+    '''Replaces the slot values found in an instruction's action with their placeholders'''
+    if isinstance(value, str):
+        _value = value.replace("{", "{{").replace("}", "}}")
+        for name, slot in sorted(slots.items(), key = lambda item: -len(item[1])): # Longest first, so a value inside another stays whole
+            if slot:
+                _value = _value.replace(slot.replace("{", "{{").replace("}", "}}"), f"{{{name}}}")
+        return _value
+    if isinstance(value, (list, tuple)):
+        return [_parametrize(item, slots) for item in value]
+    if isinstance(value, dict):
+        return {key: _parametrize(item, slots) for key, item in value.items()}
+    return value
+
+def _instantiate(value, slots: dict):
+    if isinstance(value, str):
+        return value.format(**slots)
+    if isinstance(value, list):
+        return [_instantiate(item, slots) for item in value]
+    if isinstance(value, dict):
+        return {key: _instantiate(item, slots) for key, item in value.items()}
+    return value
+
+class CachedPlan():
+    '''A plan for one task template: the instructions with placeholders where the task's slots went, and what making it cost'''
+
+    def __init__(self, template: str, steps: list, inference_seconds: float):
+        self.template = template
+        self.steps = steps # [task name, action with placeholders, id, after, new_page] per instruction
+        self.inference_seconds = inference_seconds # Time the generation took, saved again on every hit
+        self.created_at = time.time()
+        self.hits = 0
+
+    def instantiate(self, slots: dict):
+        return MultiInstruction([SingleInstruction(WorkerTask[task], _instantiate(action, slots), id = id, after = after, new_page = new_page) for task, action, id, after, new_page in self.steps])
+
+class PlanCache():
+    '''Reuses the :class:`MultiInstruction` plans an :class:`Agent` generated for earlier tasks of the same shape, so a repeated
+    task skips inference entirely. Tasks are matched on their template (see :func:`task_template`), and a hit fills the new
+    task's URLs and quoted text into the stored plan. A plan is only stored when it uses every slot of its task, since one that
+    ignores a parameter would do the same thing whatever the parameter was. Call :meth:`invalidate` when a plan fails, so the
+    next task of that shape is planned afresh. Kept in memory, LRU evicted past `max_entries` and expired after `ttl` seconds.'''
+
+    def __init__(self, max_entries = 512, ttl = 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._plans = OrderedDict() # template -> CachedPlan
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "uncacheable": 0, "invalidated": 0, "expired": 0, "evicted": 0}
+        self.inference_seconds_saved = 0.0
+
+    def get(self, prompt: str):
+        '''Returns the plan for `prompt` built from a cached one, or `None` on a miss'''
+        _template, _slots = task_template(prompt)
+        with self._lock:
+            _plan = self._plans.get(_template)
+            if _plan is not None and time.time() - _plan.created_at > self.ttl:
+                del self._plans[_template]
+                self.counters['expired'] += 1
+                _plan = None
+            if _plan is None:
+                self.counters['misses'] += 1
+                return None
+            self._plans.move_to_end(_template)
+            _plan.hits += 1
+            self.counters['hits'] += 1
+            self.inference_seconds_saved += _plan.inference_seconds
+        return _plan.instantiate(_slots)
+
+    def put(self, prompt: str, plan: MultiInstruction, inference_seconds: float = 0.0):
+        '''Stores the plan generated for `prompt`. Returns whether it was cacheable'''
+        _template, _slots = task_template(prompt)
+        _steps = [[instruction.task.name, _parametrize(instruction.action, _slots), getattr(instruction, "id", None), getattr(instruction, "after", None), getattr(instruction, "new_page", False)] for instruction in plan.get_action_list()]
+        _used = "".join(repr(step[1]) for step in _steps)
+        if not _steps or any(f"{{{name}}}" not in _used for name in _slots):
+            self.counters['uncacheable'] += 1
+            return False
+        with self._lock:
+            self._plans[_template] = CachedPlan(_template, _steps, inference_seconds)
+            self._plans.move_to_end(_template)
+            self.counters['stores'] += 1
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last = False)
+                self.counters['evicted'] += 1
+        return True
+
+    def invalidate(self, prompt: str):
+        '''Drops the plan for `prompt`'s template, e.g. because running it failed'''
+        _template, _ = task_template(prompt)
+        with self._lock:
+            if self._plans.pop(_template, None) is None:
+                return False
+            self.counters['invalidated'] += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def stats(self):
+        _lookups = self.counters['hits'] + self.counters['misses']
+        return dict(self.counters, entries = len(self._plans), hit_rate = round(self.counters['hits'] / _lookups, 4) if _lookups else 0.0, inference_seconds_saved = round(self.inference_seconds_saved, 3))
@@ -0,0 +1,168 @@
+import os
+import re
+
+from collections import deque
+
+from utils.helpers.constants import WorkerTask
+
+# Everything before the history and the task. Kept byte-identical across calls so the backend, which only reuses its KV cache
+# for the part of a prompt that matches the previous one from the first token on, never processes it twice
+SYSTEM_PREAMBLE = (
+    "You are the planner of a browser automation agent. You are given a task and answer with the browser actions that carry it out, "
+    "one per line, in the order they have to run. Answer with actions only, no explanations."
+)
+
+TOOL_DESCRIPTIONS = {
+    WorkerTask.GOTO: "GOTO <url> opens the url in the current page",
+    WorkerTask.CLICK: "CLICK <selector> clicks the element matching the CSS selector",
+    WorkerTask.TYPE: "TYPE <selector> <text> types the text into the element matching the CSS selector",
+    WorkerTask.SCREENSHOT: "SCREENSHOT takes a screenshot of the current page",
+}
+
+INSTRUCTION_HEADER = "### Instruction:\n"
+RESPONSE_HEADER = "### Response:\n"
+TRUNCATION_MARK = "\n[...]\n"
+
+def tool_preamble():
+    _lines = [TOOL_DESCRIPTIONS.get(task, task.name) for task in sorted(WorkerTask, key = lambda task: task.value)]
+    return "Available actions:\n" + "\n".join(f"- {line}" for line in _lines)
+
+PREFIX = f"{SYSTEM_PREAMBLE}\n\n{tool_preamble()}\n\n"
+
+_PIECES = re.compile(r"\w+|[^\w\s]|\n")
+
+class Tokenizer():
+    '''Counts tokens without asking the backend. With `path` pointing at the model's `tokenizer.json` and the `tokenizers`
+    package installed the counts are exact, otherwise they are estimated: a token per 4 characters of a word, per punctuation
+    mark and per line break, which runs a little over for English with the usual Llama and Mistral vocabularies.'''
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._tokenizer = None
+        if path:
+            try:
+                from tokenizers import Tokenizer as _Tokenizer
+                self._tokenizer = _Tokenizer.from_file(path)
+            except ImportError:
+                pass # Estimated instead
+
+    @property
+    def exact(self):
+        return self._tokenizer is not None
+
+    def count(self, text: str):
+        if not text:
+            return 0
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens = False).ids)
+        return sum((len(piece) + 3) // 4 for piece in _PIECES.findall(text))
+
+class BuiltPrompt():
+    '''A prompt ready for the generate call, with what it cost'''
+
+    def __init__(self, text: str, tokens: int, reused_tokens: int, truncated = False):
+        self.text = text
+        self.tokens = tokens # Prompt tokens, counted locally
+        self.reused_tokens = reused_tokens # Leading tokens shared with the previous prompt, which the backend doesn't process again
+        self.truncated = truncated # Whether history or the task itself was cut to fit
+
+    @property
+    def processed_tokens(self):
+        return self.tokens - self.reused_tokens
+
+class PromptBuilder():
+    '''Assembles the prompts an :class:`Agent` plans with: the fixed :data:`PREFIX`, then the history of earlier tasks and their
+    plans, then the task. Every part only ever grows at the end, so each prompt starts with the previous one and the backend
+    reuses its KV cache for all of it instead of reprocessing the prompt on every call.
+    Prompts are kept within `max_context_length` minus the `max_length` reserved for the answer. History over budget is
+    compacted in one go, the oldest half replaced by a line saying how many tasks were left out, so the prefix only breaks
+    on the rare call that compacts instead of on every call once the context is full. A task too long on its own is cut in
+    the middle. `history_turns` is how many earlier tasks are kept at most, 0 to plan every task on its own.'''
+
+    def __init__(self, max_context_length = 4096, max_length = 512, tokenizer: Tokenizer = None, history_turns = 0, margin = 0.05):
+        self.max_context_length = max_context_length
+        self.max_length = max_length
+        self.tokenizer = tokenizer or Tokenizer()
+        self.history_turns = history_turns
+        self.margin = margin # Left free when token counts are estimated
+        self._prefix_tokens = self.tokenizer.count(PREFIX)
+        self._history = deque() # (text, tokens) per earlier task and its plan
+        self._left_out = 0 # Earlier tasks compacted away
+        self._last = "" # Previous prompt, for the tokens the backend reuses
+        self.counters = {"calls": 0, "prompt_tokens": 0, "reused_tokens": 0, "compactions": 0, "tasks_truncated": 0}
+
+    @classmethod
+    def from_config(cls, config: dict = None, **kwargs):
+        '''Takes the context size and answer length from the generate config'''
+        _config = config or {}
+        return cls(max_context_length = _config.get('max_context_length', 4096), max_length = _config.get('max_length', 512), **kwargs)
+
+    @property
+    def budget(self):
+        '''Tokens a prompt may take'''
+        _budget = self.max_context_length - self.max_length
+        return _budget if self.tokenizer.exact else int(_budget * (1 - self.margin))
+
+    def _summary(self):
+        return f"({self._left_out} earlier tasks left out)\n\n" if self._left_out else ""
+
+    def _history_tokens(self):
+        return self.tokenizer.count(self._summary()) + sum(tokens for _, tokens in self._history)
+
+    def _compact(self):
+        '''Drops the oldest half of the history'''
+        for _ in range(max(1, len(self._history) // 2)):
+            self._history.popleft()
+            self._left_out += 1
+        self.counters['compactions'] += 1
+
+    def _fit_task(self, task: str, available: int):
+        '''Cuts the middle out of `task` until it takes at most `available` tokens, keeping its start and end'''
+        _tokens = self.tokenizer.count(task)
+        while _tokens > available and len(task) > len(TRUNCATION_MARK):
+            _keep = max(0, int(len(task) * available / _tokens) - len(TRUNCATION_MARK))
+            task = task[:_keep * 2 // 3] + TRUNCATION_MARK + task[len(task) - _keep // 3:] if _keep else ""
+            _tokens = self.tokenizer.count(task)
+        return task
+
+    def build(self, task: str):
+        '''Returns the :class:`BuiltPrompt` to plan `task` with'''
+        _task = task.strip()
+        _framing = self.tokenizer.count(INSTRUCTION_HEADER + "\n" + RESPONSE_HEADER)
+        _truncated = False
+        while self._history and self._prefix_tokens + self._history_tokens() + _framing + self.tokenizer.count(_task) > self.budget:
+            self._compact()
+            _truncated = True
+        _available = self.budget - self._prefix_tokens - self._history_tokens() - _framing
+        if self.tokenizer.count(_task) > _available:
+            _task = self._fit_task(_task, max(0, _available))
+            self.counters['tasks_truncated'] += 1
+            _truncated = True
+
+        _text = PREFIX + self._summary() + "".join(text for text, _ in self._history) + f"{INSTRUCTION_HEADER}{_task}\n{RESPONSE_HEADER}"
+        _common = os.path.commonprefix([_text, self._last])
+        _built = BuiltPrompt(_text, self.tokenizer.count(_text), self.tokenizer.count(_common), truncated = _truncated)
+        self._last = _text
+        self.counters['calls'] += 1
+        self.counters['prompt_tokens'] += _built.tokens
+        self.counters['reused_tokens'] += _built.reused_tokens
+        return _built
+
+    def record(self, task: str, answer: str):
+        '''Adds a planned task and the model's answer to the history the next prompts are built on'''
+        if self.history_turns <= 0 or not answer.strip(): # Nothing was planned, nothing to learn from
+            return
+        _text = f"{INSTRUCTION_HEADER}{task.strip()}\n{RESPONSE_HEADER}{answer.strip()}\n\n"
+        self._history.append((_text, self.tokenizer.count(_text)))
+        if len(self._history) > self.history_turns:
+            self._compact()
+
+    def stats(self):
+        return dict(
+            self.counters,
+            prefix_tokens = self._prefix_tokens,
+            budget = self.budget,
+            history = len(self._history),
+            exact_counts = self.tokenizer.exact,
+            reuse_rate = round(self.counters['reused_tokens'] / self.counters['prompt_tokens'], 4) if self.counters['prompt_tokens'] else 0.0
+        )
@@ -0,0 +1,173 @@
+import websockets
+
+from collections import OrderedDict
+
+from utils.helpers.local_transport import LocalConnection
+from utils.helpers.wire_protocol import PROTOCOL_JSON, encode_message, protocol_of
+
+ANY_AGENT = "any_agent" # Anycast target. Delivered to exactly one agent, preferring idle ones
+
+class ClientRole():
+    AGENT = "agent"
+    WORKER = "worker"
+    SCRIPT = "script"
+    NODE = "node" # A client Node connected to a host Node
+
+    @staticmethod
+    def from_name(name: str):
+        '''Best guess at a role for clients that connected without registering'''
+        if "_Worker-" in name:
+            return ClientRole.WORKER
+        if name.startswith("Agent-"):
+            return ClientRole.AGENT
+        return ClientRole.SCRIPT
+
+class MessageRouter():
+    '''Maps client names to their WebSocket so the :class:`Node` can deliver a message only to the client(s) it is meant for.
+    Supports unicast (`Agent-<id>`, `<agent>_Worker-<id>`), anycast (`any_agent`) and multicast to named groups.
+    Every client is implicitly a member of the `all` group and of the group for its role (`agents`, `workers`).
+    Workers are also members of `<agent_name>_workers` so an :class:`Agent` can address all of its own workers at once.'''
+
+    def __init__(self):
+        self._by_name = {} # name -> websocket
+        self._by_socket = {} # websocket -> name
+        self._roles = {} # name -> role
+        self._groups = {} # group -> {name: websocket}
+        self._load = {} # agent name -> number of outstanding tasks
+        self._idle = OrderedDict() # Idle agents in round-robin order
+        self._protocols = {} # websocket -> negotiated wire protocol
+
+    def register(self, name: str, websocket, role: str = None, groups: list = None, protocol: str = PROTOCOL_JSON):
+        '''Registers (or re-registers after a reconnect) a client under `name`. `protocol` is the wire protocol the client reads'''
+        if name in self._by_name and self._by_name[name] is not websocket:
+            self.unregister(self._by_name[name])
+
+        role = role or ClientRole.from_name(name)
+        self._by_name[name] = websocket
+        self._by_socket[websocket] = name
+        self._roles[name] = role
+        self._protocols[websocket] = protocol
+
+        _groups = {"all", f"{role}s"}
+        if role == ClientRole.WORKER:
+            _groups.add(name.split("_Worker-")[0] + "_workers")
+        _groups.update(groups or [])
+        for group in _groups:
+            self._groups.setdefault(group, {})[name] = websocket
+
+        if role == ClientRole.AGENT:
+            self._load.setdefault(name, 0)
+
+    def unregister(self, websocket):
+        '''Removes a client from every table. Returns the name it was registered under, or `None`'''
+        name = self._by_socket.pop(websocket, None)
+        self._protocols.pop(websocket, None)
+        if name is None:
+            return None
+
+        self._by_name.pop(name, None)
+        self._roles.pop(name, None)
+        self._load.pop(name, None)
+        self._idle.pop(name, None)
+        for group in list(self._groups):
+            self._groups[group].pop(name, None)
+            if not self._groups[group]:
+                del self._groups[group]
+
+        return name
+
+    def name_of(self, websocket):
+        return self._by_socket.get(websocket)
+
+    def socket_of(self, name: str):
+        return self._by_name.get(name)
+
+    def protocol_for(self, websocket):
+        return self._protocols.get(websocket, PROTOCOL_JSON)
+
+    def is_registered(self, websocket):
+        return websocket in self._by_socket
+
+    def members(self, group: str):
+        '''Returns the names of every client in `group`'''
+        return list(self._groups.get(group, {}))
+
+    def set_idle(self, name: str, idle: bool):
+        '''Marks an agent as idle (ready for work) or busy. Only idle agents are preferred for anycast'''
+        if name not in self._load:
+            return
+        if idle:
+            self._idle[name] = None
+        else:
+            self._idle.pop(name, None)
+
+    def add_load(self, name: str, amount: int = 1):
+        '''Adjusts the number of outstanding tasks held by an agent. Used to break ties when no agent is idle'''
+        if name in self._load:
+            self._load[name] = max(0, self._load[name] + amount)
+
+    def load_of(self, name: str):
+        return self._load.get(name, 0)
+
+    def pick_agent(self, exclude = None):
+        '''Chooses one agent for an anycast message. Idle agents are chosen round-robin, otherwise the least loaded agent is used'''
+        for name in self._idle:
+            if name != exclude:
+                self._idle.move_to_end(name) # Rotate so the next anycast goes to a different idle agent
+                return name
+
+        _candidates = [name for name in self._load if name != exclude]
+        if not _candidates:
+            return None
+        return min(_candidates, key = self._load.__getitem__)
+
+    def resolve(self, target: str, sender = None):
+        '''Resolves a target to the list of WebSockets that should receive the message. The sender never receives its own message.'''
+        if target in self._by_name:
+            _ws = self._by_name[target]
+            return [] if _ws is sender else [_ws]
+        if target == ANY_AGENT:
+            _name = self.pick_agent(exclude = self._by_socket.get(sender))
+            return [] if _name is None else [self._by_name[_name]]
+        if target in self._groups:
+            return [ws for ws in self._groups[target].values() if ws is not sender]
+        return []
+
+    async def route(self, message, target: str, sender = None, msg: dict = None):
+        '''Delivers a message to `target`. `message` is the raw frame as received and `msg` its decoded form.
+        The raw frame is forwarded untouched to clients that speak the same protocol, and re-encoded once per protocol for the rest.
+        Either may be `None` (but not both). Returns the number of clients it was sent to.'''
+        _recipients = self.resolve(target, sender)
+        if not _recipients:
+            return 0
+
+        _encoded = {} if message is None else {protocol_of(message): message}
+        _batches = {}
+        for ws in _recipients:
+            _protocol = self._protocols.get(ws, PROTOCOL_JSON)
+            if _protocol not in _encoded:
+                _encoded[_protocol] = encode_message(msg['type'], msg['origin'], msg['target'], msg['data'], protocol = _protocol)
+            _batches.setdefault(_protocol, []).append(ws)
+
+        for _protocol, _batch in _batches.items():
+            if len(_batch) == 1:
+                try:
+                    await _batch[0].send(_encoded[_protocol])
+                except websockets.exceptions.ConnectionClosed:
+                    pass
+            else:
+                for ws in _batch:
+                    if isinstance(ws, LocalConnection): # Peers on the local socket, queued without waiting just the same
+                        try:
+                            ws.send_nowait(_encoded[_protocol])
+                        except websockets.exceptions.ConnectionClosed:
+                            pass
+                websockets.broadcast([ws for ws in _batch if not isinstance(ws, LocalConnection)], _encoded[_protocol]) # Doesn't wait on slow clients
+        return len(_recipients)
+
+    async def send(self, target: str, type: str, origin: str = "node", data: dict = {}):
+        '''Builds and delivers a message that originates on the :class:`Node` itself'''
+        return await self.route(None, target, msg = {"type": type, "origin": origin, "target": target, "data": data})
+
+    def __len__(self):
+        return len(self._by_socket)
@@ -0,0 +1,218 @@
+import io
+import os
+import time
+import asyncio
+import hashlib
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+_pillow = None # PIL.Image once loaded, False when Pillow isn't installed
+
+def load_pillow():
+    '''Imports Pillow on the first screenshot rather than with this module. Returns `PIL.Image`, or `None` without Pillow,
+    in which case screenshots pass through at full size and only exact duplicates are caught'''
+    global _pillow
+    if _pillow is None:
+        try:
+            from PIL import Image
+            _pillow = Image
+        except ImportError:
+            _pillow = False
+    return _pillow or None
+
+class ImagePreset():
+    '''Target size and encoding of the screenshots fed to one vision model. Images are downscaled to fit within
+    `max_width` x `max_height` keeping their aspect ratio, and never upscaled. `None` keeps that dimension as is.'''
+
+    def __init__(self, name: str, max_width: int = None, max_height: int = None, format = "PNG", quality = 85):
+        self.name = name
+        self.max_width = max_width
+        self.max_height = max_height
+        self.format = format # "PNG", "JPEG" or "WEBP"
+        self.quality = quality # Lossy formats only
+
+VISION_PRESETS = {
+    "full": ImagePreset("full"), # Untouched capture
+    "llava": ImagePreset("llava", 672, 672, "PNG"),
+    "llava-1.5": ImagePreset("llava-1.5", 336, 336, "JPEG", 90),
+    "bakllava": ImagePreset("bakllava", 336, 336, "JPEG", 90),
+    "moondream": ImagePreset("moondream", 378, 378, "JPEG", 90),
+    "idefics2": ImagePreset("idefics2", 980, 980, "JPEG", 90)
+}
+
+DEFAULT_PRESET = "llava"
+
+class Screenshot():
+    '''A processed screenshot held in memory'''
+
+    def __init__(self, data: bytes, format: str, width: int, height: int, phash: int, source_bytes: int):
+        self.data = data
+        self.format = format
+        self.width = width
+        self.height = height
+        self.phash = phash # 64 bit perceptual hash, see `difference_hash`
+        self.source_bytes = source_bytes # Size of the capture before resizing and re-encoding
+        self.duplicate = False # Near-identical to the previous screenshot of the same stream
+        self.key = None # Where it was put in the ArtifactStore
+
+def difference_hash(image, size = 8):
+    '''64 bit dHash: the image is shrunk to (size + 1) x size greyscale and each bit records whether a pixel is brighter
+    than its right neighbour. Small rendering differences flip few bits, so the Hamming distance measures similarity.'''
+    _small = image.convert("L").resize((size + 1, size), load_pillow().BILINEAR)
+    _pixels = list(_small.getdata())
+    _hash = 0
+    for row in range(size):
+        for col in range(size):
+            _left = _pixels[row * (size + 1) + col]
+            _right = _pixels[row * (size + 1) + col + 1]
+            _hash = (_hash << 1) | (1 if _left > _right else 0)
+    return _hash
+
+def hamming_distance(a: int, b: int):
+    return bin(a ^ b).count("1")
+
+def process_image(png: bytes, preset: ImagePreset):
+    '''Decodes, downscales, hashes and re-encodes one capture. CPU bound, so it runs on the pipeline's thread pool'''
+    Image = load_pillow()
+    if Image is None:
+        # Exact-match hash only, the top 64 bits of the digest
+        return Screenshot(png, "PNG", 0, 0, int.from_bytes(hashlib.sha256(png).digest()[:8], "big"), len(png))
+
+    _image = Image.open(io.BytesIO(png))
+    _image.load()
+    _phash = difference_hash(_image)
+    _source_size = _image.size
+
+    if preset.max_width or preset.max_height:
+        _image.thumbnail((preset.max_width or _image.width, preset.max_height or _image.height), Image.LANCZOS)
+    if preset.format == "PNG" and _image.size == _source_size:
+        _data = png # Nothing changed, skip the re-encode
+    else:
+        if preset.format == "JPEG" and _image.mode not in ("RGB", "L"):
+            _image = _image.convert("RGB")
+        _out = io.BytesIO()
+        _image.save(_out, format = preset.format, quality = preset.quality, optimize = preset.format == "PNG")
+        _data = _out.getvalue()
+
+    return Screenshot(_data, preset.format, _image.width, _image.height, _phash, len(png))
+
+class ScreenshotPipeline():
+    '''Turns raw captures into model-ready images off the event loop. Decoding, resizing and encoding run on a small
+    thread pool sized for CPU work. Screenshots whose perceptual hash is within `dedupe_distance` bits of the previous
+    screenshot of the same `stream` are flagged as duplicates and not stored, so repeated captures of an unchanged page
+    don't trigger another vision inference. Call :meth:`forget` once a stream is done with. Kept screenshots go to the
+    :class:`ArtifactStore`.'''
+
+    def __init__(self, preset = DEFAULT_PRESET, store = None, max_workers = 2, dedupe_distance = 4):
+        self.preset = preset if isinstance(preset, ImagePreset) else VISION_PRESETS[preset]
+        self.store = store or get_artifact_store()
+        self.dedupe_distance = dedupe_distance # Bits of the 64 bit hash that may differ. 0 only drops identical images
+        self._executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "Thread-Screenshot")
+        self._last_hash = {} # stream -> hash of the last kept screenshot
+        self._lock = threading.Lock()
+        self.counters = {"processed": 0, "duplicates": 0, "source_bytes": 0, "stored_bytes": 0, "seconds": 0.0}
+
+    async def process(self, png: bytes, stream: str = "default", key: str = None):
+        '''Processes a capture and stores it under `key` (generated when not given). Returns the :class:`Screenshot`,
+        with `duplicate` set and nothing stored when it matches the previous screenshot of `stream`.'''
+        _start = time.perf_counter()
+        _shot = await asyncio.get_running_loop().run_in_executor(self._executor, process_image, png, self.preset)
+
+        with self._lock:
+            self.counters['processed'] += 1
+            self.counters['source_bytes'] += _shot.source_bytes
+            self.counters['seconds'] += time.perf_counter() - _start
+            _previous = self._last_hash.get(stream)
+            if _previous is not None and hamming_distance(_previous, _shot.phash) <= self.dedupe_distance:
+                _shot.duplicate = True
+                self.counters['duplicates'] += 1
+                return _shot
+            self._last_hash[stream] = _shot.phash
+            self.counters['stored_bytes'] += len(_shot.data)
+
+        _shot.key = key or f"{stream}/{time.time_ns()}.{'jpg' if _shot.format == 'JPEG' else _shot.format.lower()}"
+        self.store.put(_shot.key, _shot.data)
+        return _shot
+
+    def forget(self, stream: str):
+        '''Drops the dedupe history of `stream`, e.g. once its task is done'''
+        with self._lock:
+            self._last_hash.pop(stream, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, preset = self.preset.name)
+
+    def close(self):
+        self._executor.shutdown(wait = False)
+
+class ArtifactStore():
+    '''Keyed, size-bounded in-memory store for artifacts such as screenshots. The least recently used artifacts are
+    evicted once more than `max_bytes` are held. With a `directory`, artifacts are also written there under their key
+    on a background thread, so a disk write never blocks the caller. Thread-safe.'''
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024, directory: str = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._items = OrderedDict() # key -> bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "Thread-ArtifactWriter") if directory else None
+        self.counters = {"puts": 0, "hits": 0, "misses": 0, "evicted": 0}
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            _old = self._items.pop(key, None)
+            if _old is not None:
+                self._bytes -= len(_old)
+            self._items[key] = data
+            self._bytes += len(data)
+            self.counters['puts'] += 1
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, _evicted = self._items.popitem(last = False)
+                self._bytes -= len(_evicted)
+                self.counters['evicted'] += 1
+        if self._writer is not None:
+            self._writer.submit(self._write, key, data)
+
+    def _write(self, key: str, data: bytes):
+        _path = os.path.join(self.directory, *key.split("/"))
+        os.makedirs(os.path.dirname(_path), exist_ok = True)
+        with open(_path, "wb") as f:
+            f.write(data)
+
+    def get(self, key: str):
+        '''Returns the artifact stored under `key`, or `None` once it has been evicted'''
+        with self._lock:
+            _data = self._items.get(key)
+            if _data is None:
+                self.counters['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.counters['hits'] += 1
+            return _data
+
+    def keys(self, prefix: str = ""):
+        with self._lock:
+            return [key for key in self._items if key.startswith(prefix)]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, artifacts = len(self._items), bytes = self._bytes, max_bytes = self.max_bytes)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.shutdown(wait = True)
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+def get_artifact_store(**kwargs):
+    '''Returns this process's shared :class:`ArtifactStore`, creating it from `kwargs` on first use'''
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = ArtifactStore(**kwargs)
+        return _shared_store
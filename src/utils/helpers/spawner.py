@@ -0,0 +1,167 @@
+import sys
+import time
+import atexit
+import importlib
+import threading
+import multiprocessing
+
+def spawn_context():
+    '''The multiprocessing context :class:`WarmSpawner` starts processes with. Queues and locks handed to them must come from it'''
+    _methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in _methods else "spawn")
+
+def _template_main(conn, preload: list, inherited: tuple):
+    '''Body of a warm template process: pay for the imports up front, then wait to be told what to run'''
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass # An optional engine that isn't installed. The target imports what it really needs
+    conn.send("ready")
+    try:
+        _job = conn.recv()
+    except (EOFError, OSError):
+        return # The parent went away before using this template
+    finally:
+        conn.close()
+    if _job is None:
+        return
+    _target, _args, _kwargs = _job
+    _target(*inherited, *_args, **_kwargs)
+
+class SpawnedProcess():
+    '''A process started by :class:`WarmSpawner`, whether it came from a template or was started cold'''
+
+    def __init__(self, process, warm: bool, spawn_seconds: float):
+        self.process = process
+        self.warm = warm
+        self.spawn_seconds = spawn_seconds # Time until the target was handed over, for the caller that asked
+
+    @property
+    def name(self):
+        return self.process.name
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def terminate(self):
+        self.process.terminate()
+
+    def join(self, timeout = None):
+        self.process.join(timeout)
+
+class WarmSpawner():
+    '''Starts processes in milliseconds by keeping `warm` template processes around that already imported `preload`.
+    :meth:`spawn` hands the target to a ready template and tops the templates back up in the background.
+    New templates are forked from a forkserver that preloaded the same modules, so they are warm almost at once too.
+    Where there is no forkserver (Windows) templates are spawned and import the modules themselves before they count as ready.
+    `inherited` are objects that can only be handed over when a process starts, like a `multiprocessing.Queue`. Every target
+    gets them as its first arguments.'''
+
+    def __init__(self, preload: list, warm = 1, inherited: tuple = (), name = "Warm"):
+        self.preload = list(preload)
+        self.warm = warm
+        self.inherited = tuple(inherited)
+        self.name = name
+        self._context = spawn_context()
+        if self._context.get_start_method() == "forkserver":
+            self._context.set_forkserver_preload(self.preload)
+        self._templates = [] # (process, connection) ready to take a target
+        self._starting = 0
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._stopped = False
+        self.counters = {"warm_spawns": 0, "cold_spawns": 0, "templates_started": 0}
+        atexit.register(self.stop) # Idle templates would otherwise keep this process from exiting
+
+    def start(self):
+        '''Starts the templates. Runs in the background, the first spawns are cold if they come before a template is ready'''
+        self._stopped = False
+        self._refill()
+        return self
+
+    def _refill(self):
+        if self._stopped:
+            return
+        threading.Thread(target = self._top_up, name = f"Thread-{self.name}Spawner", daemon = True).start()
+
+    def _top_up(self):
+        while True:
+            with self._lock:
+                if self._stopped or len(self._templates) + self._starting >= self.warm:
+                    return
+                self._starting += 1
+                self._seq += 1
+                _name = f"Process-{self.name}-{self._seq}"
+            try:
+                _parent, _child = self._context.Pipe()
+                _process = self._context.Process(target = _template_main, args = (_child, self.preload, self.inherited), name = _name, daemon = False)
+                _process.start()
+                _child.close()
+                _ready = _parent.recv() == "ready" # Blocks this thread only, until the imports are done
+            except (EOFError, OSError) as e:
+                sys.stderr.write(f"Couldn't start a warm template process: {type(e).__name__}: {e}\n")
+                _ready = False
+            with self._lock:
+                self._starting -= 1
+                _keep = _ready and not self._stopped
+                if _keep:
+                    self._templates.append((_process, _parent))
+                    self.counters['templates_started'] += 1
+            if _ready and not _keep: # Stopped while it was warming up
+                _parent.send(None)
+                _parent.close()
+            if not _keep:
+                return
+
+    def spawn(self, target, *args, name: str = None, **kwargs):
+        '''Runs `target(*inherited, *args, **kwargs)` in a new process and returns a :class:`SpawnedProcess`.
+        `target` must be a module level function, since it is pickled over to the template'''
+        _start = time.perf_counter()
+        while True:
+            with self._lock:
+                _template = self._templates.pop(0) if self._templates else None
+            if _template is None:
+                break
+            _process, _conn = _template
+            try:
+                _conn.send((target, args, kwargs))
+                _conn.close()
+            except (OSError, EOFError):
+                continue # The template died while idle, try the next one
+            if name:
+                _process.name = name # Only renames it on this side, for bookkeeping
+            self.counters['warm_spawns'] += 1
+            self._refill()
+            return SpawnedProcess(_process, True, time.perf_counter() - _start)
+
+        _process = self._context.Process(target = target, args = (*self.inherited, *args), kwargs = kwargs, name = name)
+        _process.start()
+        self.counters['cold_spawns'] += 1
+        self._refill()
+        return SpawnedProcess(_process, False, time.perf_counter() - _start)
+
+    def stop(self, timeout = 10):
+        '''Lets every idle template exit, including those still warming up'''
+        with self._lock:
+            self._stopped = True
+        _deadline = time.perf_counter() + timeout
+        while self._starting and time.perf_counter() < _deadline:
+            time.sleep(0.01)
+        with self._lock:
+            _templates, self._templates = self._templates, []
+        for process, conn in _templates:
+            try:
+                conn.send(None)
+                conn.close()
+            except OSError:
+                pass
+            process.join(timeout = 5)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, ready = len(self._templates), starting = self._starting, start_method = self._context.get_start_method())
@@ -0,0 +1,332 @@
+import time
+import heapq
+import uuid
+import asyncio
+import itertools
+
+from collections import OrderedDict
+
+from utils.helpers.constants import TaskPriority
+from utils.helpers.durable_queue import DurableQueue
+from utils.helpers.wire_protocol import pack_object
+
+class _DispatchEntry():
+    '''A task waiting on the :class:`Node` or assigned to an :class:`Agent`'''
+
+    def __init__(self, task_id, item, priority: TaskPriority, deadline: float, seq: int):
+        self.task_id = task_id
+        self.item = item
+        self.priority = priority
+        self.deadline = deadline # Unix time the task should be done by, `None` for no deadline
+        self.seq = seq # Submission order, the last tie breaker
+        self.submitted_at = time.perf_counter()
+        self.agent = None
+        self.started = False
+        self.store_id = None # Row of the task in the dispatcher's DurableQueue, once leased out of it
+        self.lease_until = None # Unix time that lease runs out unless it is renewed
+
+    def sort_key(self):
+        return (self.priority.value, self.deadline if self.deadline is not None else float("inf"), self.seq)
+
+    def __lt__(self, other):
+        return self.sort_key() < other.sort_key()
+
+class _AgentSlot():
+    def __init__(self, name, slots, prefetch):
+        self.name = name
+        self.slots = slots # Tasks the agent runs at once
+        self.prefetch = prefetch # Extra tasks kept queued on the agent so it never waits on a round trip
+        self.assigned = OrderedDict() # task_id -> entry, in dispatch order
+        self.completed = 0
+        self.stealing = set() # task_ids a steal was requested for
+
+    @property
+    def window(self):
+        return self.slots + self.prefetch
+
+    @property
+    def in_flight(self):
+        return len(self.assigned)
+
+    @property
+    def running(self):
+        return sum(1 for entry in self.assigned.values() if entry.started)
+
+    @property
+    def queued(self):
+        '''Assigned but not started, so still stealable'''
+        return [entry for entry in self.assigned.values() if not entry.started and entry.task_id not in self.stealing]
+
+class TaskDispatcher():
+    '''Hands the :class:`Node`'s tasks to its :class:`Agent`'s. Tasks are dispatched by :class:`TaskPriority`, then earliest
+    deadline, then submission order. Every agent is kept topped up to its credit window, the tasks it runs at once (`slots`)
+    plus `prefetch` more queued on the agent, so it can start the next task without a round trip to the Node. Each task goes
+    to the agent with the lowest in-flight to slots ratio. An agent with free slots and nothing left to dispatch steals a
+    queued task back from the most backed up agent.
+    With a `store`, tasks are persisted in a :class:`DurableQueue` until an agent reports them done. They are leased out of it
+    only as agents have credit for them, for `lease_seconds` at a time, and the leases of the tasks an agent holds are renewed
+    as it heartbeats (:meth:`renew`). Should this Node stop, whatever it held is leased again by the next one within
+    `lease_seconds`. Writes to the store are buffered and made in batches by :meth:`flush`, off the event loop.
+    `send(target, type, data)` delivers a message to an agent and returns the number of recipients.'''
+
+    def __init__(self, send, default_slots = 1, default_prefetch = 2, steal = True, store: DurableQueue = None, lease_seconds = 30):
+        self._send = send
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self.default_slots = default_slots
+        self.default_prefetch = default_prefetch
+        self.steal = steal
+        self._pending = [] # Heap of entries not assigned to any agent
+        self._agents = {} # name -> _AgentSlot
+        self._seq = 0
+        self._leased = {} # task_id -> entry, for tasks taken out of the store and not yet done
+        self._unsaved = [] # Entries submitted since the last flush, not in the store yet
+        self._unacked = set() # Store ids of tasks done since the last flush
+        self._unreleased = set() # Store ids of tasks handed back since the last flush
+        self._renewals = set() # Store ids of leases to renew with the next flush
+        self._backlog = 0 # Tasks ready in the store, so capacity never has to count them there
+        self._store_lock = asyncio.Lock() # One flush or lease at a time
+        self.counters = {"submitted": 0, "dispatched": 0, "completed": 0, "failed": 0, "stolen": 0, "requeued": 0, "missed_deadlines": 0, "lease_expired": 0, "agents_lost": 0}
+
+    def __contains__(self, name):
+        return name in self._agents
+
+    def submit(self, item, priority: TaskPriority = None, deadline: float = None):
+        '''Queues a task and returns its id. Call :meth:`pump` afterwards to dispatch it'''
+        return self.submit_many([item], priority, deadline)[0]
+
+    def submit_many(self, items: list, priority: TaskPriority = None, deadline: float = None):
+        '''Queues several tasks at once and returns their ids. Persisted tasks are written to the store with the next :meth:`flush`'''
+        priority = priority if priority is not None else TaskPriority.NORMAL
+        self.counters['submitted'] += len(items)
+        _ids = []
+        for item in items:
+            self._seq += 1
+            _entry = _DispatchEntry(uuid.uuid4().hex, item, priority, deadline, self._seq)
+            if self.store is not None:
+                self._unsaved.append(_entry)
+            else:
+                heapq.heappush(self._pending, _entry)
+            _ids.append(_entry.task_id)
+        return _ids
+
+    def recover(self):
+        '''Makes every task leased by a previous run of this Node dispatchable again. Call once on start, before the first pump'''
+        if self.store is None:
+            return 0
+        _released = self.store.release_all()
+        self._backlog = self.store.stats()['ready']
+        return _released
+
+    def renew(self, name: str):
+        '''Marks the leases of the tasks `name` holds, and of those waiting for an agent, for renewal once half their time is up.
+        Call on each heartbeat of the agent, then :meth:`flush` when it returns `True`'''
+        _agent = self._agents.get(name)
+        if self.store is None or _agent is None:
+            return False
+        _now = time.time()
+        for entry in itertools.chain(_agent.assigned.values(), self._pending):
+            if entry.lease_until is not None and entry.lease_until - _now < self.lease_seconds / 2:
+                entry.lease_until = _now + self.lease_seconds
+                self._renewals.add(entry.store_id)
+        return bool(self._renewals)
+
+    async def flush(self):
+        '''Writes what was submitted, done, handed back or renewed since the last flush to the store in one go, off the event loop.
+        :meth:`pump` flushes before it leases, so messages arriving together share their transactions'''
+        if self.store is None:
+            return
+        async with self._store_lock:
+            await self._flush()
+
+    async def _flush(self):
+        _puts, self._unsaved = self._unsaved, []
+        _acks, self._unacked = self._unacked, set()
+        _releases, self._unreleased = self._unreleased, set()
+        _renewals, self._renewals = self._renewals, set()
+        if not (_puts or _acks or _releases or _renewals):
+            return
+        try:
+            await asyncio.to_thread(self._write, _puts, _acks, _releases, _renewals)
+        except BaseException:
+            # Kept for the next flush
+            self._unsaved[:0] = _puts
+            self._unacked |= _acks
+            self._unreleased |= _releases
+            self._renewals |= _renewals
+            raise
+        self._backlog += len(_puts) + len(_releases)
+
+    def _write(self, puts: list, acks: set, releases: set, renewals: set):
+        # Runs in a thread. Acks and releases go first, so renewing those leases is a no-op
+        if puts:
+            self.store.put_entries([((entry.task_id, entry.item), entry.priority.value, entry.deadline) for entry in puts])
+        if acks:
+            self.store.ack(acks)
+        if releases:
+            self.store.release(releases)
+        if renewals:
+            self.store.extend(renewals, self.lease_seconds)
+
+    async def _fill_from_store(self):
+        '''Leases as many stored tasks as the agents have credit for'''
+        _credit = sum(max(0, agent.window - agent.in_flight) for agent in self._agents.values()) - len(self._pending)
+        while _credit > 0:
+            _leases = await asyncio.to_thread(self.store.lease, _credit, visibility_timeout = self.lease_seconds)
+            _expired = 0
+            for lease in _leases:
+                _task_id, _item = lease.item
+                if _task_id in self._leased or lease.id in self._unacked or lease.id in self._unreleased:
+                    # The lease ran out on a task this dispatcher still has, or is about to ack or hand back. It stays where it is
+                    if _task_id in self._leased:
+                        self._leased[_task_id].lease_until = lease.visible_at
+                    _expired += 1
+                    continue
+                _entry = _DispatchEntry(_task_id, _item, TaskPriority(lease.priority), lease.deadline, lease.id)
+                _entry.store_id = lease.id
+                _entry.lease_until = lease.visible_at
+                self._leased[_task_id] = _entry
+                heapq.heappush(self._pending, _entry)
+            self.counters['lease_expired'] += _expired
+            if len(_leases) < _credit:
+                self._backlog = 0 # The store ran dry
+                return
+            self._backlog = max(0, self._backlog - (len(_leases) - _expired))
+            _credit = _expired # Those are leased again for now, so the next round gets past them
+
+    def add_agent(self, name: str, slots: int = None, prefetch: int = None):
+        '''Registers an agent, or updates its credit window when it is already known'''
+        _slots = max(1, slots if slots is not None else self.default_slots)
+        _prefetch = max(0, prefetch if prefetch is not None else self.default_prefetch)
+        _agent = self._agents.get(name)
+        if _agent is None:
+            self._agents[name] = _AgentSlot(name, _slots, _prefetch)
+        else:
+            _agent.slots, _agent.prefetch = _slots, _prefetch
+
+    def remove_agent(self, name: str):
+        '''Forgets an agent and puts every task it held back in line. Returns how many were requeued'''
+        _agent = self._agents.pop(name, None)
+        if _agent is None:
+            return 0
+        self.counters['agents_lost'] += 1
+        for entry in _agent.assigned.values():
+            self._requeue(entry)
+        return len(_agent.assigned)
+
+    def _requeue(self, entry: _DispatchEntry):
+        entry.agent = None
+        entry.started = False
+        self.counters['requeued'] += 1
+        if self.store is not None and self._leased.pop(entry.task_id, None) is not None:
+            self._unreleased.add(entry.store_id) # Back in the store with the next flush, leased again in order with everything else
+            return
+        heapq.heappush(self._pending, entry)
+
+    def in_flight(self, name: str):
+        _agent = self._agents.get(name)
+        return _agent.in_flight if _agent is not None else 0
+
+    def started(self, name: str, task_id: str):
+        _agent = self._agents.get(name)
+        if _agent is not None and task_id in _agent.assigned:
+            _agent.assigned[task_id].started = True
+
+    def done(self, name: str, task_id: str, ok = True):
+        '''Frees the task's credit and returns the finished entry. Call :meth:`pump` afterwards to refill the agent'''
+        _agent = self._agents.get(name)
+        if _agent is None:
+            return None
+        _entry = _agent.assigned.pop(task_id, None)
+        _agent.stealing.discard(task_id)
+        if _entry is None:
+            return None
+        _agent.completed += 1
+        self.counters['completed' if ok else 'failed'] += 1
+        if _entry.deadline is not None and time.time() > _entry.deadline:
+            self.counters['missed_deadlines'] += 1
+        if self._leased.pop(task_id, None) is not None:
+            self._unacked.add(_entry.store_id) # Acked with the next flush
+        return _entry
+
+    def requeue(self, name: str, task_id: str):
+        '''The agent gave up on a task it started, e.g. because the Worker running it died or hung. It goes back in line for any agent'''
+        _agent = self._agents.get(name)
+        if _agent is None:
+            return None
+        _agent.stealing.discard(task_id)
+        _entry = _agent.assigned.pop(task_id, None)
+        if _entry is not None:
+            self._requeue(_entry)
+        return _entry
+
+    def returned(self, name: str, task_id: str, returned: bool):
+        '''Answer to a steal request. A returned task goes back in line, one the agent already started stays with it'''
+        _agent = self._agents.get(name)
+        if _agent is None:
+            return
+        _agent.stealing.discard(task_id)
+        _entry = _agent.assigned.get(task_id)
+        if _entry is None:
+            return
+        if returned:
+            del _agent.assigned[task_id]
+            self._requeue(_entry)
+            self.counters['stolen'] += 1
+        else:
+            _entry.started = True
+
+    def _pick_agent(self):
+        _open = [agent for agent in self._agents.values() if agent.in_flight < agent.window]
+        if not _open:
+            return None
+        return min(_open, key = lambda agent: (agent.in_flight / agent.slots, agent.in_flight))
+
+    async def pump(self):
+        '''Dispatches pending tasks while agents have credit, then lets idle agents steal'''
+        if self.store is not None:
+            async with self._store_lock:
+                await self._flush()
+                await self._fill_from_store()
+        while self._pending:
+            _agent = self._pick_agent()
+            if _agent is None:
+                break
+            _entry = heapq.heappop(self._pending)
+            _entry.agent = _agent.name
+            _agent.assigned[_entry.task_id] = _entry
+            self.counters['dispatched'] += 1
+            _data = {"task_id": _entry.task_id, "item": pack_object(_entry.item), "priority": _entry.priority.value, "deadline": _entry.deadline}
+            if not await self._send(_agent.name, "dispatch_task", _data):
+                # The agent is gone. Its tasks go back in line for the others
+                self.remove_agent(_agent.name)
+
+        if self.steal and not self._pending:
+            await self._steal()
+
+    async def _steal(self):
+        for thief in list(self._agents.values()):
+            if thief.running >= thief.slots or thief.queued:
+                continue # Busy, or still has work of its own waiting
+            _victims = [agent for agent in self._agents.values() if agent is not thief and len(agent.queued) > 0 and agent.running >= agent.slots]
+            if not _victims:
+                return
+            _victim = max(_victims, key = lambda agent: len(agent.queued))
+            _entry = max(_victim.queued) # The least urgent of its queued tasks
+            _victim.stealing.add(_entry.task_id)
+            await self._send(_victim.name, "steal_task", {"task_id": _entry.task_id})
+
+    def capacity(self):
+        '''(slots, held): tasks the agents take at once counting their prefetch windows, and tasks on this Node either way'''
+        _held = self._backlog + len(self._unsaved) + len(self._pending) + sum(agent.in_flight for agent in self._agents.values())
+        return sum(agent.window for agent in self._agents.values()), _held
+
+    def stats(self):
+        _now = time.perf_counter()
+        return dict(
+            self.counters,
+            pending = len(self._pending),
+            store = self.store.stats() if self.store is not None else None,
+            oldest_pending_seconds = round(max((_now - entry.submitted_at for entry in self._pending), default = 0.0), 4),
+            agents = {name: {"slots": agent.slots, "prefetch": agent.prefetch, "in_flight": agent.in_flight, "running": agent.running, "completed": agent.completed} for name, agent in self._agents.items()}
+        )
@@ -0,0 +1,209 @@
+import time
+import json
+import uuid
+import threading
+
+from collections import deque
+from contextlib import nullcontext
+
+# Stages a traced task is timed through. Browser actions are recorded per WorkerTask as "action.<TASK>"
+QUEUE_WAIT = "queue_wait" # Submitted on the Node until dispatched to an agent
+AGENT_QUEUE_WAIT = "agent_queue_wait" # Prefetched on the agent until a slot frees up
+WORKER_QUEUE_WAIT = "worker_queue_wait" # On the agent's Task Queue until a Worker has a page for it
+INFERENCE = "inference"
+WS_HOP = "ws_hop" # One websocket message, sender to receiver
+TASK_TOTAL = "task_total" # Submitted on the Node until reported done
+
+class Trace():
+    '''Timing of one task as it moves from the :class:`Node` to an :class:`Agent` and its :class:`Worker` and back.
+    It travels in message data as a plain dict (see :meth:`to_dict`), so each process adds the stages it saw to the same trace.
+    Timestamps crossing processes are wall clock, so websocket hops between machines are only as exact as their clocks.'''
+
+    def __init__(self, trace_id: str = None, spans: list = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.spans = spans if spans is not None else [] # [stage, seconds] in the order they were recorded
+        self.started_at = time.time() # When this process first saw the trace
+        self._marks = {} # name -> wall clock time, local to this process
+
+    def add(self, stage: str, seconds: float):
+        self.spans.append([stage, round(max(0.0, seconds), 6)])
+
+    def mark(self, name: str):
+        self._marks[name] = time.time()
+
+    def since(self, name: str, stage: str):
+        '''Records the time since :meth:`mark` was called with `name` as `stage`'''
+        _marked = self._marks.pop(name, None)
+        if _marked is not None:
+            self.add(stage, time.time() - _marked)
+
+    def span(self, stage: str):
+        return _Span(self, stage)
+
+    def to_dict(self):
+        '''The trace as message data. Stamped with the send time so the receiver can time the hop'''
+        return {"trace_id": self.trace_id, "spans": self.spans, "sent_at": time.time()}
+
+    @classmethod
+    def receive(cls, data: dict):
+        '''Rebuilds a trace sent with :meth:`to_dict` and records the hop it just made. `None` when the message wasn't traced'''
+        if not data:
+            return None
+        _trace = cls(data['trace_id'], list(data.get('spans', [])))
+        if data.get('sent_at') is not None:
+            _trace.add(WS_HOP, time.time() - data['sent_at'])
+        return _trace
+
+class _Span():
+    def __init__(self, trace: Trace, stage: str):
+        self._trace = trace
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._trace.add(self._stage, time.perf_counter() - self._start)
+        return False
+
+_NO_SPAN = nullcontext()
+
+def span(trace: Trace, stage: str):
+    '''Times the block as `stage` of `trace`. Costs next to nothing when the task isn't traced (`trace` is `None`)'''
+    return _NO_SPAN if trace is None else trace.span(stage)
+
+class StageHistogram():
+    '''Latency samples of one stage. Percentiles come from the last `window` samples, count and sum from all of them'''
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window = 2048):
+        self._samples = deque(maxlen = window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentiles(self):
+        _samples = sorted(self._samples)
+        if not _samples:
+            return {f"p{int(q * 100)}": 0.0 for q in self.QUANTILES}
+        return {f"p{int(q * 100)}": round(_samples[min(len(_samples) - 1, int(q * len(_samples)))], 6) for q in self.QUANTILES}
+
+    def stats(self):
+        return dict(self.percentiles(), count = self.count, sum = round(self.total, 6), max = round(self.max, 6))
+
+class MetricsRegistry():
+    '''Per-stage latency histograms and counters of a :class:`Node`. Thread-safe, since the metrics endpoint reads it from its own thread'''
+
+    def __init__(self, window = 2048):
+        self.window = window
+        self._stages = {} # stage -> StageHistogram
+        self.counters = {"traces": 0}
+        self._gauges = {} # name -> callable returning a number, read on export
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            _histogram = self._stages.get(stage)
+            if _histogram is None:
+                _histogram = self._stages[stage] = StageHistogram(self.window)
+            _histogram.observe(seconds)
+
+    def observe_trace(self, trace: Trace):
+        '''Adds every stage of a finished trace'''
+        for stage, seconds in trace.spans:
+            self.observe(stage, seconds)
+        with self._lock:
+            self.counters['traces'] += 1
+
+    def increment(self, name: str, amount = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name: str, read):
+        '''Exports `read()` as `name` whenever the metrics are read'''
+        self._gauges[name] = read
+
+    def stats(self):
+        with self._lock:
+            _stages = {stage: histogram.stats() for stage, histogram in sorted(self._stages.items())}
+            _counters = dict(self.counters)
+        _gauges = {}
+        for name, read in self._gauges.items():
+            try:
+                _gauges[name] = read()
+            except Exception:
+                _gauges[name] = None
+        return {"stages": _stages, "counters": _counters, "gauges": _gauges}
+
+    def prometheus(self, prefix = "soap"):
+        '''The metrics in the Prometheus text exposition format, stages as a summary'''
+        _stats = self.stats()
+        _lines = [f"# HELP {prefix}_stage_seconds Seconds a task spent in each stage", f"# TYPE {prefix}_stage_seconds summary"]
+        for stage, stats in _stats['stages'].items():
+            for q in StageHistogram.QUANTILES:
+                _lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{q}"}} {stats[f"p{int(q * 100)}"]}')
+            _lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+            _lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for name, value in _stats['counters'].items():
+            _lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        for name, value in _stats['gauges'].items():
+            if isinstance(value, (int, float)):
+                _lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+        return "\n".join(_lines) + "\n"
+
+class MetricsServer():
+    '''Serves a :class:`MetricsRegistry` over HTTP on its own thread: `/metrics` in Prometheus text, `/metrics.json` as JSON.
+    Binds to localhost by default, it is meant for a scraper or curl on the same machine'''
+
+    def __init__(self, registry: MetricsRegistry, host = "localhost", port = 9102):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # Only nodes serving metrics need it
+
+        _registry = self.registry
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                _path = self.path.split("?", 1)[0]
+                if _path == "/metrics":
+                    _body, _type = _registry.prometheus().encode(), "text/plain; version=0.0.4"
+                elif _path == "/metrics.json":
+                    _body, _type = json.dumps(_registry.stats()).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", _type)
+                self.send_header("Content-Length", str(len(_body)))
+                self.end_headers()
+                self.wfile.write(_body)
+
+            def log_message(self, *args):
+                pass # Scrapes would otherwise print a line each
+
+        self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target = self._server.serve_forever, name = "Thread-Metrics", daemon = True).start()
+        return self
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/metrics"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
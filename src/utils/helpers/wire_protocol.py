@@ -0,0 +1,356 @@
+'''Binary envelope used between the :class:`Node`, :class:`Agent`'s and :class:`Worker`'s once both ends have negotiated it.
+
+Layout (big endian):
+    header  | magic "SP" (2s) | version (B) | type code (B) |
+    type    | only when type code == 0: u16 length + utf-8 (message types without a code)
+    origin  | u16 length + utf-8
+    target  | u16 length + utf-8
+    data    | one typed value (see `_TAG_*`), normally a dict
+
+Instructions and :class:`WorkerTask`'s are typed values of their own, so they travel natively instead of as
+`jsonpickle` strings inside JSON. Clients that never negotiate keep talking JSON made by `create_ws_message`.'''
+
+import json
+import struct
+import uuid
+import asyncio
+
+from utils.helpers.constants import WorkerTask
+from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary/1"
+SUPPORTED_PROTOCOLS = [PROTOCOL_BINARY, PROTOCOL_JSON] # In order of preference
+
+MAGIC = b"SP"
+SCHEMA_VERSION = 1
+
+_HEADER = struct.Struct(">2sBB")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_I64 = struct.Struct(">q")
+_F64 = struct.Struct(">d")
+
+# Message types that get a one byte code. Anything else is sent as a string with code 0.
+# Only ever append to this list, the position of a type is its code on the wire
+MESSAGE_TYPES = [
+    "register",
+    "register_ack",
+    "function_invoke",
+    "agent_ready",
+    "agent_dequeue",
+    "node_add_queue_item",
+    "worker_complete",
+    "ping",
+    "heartbeat",
+    "inference_request",
+    "inference_result",
+    "get_inference_stats",
+    "inference_stats",
+    "pong",
+    "worker_cancel",
+    "worker_stop",
+    "get_worker_stats",
+    "worker_stats",
+    "dispatch_task",
+    "task_started",
+    "task_done",
+    "steal_task",
+    "task_returned",
+    "get_dispatch_stats",
+    "dispatch_stats",
+    "node_capacity",
+    "cluster_task_done",
+    "get_cluster_stats",
+    "cluster_stats",
+    "get_metrics",
+    "metrics",
+    "get_plan_stats",
+    "plan_stats",
+    "queue_full",
+    "get_prompt_stats",
+    "prompt_stats",
+    "inference_reserve",
+    "inference_release"
+]
+_TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES, start = 1)}
+
+_TAG_NONE = 0
+_TAG_TRUE = 1
+_TAG_FALSE = 2
+_TAG_INT = 3
+_TAG_FLOAT = 4
+_TAG_STR = 5
+_TAG_BYTES = 6
+_TAG_LIST = 7
+_TAG_DICT = 8
+_TAG_UUID = 9
+_TAG_WORKER_TASK = 10
+_TAG_SINGLE_INSTRUCTION = 11
+_TAG_MULTI_INSTRUCTION = 12
+
+_DEPENDENCY_FLAG = 0x80 # Set on an instruction's task byte when its id, after and new_page follow
+
+class WireProtocolError(Exception):
+    pass
+
+class _OutOfRange(WireProtocolError):
+    pass
+
+def choose_protocol(offered):
+    '''Picks the most preferred protocol both ends support. Falls back to JSON for clients that offered nothing'''
+    for protocol in SUPPORTED_PROTOCOLS:
+        if protocol in (offered or []):
+            return protocol
+    return PROTOCOL_JSON
+
+def protocol_of(raw):
+    '''Returns which protocol a raw WebSocket frame was encoded with'''
+    return PROTOCOL_BINARY if isinstance(raw, (bytes, bytearray, memoryview)) else PROTOCOL_JSON
+
+def encode_message(type, origin, target, data = {}, protocol = PROTOCOL_JSON):
+    '''Same as `create_ws_message` but encodes with the negotiated `protocol`.
+    With JSON, instructions and other objects are embedded as `jsonpickle` strings, exactly as older clients expect.'''
+    if protocol == PROTOCOL_BINARY:
+        try:
+            return _encode_binary(type, origin, target, data)
+        except _OutOfRange:
+            pass # An int past 64 bits. JSON has no limit, and every peer decodes JSON frames as well
+
+    _b = {
+        "type": type,
+        "origin": origin,
+        "target": target,
+        "data": data
+    }
+
+    return json.dumps(_b, default = _jsonpickle().encode)
+
+def decode_message(raw):
+    '''Decodes a frame of either protocol into the usual `{"type", "origin", "target", "data"}` dict'''
+    if protocol_of(raw) == PROTOCOL_BINARY:
+        return _decode_binary(raw)
+    return json.loads(raw)
+
+def pack_object(value):
+    '''The counterpart of :func:`unpack_object` for fields that may hold plain text, like a task that is a prompt.
+    Text is sent `jsonpickle`d as well, so it isn't mistaken for an object the receiver has to unpack'''
+    if isinstance(value, str):
+        return _jsonpickle().encode(value)
+    return value
+
+def unpack_object(value):
+    '''Returns the object behind a field that JSON clients send as a `jsonpickle` string and binary clients send natively'''
+    if isinstance(value, str):
+        try:
+            return _jsonpickle().decode(value)
+        except ValueError as e:
+            raise WireProtocolError(f"Malformed jsonpickle value: {e}") from e
+    return value
+
+def _jsonpickle():
+    # Only the JSON fallback needs it, so binary peers never import it
+    import jsonpickle
+    return jsonpickle
+
+async def negotiate(ws, name: str, role: str, groups: list = None, timeout: float = 2):
+    '''Registers `name` with the :class:`Node` over `ws` and returns the protocol to use for every following message.
+    Nodes that predate negotiation never answer, in which case JSON is used.'''
+    await ws.send(encode_message(type = "register", origin = name, target = "node", data = {"role": role, "groups": groups or [], "protocols": SUPPORTED_PROTOCOLS}))
+    try:
+        _ack = decode_message(await asyncio.wait_for(ws.recv(), timeout))
+    except asyncio.TimeoutError:
+        return PROTOCOL_JSON
+
+    if _ack['type'] != "register_ack":
+        return PROTOCOL_JSON
+    return _ack['data'].get('protocol', PROTOCOL_JSON)
+
+def _encode_binary(type, origin, target, data):
+    _buf = bytearray()
+    _code = _TYPE_CODES.get(type, 0)
+    _buf += _HEADER.pack(MAGIC, SCHEMA_VERSION, _code)
+    if _code == 0:
+        _write_short_str(_buf, type)
+    _write_short_str(_buf, origin)
+    _write_short_str(_buf, target)
+    _write_value(_buf, data)
+
+    return bytes(_buf)
+
+def _decode_binary(raw):
+    try:
+        return _decode_envelope(memoryview(raw))
+    except (struct.error, IndexError, ValueError) as e: # Truncated frames, bad utf-8, unknown task codes
+        raise WireProtocolError(f"Malformed binary envelope: {e}") from e
+
+def _decode_envelope(view):
+    _magic, _version, _code = _HEADER.unpack_from(view, 0)
+    if _magic != MAGIC:
+        raise WireProtocolError("Frame does not start with the binary envelope magic")
+    if _version > SCHEMA_VERSION:
+        raise WireProtocolError(f"Binary envelope version {_version} is newer than supported version {SCHEMA_VERSION}")
+
+    _offset = _HEADER.size
+    if _code == 0:
+        type, _offset = _read_short_str(view, _offset)
+    elif _code <= len(MESSAGE_TYPES):
+        type = MESSAGE_TYPES[_code - 1]
+    else: # Appended to MESSAGE_TYPES by a newer peer
+        raise WireProtocolError(f"Unknown message type code {_code} in binary envelope")
+    origin, _offset = _read_short_str(view, _offset)
+    target, _offset = _read_short_str(view, _offset)
+    data, _offset = _read_value(view, _offset)
+
+    return {
+        "type": type,
+        "origin": origin,
+        "target": target,
+        "data": data
+    }
+
+def _write_short_str(buf, s):
+    _encoded = s.encode("utf-8")
+    buf += _U16.pack(len(_encoded))
+    buf += _encoded
+
+def _read_short_str(view, offset):
+    (_length,) = _U16.unpack_from(view, offset)
+    offset += _U16.size
+    return str(_take(view, offset, _length), "utf-8"), offset + _length
+
+def _take(view, offset, length):
+    # Slicing past the end would quietly return less
+    if offset + length > len(view):
+        raise WireProtocolError(f"Binary envelope truncated, {length} bytes expected at offset {offset} of {len(view)}")
+    return view[offset:offset + length]
+
+def _write_value(buf, value):
+    # Order matters: bool is a subclass of int
+    if value is None:
+        buf.append(_TAG_NONE)
+    elif value is True:
+        buf.append(_TAG_TRUE)
+    elif value is False:
+        buf.append(_TAG_FALSE)
+    elif isinstance(value, WorkerTask):
+        buf.append(_TAG_WORKER_TASK)
+        buf.append(value.value)
+    elif isinstance(value, int):
+        if not -2 ** 63 <= value < 2 ** 63:
+            raise _OutOfRange(f"{value} doesn't fit the binary envelope's 64 bit ints")
+        buf.append(_TAG_INT)
+        buf += _I64.pack(value)
+    elif isinstance(value, float):
+        buf.append(_TAG_FLOAT)
+        buf += _F64.pack(value)
+    elif isinstance(value, str):
+        _encoded = value.encode("utf-8")
+        buf.append(_TAG_STR)
+        buf += _U32.pack(len(_encoded))
+        buf += _encoded
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        buf.append(_TAG_BYTES)
+        buf += _U32.pack(len(value))
+        buf += value
+    elif isinstance(value, (list, tuple)):
+        buf.append(_TAG_LIST)
+        buf += _U32.pack(len(value))
+        for item in value:
+            _write_value(buf, item)
+    elif isinstance(value, dict):
+        buf.append(_TAG_DICT)
+        buf += _U32.pack(len(value))
+        for key, item in value.items():
+            _write_short_str(buf, str(key))
+            _write_value(buf, item)
+    elif isinstance(value, uuid.UUID):
+        buf.append(_TAG_UUID)
+        buf += value.bytes
+    elif isinstance(value, SingleInstruction):
+        buf.append(_TAG_SINGLE_INSTRUCTION)
+        _write_single_instruction(buf, value)
+    elif isinstance(value, MultiInstruction):
+        _actions = value.get_action_list()
+        buf.append(_TAG_MULTI_INSTRUCTION)
+        buf += _U32.pack(len(_actions))
+        for instruction in _actions:
+            _write_single_instruction(buf, instruction)
+    else:
+        raise WireProtocolError(f"Can't encode value of type {type(value).__name__} in the binary envelope")
+
+def _write_single_instruction(buf, instruction: SingleInstruction):
+    if not instruction.has_dependencies: # Sequential instructions stay as compact as before
+        buf.append(instruction.task.value)
+        _write_value(buf, instruction.action)
+        return
+    buf.append(instruction.task.value | _DEPENDENCY_FLAG)
+    _write_value(buf, instruction.action)
+    _write_value(buf, instruction.id)
+    _write_value(buf, instruction.after)
+    _write_value(buf, bool(instruction.new_page))
+
+def _read_single_instruction(view, offset):
+    _code = view[offset]
+    _task = WorkerTask(_code & ~_DEPENDENCY_FLAG)
+    _action, offset = _read_value(view, offset + 1)
+    if not _code & _DEPENDENCY_FLAG:
+        return SingleInstruction(_task, _action), offset
+    _id, offset = _read_value(view, offset)
+    _after, offset = _read_value(view, offset)
+    _new_page, offset = _read_value(view, offset)
+    return SingleInstruction(_task, _action, id = _id, after = _after, new_page = _new_page), offset
+
+def _read_value(view, offset):
+    _tag = view[offset]
+    offset += 1
+    if _tag == _TAG_NONE:
+        return None, offset
+    if _tag == _TAG_TRUE:
+        return True, offset
+    if _tag == _TAG_FALSE:
+        return False, offset
+    if _tag == _TAG_INT:
+        return _I64.unpack_from(view, offset)[0], offset + _I64.size
+    if _tag == _TAG_FLOAT:
+        return _F64.unpack_from(view, offset)[0], offset + _F64.size
+    if _tag == _TAG_STR:
+        (_length,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        return str(_take(view, offset, _length), "utf-8"), offset + _length
+    if _tag == _TAG_BYTES:
+        (_length,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        return bytes(_take(view, offset, _length)), offset + _length
+    if _tag == _TAG_LIST:
+        (_count,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        _items = []
+        for _ in range(_count):
+            _item, offset = _read_value(view, offset)
+            _items.append(_item)
+        return _items, offset
+    if _tag == _TAG_DICT:
+        (_count,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        _d = {}
+        for _ in range(_count):
+            _key, offset = _read_short_str(view, offset)
+            _d[_key], offset = _read_value(view, offset)
+        return _d, offset
+    if _tag == _TAG_UUID:
+        return uuid.UUID(bytes = bytes(_take(view, offset, 16))), offset + 16
+    if _tag == _TAG_WORKER_TASK:
+        return WorkerTask(view[offset]), offset + 1
+    if _tag == _TAG_SINGLE_INSTRUCTION:
+        return _read_single_instruction(view, offset)
+    if _tag == _TAG_MULTI_INSTRUCTION:
+        (_count,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        _instructions = []
+        for _ in range(_count):
+            _instruction, offset = _read_single_instruction(view, offset)
+            _instructions.append(_instruction)
+        return MultiInstruction(_instructions), offset
+
+    raise WireProtocolError(f"Unknown value tag {_tag} in binary envelope")
@@ -1,16 +1,115 @@
+import copy
+
+from utils.helpers.constants import WorkerTask
+
 class SingleInstruction():
-    def __init__(self, task, action):
+    '''One browser action. Inside a :class:`MultiInstruction` it follows the instruction before it on the same page, unless it
+    starts a page of its own (`new_page`) or follows the instruction named `after` (its `id`)'''
+    def __init__(self, task, action, id: str = None, after: str = None, new_page = False):
         self.task = task
         self.action = action
+        self.id = id # Lets later instructions of a MultiInstruction name this one in `after`
+        self.after = after # id of the instruction this one follows, on that instruction's page
+        self.new_page = new_page # Starts a branch on a page of its own, independent of everything before it
+
+    @property
+    def has_dependencies(self):
+        # Instructions unpickled from before these fields existed have none
+        return getattr(self, "id", None) is not None or getattr(self, "after", None) is not None or getattr(self, "new_page", False)
 
     def get_action_list(self):
         '''Returns a list of :class:`SingleInstructions`'s'''
         return [self]
 
 class MultiInstruction():
-    '''Takes in a list of :class:`SingleInstruction`'s and manages each instruction'''
+    '''Takes in a list of :class:`SingleInstruction`'s and manages each instruction.
+    By default they run one after another on one page. Instructions that start a `new_page` begin an independent branch, and
+    everything following them (the next instructions, or those naming one of them in `after`) runs on that branch's page, in
+    list order. A :class:`Worker` runs the branches concurrently, each on a page of its own, as far as it has pages to spare.
+    Pages share no state, so an instruction depends on exactly one other: the one whose page it continues.'''
     def __init__(self, instructions: list[SingleInstruction]):
         self._instructions = instructions
 
+    @classmethod
+    def parallel(cls, *branches: list):
+        '''Builds a MultiInstruction of independent branches, each a list of instructions run in order on a page of its own.
+        E.g. `MultiInstruction.parallel(*[[SingleInstruction(WorkerTask.GOTO, url), SingleInstruction(WorkerTask.SCREENSHOT, None)] for url in urls])`
+        The instructions are copied, the ones passed in are left as they are'''
+        _instructions = []
+        for branch in branches:
+            for n, instruction in enumerate(branch):
+                instruction = copy.copy(instruction) # May be shared with another MultiInstruction or a cached plan
+                instruction.new_page = n == 0
+                instruction.after = None
+                _instructions.append(instruction)
+        return cls(_instructions)
+
     def get_action_list(self):
-        return [single_instruction for single_instruction in self._instructions]
\ No newline at end of file
+        return [single_instruction for single_instruction in self._instructions]
+
+    def branches(self):
+        '''Splits the instructions into the branches that may run concurrently. Returns lists of instructions, each run in order
+        on one page, ordered by where the branch starts. Raises `ValueError` when `after` names an id not defined before it'''
+        _branches = []
+        _branch_of = {} # instruction id -> index of its branch
+        _current = 0
+        for instruction in self._instructions:
+            _after = getattr(instruction, "after", None)
+            if getattr(instruction, "new_page", False) or (not _branches and _after is None):
+                _branch = len(_branches)
+                _branches.append([])
+            elif _after is not None:
+                if _after not in _branch_of:
+                    raise ValueError(f"Instruction {instruction.task.name} follows {_after!r}, which isn't an earlier instruction's id")
+                _branch = _branch_of[_after]
+            else:
+                _branch = _current # Follows the instruction before it
+            _branches[_branch].append(instruction)
+            if getattr(instruction, "id", None) is not None:
+                _branch_of[instruction.id] = _branch
+            _current = _branch
+        return _branches
+
+class InstructionStreamParser():
+    '''Turns model output into :class:`SingleInstruction`'s while it is still being generated.
+    Each instruction is one line, `<TASK> [action]`, e.g. `GOTO https://google.com` or `SCREENSHOT`.
+    Leading list markers like `1.` or `-` are ignored, as is any line that doesn't start with a :class:`WorkerTask` name.
+    An instruction is emitted as soon as its line ends, so a :class:`Worker` can start on it while later lines are still generating.'''
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text: str):
+        '''Adds newly generated text and returns every instruction it completed'''
+        self._buffer += text
+        _instructions = []
+        while "\n" in self._buffer:
+            _line, self._buffer = self._buffer.split("\n", 1)
+            _instruction = self.parse_line(_line)
+            if _instruction is not None:
+                _instructions.append(_instruction)
+        return _instructions
+
+    def close(self):
+        '''Flushes the last line, which has no trailing newline once generation stops'''
+        _line, self._buffer = self._buffer, ""
+        _instruction = self.parse_line(_line)
+        return [] if _instruction is None else [_instruction]
+
+    @classmethod
+    def parse(cls, text: str):
+        '''Every instruction in a finished generation'''
+        _parser = cls()
+        return _parser.feed(text) + _parser.close()
+
+    @staticmethod
+    def parse_line(line: str):
+        _parts = line.strip().lstrip("-*0123456789.) ").split(None, 1)
+        if not _parts:
+            return None
+        _name = _parts[0].rstrip(":").upper()
+        if _name not in WorkerTask.__members__:
+            return None
+
+        _action = _parts[1].strip() if len(_parts) > 1 else None
+        return SingleInstruction(WorkerTask[_name], _action)
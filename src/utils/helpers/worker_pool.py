@@ -0,0 +1,229 @@
+import time
+import uuid
+import queue
+import asyncio
+import threading
+import multiprocessing
+
+from multiprocessing import Queue
+
+from utils.console import print_substep
+from utils.helpers.backpressure import Backpressure
+
+from worker import Worker
+
+WORKER_MODES = ("thread", "process")
+
+class _ParentRef():
+    '''Stands in for the parent :class:`Agent` of a process worker, which only needs its name to report back'''
+
+    def __init__(self, agent_name: str):
+        self.agent_name = agent_name
+
+def _run_process_worker(agent_name: str, task_queue, uid, worker_kwargs: dict):
+    '''Entry point of a process worker. Imports here so the child only pays for them once it exists'''
+    from engines import prepare_engine
+    from utils.helpers.screenshot_pipeline import ScreenshotPipeline
+
+    _kwargs = dict(worker_kwargs)
+    prepare_engine(_kwargs.get('engine', "playwright"))
+    _kwargs['screenshots'] = ScreenshotPipeline(preset = _kwargs.pop('vision_preset'))
+    Worker(parent_agent = _ParentRef(agent_name), task_queue = task_queue, uid = uid, **_kwargs).sync_start()
+
+class _PooledWorker():
+    def __init__(self, name, runner, worker = None):
+        self.name = name
+        self.runner = runner # Thread or Process
+        self.worker = worker # Only for thread workers, process workers live in another address space
+        self.started_at = time.time()
+
+class WorkerPool():
+    '''Elastic pool of :class:`Worker`'s for one :class:`Agent`, all pulling from the agent's Task Queue and reused across tasks.
+    Keeps at least `min_workers` running, adds one whenever the tasks outstanding exceed what the running workers can take at
+    once (each works `max_pages` tasks concurrently), up to `max_workers`, and retires one once the pool could have done
+    without it for `idle_timeout` seconds. `mode` runs workers as threads of the agent process or as processes of their own.
+    With `max_outstanding` set, :meth:`submit` raises `queue.Full` instead of queueing past it, until the tasks outstanding
+    drained back to the low watermark (see :class:`Backpressure`).'''
+
+    def __init__(self, parent_agent, task_queue: Queue, min_workers = 1, max_workers = 4, idle_timeout = 60, mode = "thread", max_pages = 4, engine = "playwright", vision_preset = "llava", screenshots = None, node_url: str = None, heartbeat_interval = 5, max_branches: int = None, max_outstanding: int = None):
+        assert mode in WORKER_MODES, f"Unknown worker mode {mode}, expected one of {WORKER_MODES}"
+        assert 0 <= min_workers <= max_workers, "Need 0 <= min_workers <= max_workers"
+        self._parent_agent = parent_agent
+        self.task_queue = task_queue
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.mode = mode
+        self.max_pages = max_pages
+        self._engine = engine
+        self._vision_preset = vision_preset
+        self._screenshots = screenshots # Shared by thread workers. Process workers build their own
+        self._node_url = node_url
+        self._heartbeat_interval = heartbeat_interval
+        self._max_branches = max_branches
+        self._workers = {} # worker name -> _PooledWorker
+        self._retiring = 0 # Stop requests put on the queue that no worker has acted on yet
+        self._outstanding = 0 # Tasks submitted and not yet reported complete
+        self.admission = Backpressure(max_outstanding) if max_outstanding else None # Credits the agent hands out to its Workers
+        self._lock = threading.Lock()
+        self._over_capacity_since = time.perf_counter() # Last moment every running worker was needed
+        self._busy_seconds = 0.0 # Page slots in use integrated over time, for utilization
+        self._capacity_seconds = 0.0 # Page slots available integrated over time
+        self._last_tick = time.perf_counter()
+        self._maintenance = None
+        self.counters = {"submitted": 0, "completed": 0, "spawned": 0, "retired": 0, "died": 0, "evicted": 0, "peak_workers": 0}
+
+    def __contains__(self, worker):
+        return getattr(worker, "worker_name", worker) in self._workers
+
+    def __len__(self):
+        return len(self._workers)
+
+    @property
+    def size(self):
+        '''Workers running and not asked to stop'''
+        return len(self._workers) - self._retiring
+
+    def capacity(self):
+        return self.size * self.max_pages
+
+    def _tick(self):
+        _now = time.perf_counter()
+        _capacity = self.capacity()
+        self._busy_seconds += min(self._outstanding, _capacity) * (_now - self._last_tick)
+        self._capacity_seconds += _capacity * (_now - self._last_tick)
+        self._last_tick = _now
+        return _now
+
+    def submit(self, task, block = True, timeout = None, task_id: str = None, trace = None):
+        '''Puts a task on the Task Queue, adding a worker first when the running ones are all busy.
+        The Worker echoes `task_id` back in its `worker_complete`, along with `trace` once it added its stages.
+        Raises `queue.Full` when the pool has `max_outstanding` tasks already'''
+        with self._lock:
+            if self.admission is not None and not self.admission.admit(self._outstanding):
+                raise queue.Full(f"{self._outstanding} tasks outstanding, retry in {self.admission.retry_after()} s")
+            self._tick()
+            self._outstanding += 1
+            self.counters['submitted'] += 1
+            if self._outstanding > self.capacity() and self.size < self.max_workers:
+                self._spawn()
+        try:
+            if trace is not None:
+                trace.mark("worker_queued")
+                self.task_queue.put((task_id, task, trace), block, timeout)
+            else:
+                self.task_queue.put((task_id, task) if task_id is not None else task, block, timeout)
+        except BaseException:
+            with self._lock:
+                self._outstanding -= 1
+                self.counters['submitted'] -= 1
+            raise
+
+    def task_done(self):
+        '''Called for every `worker_complete`, whatever the result'''
+        with self._lock:
+            self._tick()
+            self._outstanding = max(0, self._outstanding - 1)
+            self.counters['completed'] += 1
+            if self.admission is not None:
+                self.admission.drained()
+                self.admission.update(self._outstanding)
+
+    def _spawn(self):
+        _uid = uuid.uuid4()
+        _name = self._parent_agent.agent_name + "_Worker-" + _uid.hex
+        print_substep(f"{self._parent_agent.agent_name}: Employing new Worker with UUID: {_uid}", style = "bright_blue")
+        if self.mode == "thread":
+            _worker = Worker(parent_agent = self._parent_agent, task_queue = self.task_queue, uid = _uid, engine = self._engine, max_pages = self.max_pages, screenshots = self._screenshots, node_url = self._node_url, heartbeat_interval = self._heartbeat_interval, max_branches = self._max_branches)
+            _runner = threading.Thread(target = _worker.sync_start, name = f"Thread-{_name}", daemon = True)
+        else:
+            _worker = None
+            _kwargs = {"engine": self._engine, "max_pages": self.max_pages, "vision_preset": self._vision_preset, "node_url": self._node_url, "heartbeat_interval": self._heartbeat_interval, "max_branches": self._max_branches}
+            _runner = multiprocessing.Process(target = _run_process_worker, args = (self._parent_agent.agent_name, self.task_queue, _uid, _kwargs), name = f"Process-{_name}", daemon = True)
+        _runner.start()
+        self._workers[_name] = _PooledWorker(_name, _runner, _worker)
+        self.counters['spawned'] += 1
+        self.counters['peak_workers'] = max(self.counters['peak_workers'], len(self._workers))
+
+    def evict(self, name: str, tasks = 0):
+        '''Drops a worker that stopped sending heartbeats, so :meth:`maintain` replaces it. A process worker is terminated.
+        A thread worker can't be, it is told to exit should it ever get unstuck. `tasks` it held no longer count as outstanding'''
+        with self._lock:
+            self._tick()
+            _pooled = self._workers.pop(name, None)
+            if _pooled is None:
+                return False
+            self._outstanding = max(0, self._outstanding - tasks)
+            if _pooled.worker is not None:
+                _pooled.worker._stopping = True
+            else:
+                _pooled.runner.terminate()
+            self.counters['evicted'] += 1
+            return True
+
+    def _retire_one(self):
+        # Whichever worker takes the stop item exits after its tasks in flight, so no task is cut short
+        self._retiring += 1
+        self.task_queue.put(Worker.STOP)
+
+    def maintain(self):
+        '''Reaps exited workers, tops the pool back up to `min_workers` and retires a worker that has been surplus for `idle_timeout`'''
+        with self._lock:
+            _now = self._tick()
+            for name, pooled in list(self._workers.items()):
+                if not pooled.runner.is_alive():
+                    del self._workers[name]
+                    if self._retiring > 0:
+                        self._retiring -= 1
+                        self.counters['retired'] += 1
+                    else:
+                        self.counters['died'] += 1
+
+            while self.size < self.min_workers or (self._outstanding > self.capacity() and self.size < self.max_workers):
+                self._spawn()
+
+            # The pool could do without one worker while the outstanding tasks fit on the rest
+            if self._outstanding > (self.size - 1) * self.max_pages:
+                self._over_capacity_since = _now
+            elif self.size > self.min_workers and _now - self._over_capacity_since >= self.idle_timeout:
+                self._retire_one()
+                self._over_capacity_since = _now
+
+    async def _maintenance_loop(self, interval):
+        while True:
+            self.maintain()
+            await asyncio.sleep(interval)
+
+    def start(self, interval = 1.0):
+        '''Brings the pool up to `min_workers` and maintains it in the background of the running event loop'''
+        if self._maintenance is None or self._maintenance.done():
+            self._maintenance = asyncio.get_running_loop().create_task(self._maintenance_loop(interval))
+
+    def stop(self):
+        '''Asks every worker to exit once the tasks queued before this call are done'''
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            self._maintenance = None
+        with self._lock:
+            for _ in range(self.size):
+                self._retire_one()
+
+    def stats(self):
+        '''Pool size and utilization, for capacity planning'''
+        with self._lock:
+            self._tick()
+            _capacity = self.capacity()
+            return dict(
+                self.counters,
+                mode = self.mode,
+                size = self.size,
+                retiring = self._retiring,
+                min_workers = self.min_workers,
+                max_workers = self.max_workers,
+                max_pages = self.max_pages,
+                outstanding = self._outstanding,
+                admission = self.admission.stats() if self.admission is not None else None,
+                utilization = round(min(self._outstanding, _capacity) / _capacity, 3) if _capacity else 0.0,
+                busy_worker_seconds = round(self._busy_seconds / self.max_pages, 3),
+                average_utilization = round(self._busy_seconds / self._capacity_seconds, 3) if self._capacity_seconds else 0.0
+            )
@@ -1,21 +1,22 @@
+import uuid
+import queue
 import asyncio
-import websockets
-import jsonpickle
-import json
 import platform
 
-from playwright.async_api import async_playwright
-
-from selenium import webdriver
-from selenium.webdriver import ChromeOptions
-from selenium.webdriver.common.action_chains import ActionChains
+from collections import deque
 
 from multiprocessing import Queue
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.helpers.constants import WorkerState, WorkerTask
+from utils.helpers.constants import WorkerState, WorkerTask, node_url as default_node_url
 from utils.helpers.worker_helpers import SingleInstruction, MultiInstruction
-from utils.helpers.all_helpers import create_ws_message
-from utils.console import print_substep, print_step, print_table
+from utils.helpers.screenshot_pipeline import ScreenshotPipeline
+from utils.helpers.wire_protocol import PROTOCOL_JSON, decode_message, encode_message, negotiate
+from utils.helpers.tracing import WORKER_QUEUE_WAIT, Trace, span
+from utils.console import DEBUG, print_substep, print_step, log_table, log_enabled
+
+from engines import BrowserEngine, DEFAULT_ENGINE, get_engine
+from engines.base import split_type_action
 
 
 class Worker():
@@ -24,13 +25,28 @@ class Worker():
     A :class:`Worker` is attached to an :class:`Agent` by calling the `.attach_worker()` within the parent :class:`Agent`.
     A :class:`Worker` CAN report back to the :class:`Agent` to perform succeeding tasks. The Worker is the one who give the :class:`Agent` the OK to move on to the next task'''
 
-    def __init__(self, parent_agent, task_queue: Queue, uid):
+    STOP = "__stop_worker__" # Task Queue item that makes whichever Worker takes it finish its tasks in flight and exit
+
+    def __init__(self, parent_agent, task_queue: Queue, uid, engine = DEFAULT_ENGINE, max_pages = 4, screenshots: ScreenshotPipeline = None, node_url: str = None, heartbeat_interval = 5, max_branches: int = None):
         self.is_working = False
         self.status: WorkerState = WorkerState.IDLE
         self._parent_agent = parent_agent
         self.worker_uuid = uid.hex
         self.task_queue = task_queue
         self.worker_name = self._parent_agent.agent_name + "_Worker-" + self.worker_uuid
+        self.protocol = PROTOCOL_JSON # Wire protocol negotiated with the Node on connect
+        self.node_url = node_url or default_node_url()
+        self.engine: BrowserEngine = engine if isinstance(engine, BrowserEngine) else get_engine(engine, max_pages = max_pages) # Drives the browser pages
+        self.screenshots = screenshots or ScreenshotPipeline() # Resizes, dedupes and stores captures off the event loop
+        self.max_branches = max_branches or self.engine.max_pages # Pages one task may use at once for the independent branches of a MultiInstruction
+        self.current_task = None # The most recently started task
+        self._executions = set() # asyncio tasks running instructions, one per open page, so they can be cancelled
+        self._running = {} # task_id -> asyncio task running it, for tasks dispatched by the Node. Reported in every heartbeat
+        self.heartbeat_interval = heartbeat_interval # Seconds between heartbeats to the parent Agent, which requeues this Worker's tasks if they stop
+        self._capacity = None # Free page slots. Created inside the worker's event loop
+        self._stopping = False
+        self._intake = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f"Intake-{self.worker_uuid}") # Waits on the multiprocessing queue off the event loop
+        self.intake_poll_interval = 0.5 # Seconds between checks for a stop request while waiting on the queue
         self.web_driver_path = "webdrivers/chromedriver-win64/chromedriver.exe" if platform.system() == "Windows" else "webdrivers/chromdriver-linux64/chromedriver"
 
     def sync_start(self):
@@ -49,84 +65,238 @@ class Worker():
     async def start(self):
         '''Starts the :class:`Worker`. Initially, the worker will run through it's first retrieved task, then listen for websocket messages.
         Only run this method once as it would break this current worker process to have this ran twice.'''
+        from utils.helpers.local_transport import connect # Imported once a Worker runs, not when its module is. Uses the Node's local socket when it can
+
         print_step(f"{self.worker_name} with ID {self.worker_uuid} initialized!", style = "green1")
-        await self.start_selenium() # Start selenium preemptively
-        async with websockets.connect("ws://localhost:5002", ping_timeout = None) as ws:
+        async with connect(self.node_url, ping_timeout = None) as ws:
             self.ws = ws
+            self.protocol = await negotiate(ws, self.worker_name, role = "worker")
+            await self.engine.start() # Launch the browser before the first task needs it
             print_substep(f"{self.worker_name}: Connected and awaiting task...", style = "green1")
-            while True:
-                # Wait for task
-                self.current_task = self.task_queue.get(block = True, timeout = None)
-                # Perform the task NOTE: During task execution, messages will not be received by the client
-                await self.give_instructions(self.current_task)
-                # Wait for new messages when task is fully complete
-                res = await ws.recv() # TODO: Test full messging system, and ensure all communication is success. Still needs messaging system for give agent tasks. Queue system from node to agent.
-                res = json.loads(res)
-                print(res)
-
-    async def start_selenium(self):
-        print_substep(f"{self}: Selenium starting...", style = "bright_blue")
-        self.status = WorkerState.STARTING
-        # Start selenium in headless ChromeDriver
-        self._chrome_options = ChromeOptions()
-        self._chrome_options.add_argument("--headless=new")
-        self._chrome_options.add_argument("--log-level=3")
-        self.web_driver = webdriver.Chrome(options = self._chrome_options)
-        # Set back to idle after browser is launched
-        self.status = WorkerState.IDLE
-
-    def stop_selenium(self):
-        '''Rough close. Selenium will not wait for current action to be done, will just straight up close the WebDriver.'''
-        print_substep(f"Selenium stopping on {self}...", style = "bright_blue")
-        self.status = WorkerState.STOPPING
-
-        self.web_driver.close()
-
-    async def give_instructions(self, instructions: SingleInstruction):
+            _receiver = asyncio.get_running_loop().create_task(self._receive(ws)) # Messages are handled while idle and while executing
+            _heartbeat = asyncio.get_running_loop().create_task(self.heartbeat())
+            self._capacity = asyncio.Semaphore(self.engine.max_pages)
+            try:
+                while not self._stopping:
+                    # Only take a task when a page is free, so tasks left in the queue stay available to other Workers
+                    await self._capacity.acquire()
+                    # Wait for task without blocking the event loop
+                    _task = await self._next_task()
+                    if _task is None or _task == self.STOP:
+                        self._stopping = self._stopping or _task == self.STOP
+                        self._capacity.release()
+                        continue
+                    _task_id, _trace = None, None
+                    if isinstance(_task, tuple): # (task_id, task) from a task dispatched by the Node, (task_id, task, trace) when it is traced
+                        _task_id, _task, _trace = _task if len(_task) == 3 else (*_task, None)
+                    self.current_task = _task
+                    # Run it next to any other tasks in flight. The next one is pulled as soon as a page frees up
+                    _execution = asyncio.get_running_loop().create_task(self._execute(_task, _task_id, _trace))
+                    self._executions.add(_execution)
+                    _execution.add_done_callback(self._executions.discard)
+                    if _task_id is not None:
+                        self._running[_task_id] = _execution
+                        _execution.add_done_callback(lambda _, task_id = _task_id: self._running.pop(task_id, None))
+                if self._executions:
+                    await asyncio.gather(*self._executions, return_exceptions = True) # Let in-flight tasks finish on stop
+            finally:
+                _receiver.cancel()
+                _heartbeat.cancel()
+                self._intake.shutdown(wait = False)
+                await self.engine.stop()
+
+    async def _execute(self, task, task_id = None, trace: Trace = None):
+        '''Runs one task on a page of its own and reports the result'''
+        if trace is not None:
+            trace.since("worker_queued", WORKER_QUEUE_WAIT)
+        try:
+            async with self.engine.page() as page:
+                await self.give_instructions(task, page, task_id = task_id, trace = trace)
+        except asyncio.CancelledError:
+            print_substep(f"{self}: Task cancelled.", style = "gold3")
+            await self.report_completion(task, result = "cancelled", task_id = task_id, trace = trace)
+        except Exception as e:
+            print_substep(f"{self}: Task failed: {type(e).__name__}: {e}", style = "red1")
+            await self.report_completion(task, result = "failed", task_id = task_id, trace = trace)
+        finally:
+            self._capacity.release()
+
+    def _blocking_get(self, timeout: float = None):
+        '''Runs on the intake thread. Polls so a stop request is noticed even while the queue stays empty'''
+        _waited = 0.0
+        while not self._stopping:
+            try:
+                return self.task_queue.get(timeout = self.intake_poll_interval)
+            except queue.Empty:
+                _waited += self.intake_poll_interval
+                if timeout is not None and _waited >= timeout:
+                    return None
+        return None
+
+    async def _next_task(self, timeout: float = None):
+        '''Waits for the next task from the Task Queue without blocking the event loop. Returns `None` after `timeout` seconds or on stop'''
+        return await asyncio.get_running_loop().run_in_executor(self._intake, self._blocking_get, timeout)
+
+    async def heartbeat(self):
+        '''Tells the parent :class:`Agent` every `heartbeat_interval` seconds that this Worker is alive and which tasks it runs.
+        The tasks of a Worker whose heartbeats stop, because its process died or its event loop is stuck, are run by another'''
+        while True:
+            try:
+                await self.ws.send(encode_message(type = "heartbeat", origin = self.worker_name, target = self._parent_agent.agent_name, data = {"tasks": list(self._running)}, protocol = self.protocol))
+            except Exception as e:
+                print_substep(f"{self}: Couldn't send heartbeat: {type(e).__name__}: {e}", style = "red1")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _receive(self, ws):
+        async for message in ws:
+            try:
+                await self._parse(decode_message(message))
+            except Exception as e:
+                print_substep(f"{self}: Couldn't handle message: {type(e).__name__}: {e}", style = "red1")
+
+    async def _parse(self, msg):
+        if msg['type'] == "ping":
+            await self.ws.send(encode_message(type = "pong", origin = self.worker_name, target = msg['origin'], protocol = self.protocol))
+        elif msg['type'] == "worker_cancel": # Abandon the running tasks, or only the one given, and keep working
+            _task_id = (msg.get('data') or {}).get('task_id')
+            if _task_id is None:
+                _executions = list(self._executions)
+            else:
+                _executions = [self._running[_task_id]] if _task_id in self._running else []
+            for execution in _executions:
+                execution.cancel()
+        elif msg['type'] == "worker_stop": # Finish the current task, then exit
+            self._stopping = True
+
+    async def give_instructions(self, instructions: SingleInstruction, page, task_id = None, trace: Trace = None):
         if isinstance(instructions, SingleInstruction) or isinstance(instructions, MultiInstruction):
-            _i = 1
-            for instruction in instructions.get_action_list():
-                self.status = WorkerState.TRANSITIONING
-                print_substep(f"{self} | Running instruction {_i} of {len(instructions.get_action_list())}...", style = "cyan1")
-                print_table(f"{self} Instruction {_i}", items = [[instruction.task.name, instruction.action]], columns = ["Task ID", "Task Action"], color = "blue1")
-                await self.do(instruction)
-                print_substep(f"{self} | Instruction {_i} of {len(instructions.get_action_list())} complete!", style = "cyan1")
-                _i += 1
-            await self.report_completion()
-
-    async def report_completion(self):
-        '''Reports back to the parent :class:`Agent` to inform it that the task has been completed and it is ready for a new one.'''
-        self.is_working = False
-        await self.ws.send(create_ws_message(type = "worker_complete", target = self._parent_agent.agent_name, origin = self.worker_name, data = {"result": "success", "task": jsonpickle.encode(self.current_task)}))
-        self.current_task = None
+            _branches = instructions.branches() if isinstance(instructions, MultiInstruction) else [[instructions]]
+            _stream = f"{self.worker_uuid}/{task_id or uuid.uuid4().hex}" # Screenshots are only deduped within one task, per branch
+            try:
+                if len(_branches) == 1:
+                    _artifacts = await self._run_branch(_branches[0], page, trace, stream = _stream)
+                    await self.report_completion(instructions, artifacts = _artifacts, task_id = task_id, trace = trace)
+                    return
+                _results = await self._run_branches(_branches, page, trace, stream = _stream)
+                _artifacts = [key for result in _results for key in result['artifacts']]
+                _result = "success" if all(result['result'] == "success" for result in _results) else "failed"
+                await self.report_completion(instructions, result = _result, artifacts = _artifacts, task_id = task_id, trace = trace, branches = _results)
+            finally:
+                for n in range(len(_branches)):
+                    self.screenshots.forget(f"{_stream}/{n}")
+
+    async def _run_branch(self, instructions: list, page, trace: Trace = None, branch = 0, stream: str = None):
+        '''Runs `instructions` in order on `page` and returns the artifact keys of the screenshots taken.
+        Screenshots are deduped against the previous one of the branch, in `stream`'''
+        _stream = f"{stream or self.worker_uuid}/{branch}"
+        _artifacts = []
+        _verbose = log_enabled(DEBUG) # Per-instruction output is DEBUG only, so it isn't even built otherwise
+        for _i, instruction in enumerate(instructions, start = 1):
+            self.status = WorkerState.TRANSITIONING
+            if _verbose:
+                print_substep(f"{self} | Branch {branch}: Running instruction {_i} of {len(instructions)}...", style = "cyan1", level = DEBUG, category = "worker")
+                log_table(f"{self} Branch {branch} Instruction {_i}", items = [[instruction.task.name, str(instruction.action)]], columns = ["Task ID", "Task Action"], color = "blue1", level = DEBUG, category = "worker")
+            with span(trace, f"action.{instruction.task.name}"): # Browser time per WorkerTask
+                _result = await self.do(instruction, page, stream = _stream)
+            if _result is not None:
+                _artifacts.append(_result.key)
+            if _verbose:
+                print_substep(f"{self} | Branch {branch}: Instruction {_i} of {len(instructions)} complete!", style = "cyan1", level = DEBUG, category = "worker")
+        return _artifacts
+
+    async def _run_branches(self, branches: list, page, trace: Trace = None, stream: str = None):
+        '''Runs independent branches concurrently: on the task's own page, and on as many extra pages as this Worker has free right
+        now, up to `max_branches` in all. Extra pages are never waited for, branches without one run on the task's pages as they
+        free up, so tasks can't deadlock holding pages each other wants. A failed branch doesn't stop the others.
+        Returns one result per branch, in branch order'''
+        _extra = 0
+        while self._capacity is not None and _extra < min(len(branches), self.max_branches) - 1 and not self._capacity.locked():
+            await self._capacity.acquire() # Free, so this doesn't wait
+            _extra += 1
+        _pending = deque(enumerate(branches))
+        _results = [None] * len(branches)
+
+        async def _lane(lane_page):
+            while _pending:
+                n, branch = _pending.popleft()
+                try:
+                    _results[n] = {"branch": n, "result": "success", "instructions": len(branch), "artifacts": await self._run_branch(branch, lane_page, trace, n, stream = stream)}
+                except Exception as e:
+                    print_substep(f"{self} | Branch {n} failed: {type(e).__name__}: {e}", style = "red1")
+                    _results[n] = {"branch": n, "result": "failed", "instructions": len(branch), "artifacts": [], "error": f"{type(e).__name__}: {e}"}
+
+        async def _extra_lane():
+            try:
+                async with self.engine.page() as lane_page:
+                    await _lane(lane_page)
+            except Exception as e: # The page couldn't be opened or closed. The other lanes take whatever is left
+                print_substep(f"{self} | Extra page failed: {type(e).__name__}: {e}", style = "red1")
 
-    async def do(self, instruction: SingleInstruction):
+        try:
+            await asyncio.gather(_lane(page), *[_extra_lane() for _ in range(_extra)])
+        finally:
+            for _ in range(_extra):
+                self._capacity.release()
+        return _results
+
+    async def report_completion(self, task = None, result = "success", artifacts: list = None, task_id = None, trace: Trace = None, branches: list = None):
+        '''Reports back to the parent :class:`Agent` to inform it that the task has been completed and it is ready for a new one.
+        `branches` are the results of each branch of a :class:`MultiInstruction` that ran as several.'''
+        self.is_working = bool(self._executions)
+        _data = {"result": result, "task": task if task is not None else self.current_task}
+        if artifacts:
+            _data['artifacts'] = artifacts # ArtifactStore keys of the screenshots taken
+        if branches:
+            _data['branches'] = branches # {"branch", "result", "instructions", "artifacts"[, "error"]} each
+        if task_id is not None:
+            _data['task_id'] = task_id
+        if trace is not None:
+            _data['trace'] = trace.to_dict()
+        await self.ws.send(encode_message(type = "worker_complete", target = self._parent_agent.agent_name, origin = self.worker_name, data = _data, protocol = self.protocol))
+
+    async def do(self, instruction: SingleInstruction, page, stream: str = None):
         _task = instruction.task
         if _task == WorkerTask.GOTO:
-            await self.goto(instruction.action)
+            await self.goto(page, instruction.action)
         elif _task == WorkerTask.SCREENSHOT:
-            await self.screenshot_full(self._page, self.worker_uuid)
+            return await self.screenshot_full(page, stream = stream)
+        elif _task == WorkerTask.CLICK:
+            await self.click_browser_selector(page, instruction.action)
+        elif _task == WorkerTask.TYPE:
+            await self.type_text(page, *split_type_action(instruction.action))
 
-    async def goto(self, url):
-        '''Goes to the specified url and returns a page'''
+    async def goto(self, page, url):
+        '''Goes to the specified url on `page`'''
         self.status = WorkerState.GOING
         self.is_working = True
 
         # Do the actual going to the specified URL
-        self.web_driver.goto(url)
+        await self.engine.goto(page, url)
 
-    async def click_browser_selector(self, id, x: int, y: int):
-        '''Click somewhere on the browser given a provided selector. Element is located by ID. Make sure the ID is passed properly.'''
-        elem = self.web_driver.find_element(value = id)
-        elem.click()
+    async def click_browser_selector(self, page, selector):
+        '''Clicks the element matching the CSS `selector`. Use `#<id>` to locate an element by ID.'''
+        self.status = WorkerState.CLICKING
+        await self.engine.click(page, selector)
 
-    async def screenshot_full(self, filepath):
-        '''Takes a screenshot of the full page and returns the bytes result.'''
+    async def type_text(self, page, selector, text):
+        '''Types `text` into the element matching the CSS `selector`'''
+        self.status = WorkerState.TYPING
+        await self.engine.type(page, selector, text)
+
+    async def screenshot_full(self, page, stream: str = None):
+        '''Takes a screenshot of the full page and returns the processed :class:`Screenshot`, kept in memory and in the artifact store.
+        Returns `None` when it is near-identical to the previous screenshot of `stream` (by default this worker's), so it doesn't
+        get inferenced again.'''
         self.status = WorkerState.SCREENSHOTTING
 
-        # Take the full screenshot
-        _p = self.worker_uuid + ".png"
-        self.web_driver.save_screenshot(filename = _p)
+        # Take the full screenshot, then resize and encode it for the vision model off the event loop
+        _png = await self.engine.screenshot(page)
+        _shot = await self.screenshots.process(_png, stream = stream or self.worker_uuid)
+        if _shot.duplicate:
+            print_substep(f"{self} | Screenshot unchanged since the last one, skipped.", style = "gold3")
+            return None
+
+        return _shot
 
     def __str__(self):
         return f"Worker {self.worker_name}"
\ No newline at end of file